@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Write staged files from background threads so that converting the next
+# document overlaps writing the last one out, which matters when the temp
+# directory is on a slow or network mounted volume.
+#
+# BackgroundWriter.staged_output() is a drop in for plugin.staged_output():
+# the converter writes into a small local buffer that is handed to a writer
+# thread in CHUNK_SIZE pieces, and the thread does the open, writes and
+# final rename.  Every chunk of one file goes to the same thread so they
+# are written in order.  The bytes queued but not yet written are capped,
+# a converter that gets ahead of the disk simply waits for room.
+# The threads checksum what they write just as staged_output() does.
+# A failure to write one file is reported by close(), anything else going
+# wrong in a thread stops it and is raised to the converter at its next
+# write, or by close().
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import io
+import threading
+from contextlib import contextmanager
+
+from checksums import staged_checksums
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# bytes collected from a converter before they are queued
+CHUNK_SIZE = 256 * 1024
+
+# default cap on the bytes queued to all writer threads
+MAX_PENDING = 16 * 1024 * 1024
+
+_OPEN, _WRITE, _CLOSE, _ABORT, _STOP = range(5)
+
+
+class _QueuedOutput(object):
+
+    # what the converter writes to, str in text mode and bytes-like in binary
+
+    def __init__(self, writer, fq, fpath, binary):
+        self.writer = writer
+        self.fq = fq
+        self.fpath = fpath
+        self.binary = binary
+        self.buf = bytearray()
+
+    def write(self, data):
+        if self.binary:
+            self.buf += data
+        else:
+            self.buf += data.encode("utf-8")
+        if len(self.buf) >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buf:
+            chunk = bytes(self.buf)
+            self.buf = bytearray()
+            self.writer._put(self.fq, (_WRITE, self.fpath, chunk), len(chunk))
+
+
+class BackgroundWriter(object):
+
+    def __init__(self, threads=2, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.errors = []
+        self.fatal = None
+        self.next_queue = 0
+        self.queues = []
+        self.threads = []
+        for i in range(max(1, threads)):
+            fq = queue.Queue()
+            t = threading.Thread(target=self._serve, args=(fq,))
+            t.daemon = True
+            t.start()
+            self.queues.append(fq)
+            self.threads.append(t)
+
+    def _put(self, fq, op, size):
+        # backpressure: wait until the chunk fits under the cap, a chunk
+        # larger than the cap is let through once nothing else is queued
+        with self.cond:
+            while self.fatal is None and self.pending > 0 and self.pending + size > self.max_pending:
+                self.cond.wait()
+            if self.fatal is not None:
+                raise self.fatal
+            self.pending += size
+        fq.put((op, size))
+
+    def _done(self, size):
+        if size:
+            with self.cond:
+                self.pending -= size
+                self.cond.notify_all()
+
+    def _serve(self, fq):
+        files = {}
+        failed = set()
+        while True:
+            (op, size) = fq.get()
+            cmd, fpath = op[0], op[1] if len(op) > 1 else None
+            if cmd == _STOP:
+                break
+            tmp_path = fpath + ".tmp"
+            try:
+                if fpath in failed:
+                    if cmd in (_CLOSE, _ABORT):
+                        failed.discard(fpath)
+                elif cmd == _OPEN:
+                    files[fpath] = (io.open(tmp_path, "wb"), staged_checksums.new_hasher())
+                elif cmd == _WRITE:
+                    f, hasher = files[fpath]
+                    f.write(op[2])
+                    hasher.update(op[2])
+                elif cmd == _CLOSE:
+                    f, hasher = files.pop(fpath)
+                    f.close()
+                    if os.path.exists(fpath):
+                        os.remove(fpath)
+                    os.rename(tmp_path, fpath)
+                    staged_checksums.record(fpath, hasher)
+                elif cmd == _ABORT:
+                    files.pop(fpath)[0].close()
+                    os.remove(tmp_path)
+            except (IOError, OSError) as e:
+                with self.cond:
+                    self.errors.append((fpath, e))
+                f = files.pop(fpath, None)
+                if f is not None:
+                    f[0].close()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if cmd not in (_CLOSE, _ABORT):
+                    failed.add(fpath)
+            except BaseException as e:
+                # the thread cannot go on, wake up whoever waits for room
+                # so that they see the error instead of waiting forever
+                with self.cond:
+                    if self.fatal is None:
+                        self.fatal = e
+                    self.cond.notify_all()
+                for f, hasher in files.values():
+                    f.close()
+                for open_path in files:
+                    if os.path.exists(open_path + ".tmp"):
+                        os.remove(open_path + ".tmp")
+                break
+            self._done(size)
+
+    @contextmanager
+    def staged_output(self, fpath, binary=False):
+        """
+        Queue writing fpath the way plugin.staged_output() writes it:
+        to a temporary file that replaces fpath once the block completes
+        and is written, and is removed if the block raises.
+        A failure to write is not raised here, see close().
+
+        :param fpath: the path of the file
+        :type  fpath: str
+        :param binary: if True, take utf-8 bytes instead of str
+        :type  binary: bool
+        """
+        with self.cond:
+            fq = self.queues[self.next_queue]
+            self.next_queue = (self.next_queue + 1) % len(self.queues)
+        self._put(fq, (_OPEN, fpath), 0)
+        out = _QueuedOutput(self, fq, fpath, binary)
+        try:
+            yield out
+        except BaseException:
+            self._put(fq, (_ABORT, fpath), 0)
+            raise
+        out.flush()
+        self._put(fq, (_CLOSE, fpath), 0)
+
+    def close(self):
+        """
+        Wait for everything queued to be written and stop the threads.
+        Safe to call more than once.  Raises the error that stopped a
+        thread, if any.
+
+        :returns: (fpath, exception) for every file that failed to be written
+        :rtype: list of tuple
+        """
+        for fq in self.queues:
+            fq.put(((_STOP,), 0))
+        for t in self.threads:
+            t.join()
+        self.queues = []
+        self.threads = []
+        if self.fatal is not None:
+            raise self.fatal
+        return self.errors
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Checksums of the staged files, computed from the bytes as they are
+# written so that the zip writer never has to read a converted file back
+# just for its CRC32, and the SHA-256 sidecar costs no extra pass.
+#
+# staged_output() and the BackgroundWriter record every file they finish
+# in the module's registry; the zip writer looks files up there and only
+# hashes the ones it finds no (or a stale) entry for, such as the linked
+# resources, while it reads them to compress them.  Entries are made in
+# this process, files converted by worker processes are hashed at zip time.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import io
+import json
+import zlib
+import hashlib
+import threading
+
+
+class Hasher(object):
+
+    def __init__(self, sha256=False):
+        self.crc = 0
+        self.size = 0
+        self.sha = hashlib.sha256() if sha256 else None
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.sha is not None:
+            self.sha.update(data)
+
+    def get_crc(self):
+        return self.crc & 0xFFFFFFFF
+
+    def get_sha256(self):
+        if self.sha is None:
+            return None
+        return self.sha.hexdigest()
+
+
+class HashingFile(io.RawIOBase):
+
+    # a binary file that hashes whatever goes through it on the way to disk
+
+    def __init__(self, fpath, hasher):
+        io.RawIOBase.__init__(self)
+        self.fp = io.open(fpath, "wb")
+        self.hasher = hasher
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        n = self.fp.write(data)
+        self.hasher.update(data)
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.fp.close()
+        io.RawIOBase.close(self)
+
+
+def _key(fpath):
+    return os.path.normcase(os.path.abspath(fpath))
+
+
+class ChecksumRegistry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.sha256 = False
+
+    def reset(self, sha256=False):
+        """
+        Forget all entries and set whether SHA-256 is computed from now on.
+        """
+        with self.lock:
+            self.entries = {}
+            self.sha256 = sha256
+
+    def new_hasher(self):
+        return Hasher(self.sha256)
+
+    def record(self, fpath, hasher):
+        """
+        Remember the checksums of the file just written at fpath,
+        with its size and modification time to spot later changes.
+        """
+        st = os.stat(fpath)
+        if st.st_size != hasher.size:
+            return
+        with self.lock:
+            self.entries[_key(fpath)] = (st.st_size, st.st_mtime, hasher.get_crc(), hasher.get_sha256())
+
+    def forget(self, fpath):
+        with self.lock:
+            self.entries.pop(_key(fpath), None)
+
+    def lookup(self, fpath, st=None):
+        """
+        Return (crc32, sha256 hex digest or None) of fpath if they were
+        recorded and it has not changed since, else None.
+        """
+        if st is None:
+            st = os.stat(fpath)
+        with self.lock:
+            entry = self.entries.get(_key(fpath), None)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+            return None
+        return entry[2], entry[3]
+
+
+# the registry of this process
+staged_checksums = ChecksumRegistry()
+
+
+def sidecar_path(fpath):
+    return fpath + ".checksums.json"
+
+
+def write_sidecar(fpath, summary):
+    """
+    Write the checksums write_epub() returned for the epub fpath to the
+    manifest next to it: the epub's name, size, crc32 and sha256 and the
+    same for every member in archive order, crc32 as 8 hex digits and
+    sha256 as a hex digest or null when it was not computed.
+
+    :returns: the path of the manifest
+    :rtype: str
+    """
+    manifest = {"epub": os.path.basename(fpath)}
+    manifest.update(summary)
+    spath = sidecar_path(fpath)
+    with open(spath, "w") as f:
+        f.write(json.dumps(manifest, indent=1, sort_keys=True))
+        f.write("\n")
+    return spath
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Zip the staged book into an epub, deflating its members on several
+# threads at once (zlib releases the GIL while it compresses) and writing
+# them out in a fixed order with the mimetype first and stored.
+#
+# zipfile cannot write data that is already compressed, so the local
+# headers, central directory and end record are written here.  Books that
+# would need zip64 (members or archives of 4GB or more, 65535 members or
+# more) are left to zipfile, one member at a time.
+#
+# A member whose checksums were recorded while it was staged (see
+# checksums.py) is not checksummed again, the rest are hashed as they are
+# read for compressing, and the epub itself is hashed as it is written.
+#
+# The reading order layout puts what a reader needs to show the first page
+# at the front of the archive and audio and video at the back, so that a
+# reader fetching the epub by ranges gets there with the fewest bytes.
+#
+# Given a timestamp, the archive depends on nothing but the staged files'
+# names and contents: every member gets that time and the same permissions.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import io
+import sys
+import time
+import zlib
+import shutil
+import struct
+import tempfile
+import zipfile
+
+from checksums import Hasher, HashingFile
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_RECORD = struct.Struct("<IHHHHIIH")
+
+_ZIP32_LIMIT = 0xFFFFFFFF
+_MAX_MEMBERS = 0xFFFF
+
+# bytes read from a member at a time
+READ_SIZE = 1024 * 1024
+
+# compressed members bigger than this are spooled to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+
+# bit 11 of the flags, the name is utf-8
+_UTF8_FLAG = 0x800
+
+# the mode of every member when the archive is written with a timestamp,
+# a regular file readable by all
+NORMALIZED_MODE = 0o100644
+
+# 1980-01-01 00:00:00 UTC, the earliest time a zip can hold
+_DOS_EPOCH = 315532800
+
+DEFAULT_LEVEL = 6
+
+# deflate level by manifest media type, 0 stores the member as is
+# media that is already compressed gains next to nothing from deflate
+# and markup gains the most from the higher levels
+COMPRESSION_POLICY = {
+    "image/jpeg": 0,
+    "image/png": 0,
+    "image/gif": 0,
+    "image/webp": 0,
+    "audio/mpeg": 0,
+    "audio/mp4": 0,
+    "audio/ogg": 0,
+    "audio/opus": 0,
+    "video/mp4": 0,
+    "video/webm": 0,
+    "font/woff": 0,
+    "font/woff2": 0,
+    "application/font-woff": 0,
+    "application/font-woff2": 0,
+    "application/xhtml+xml": 9,
+    "application/x-dtbncx+xml": 9,
+    "application/oebps-package+xml": 9,
+    "application/smil+xml": 9,
+    "image/svg+xml": 9,
+    "text/css": 9,
+}
+
+
+def member_level(name, media_type, policy=None):
+    """
+    Return the deflate level for a member, 0 to store it.
+    The mimetype is always stored, members of media types not in
+    the policy are deflated at DEFAULT_LEVEL.
+
+    :param name: the book path of the member
+    :type  name: str
+    :param media_type: its manifest media type, None if not in the manifest
+    :type  media_type: str
+    :param policy: media type to level, COMPRESSION_POLICY if None
+    :type  policy: dict
+    :rtype: int
+    """
+    if name == "mimetype":
+        return 0
+    if policy is None:
+        policy = COMPRESSION_POLICY
+    return policy.get(media_type, DEFAULT_LEVEL)
+
+
+def _dos_date_time(mtime, utc=False):
+    t = time.gmtime(mtime) if utc else time.localtime(mtime)
+    year = max(t.tm_year, 1980)
+    dosdate = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dosdate, dostime
+
+
+def epub_member_names(book_dir):
+    """
+    Return the book paths of all files under book_dir
+    with mimetype first and the rest sorted.
+
+    :rtype: list of str
+    """
+    names = []
+    for dirpath, dirnames, filenames in os.walk(book_dir):
+        rel = os.path.relpath(dirpath, book_dir)
+        for fname in filenames:
+            if rel == os.curdir:
+                names.append(fname)
+            else:
+                names.append(os.path.join(rel, fname).replace(os.sep, "/"))
+    if "mimetype" not in names:
+        raise Exception("mimetype file is missing")
+    names.remove("mimetype")
+    names.sort()
+    return ["mimetype"] + names
+
+
+# members of these media types go last in the reading order layout
+DEFERRED_MEDIA = ("audio/", "video/")
+
+
+def reading_order(names, first=(), media_types=None):
+    """
+    Reorder the member names epub_member_names() gave for reading:
+    the mimetype, META-INF/container.xml, the book paths in first in
+    their order, the other members but audio and video in the order
+    they were given, and then the audio and video.
+
+    :param names: the member names, mimetype first
+    :type  names: list of str
+    :param first: book paths to put right after the container, those
+                  not in names are skipped
+    :type  first: list of str
+    :param media_types: book path to manifest media type
+    :type  media_types: dict
+    :rtype: list of str
+    """
+    if media_types is None:
+        media_types = {}
+    present = set(names)
+    ordered = []
+    seen = set()
+    for name in ["mimetype", "META-INF/container.xml"] + list(first):
+        if name in present and name not in seen:
+            ordered.append(name)
+            seen.add(name)
+    deferred = []
+    for name in names:
+        if name in seen:
+            continue
+        if media_types.get(name, "").startswith(DEFERRED_MEDIA):
+            deferred.append(name)
+        else:
+            ordered.append(name)
+    return ordered + deferred
+
+
+class _Member(object):
+
+    def __init__(self, name, fpath, level, checksums=None, sha256=False, timestamp=None):
+        self.name = name
+        self.fpath = fpath
+        self.level = level
+        self.method = zipfile.ZIP_DEFLATED if level > 0 else zipfile.ZIP_STORED
+        st = os.stat(fpath)
+        if timestamp is None:
+            self.mode = st.st_mode & 0xFFFF
+            self.dosdate, self.dostime = _dos_date_time(st.st_mtime)
+        else:
+            self.mode = NORMALIZED_MODE
+            self.dosdate, self.dostime = _dos_date_time(max(timestamp, _DOS_EPOCH), utc=True)
+        self.known = None
+        if checksums is not None:
+            self.known = checksums.lookup(fpath, st)
+            if self.known is not None and sha256 and self.known[1] is None:
+                self.known = None
+        self.sha256 = sha256
+        self.crc = 0
+        self.sha = None
+        self.size = 0
+        self.csize = 0
+        self.data = None
+        self.offset = 0
+
+    def compress(self):
+        # runs on a pool thread, the compressed data goes to a
+        # spooled temporary file so huge members do not sit in memory
+        data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        compressor = None
+        if self.method == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        hasher = None
+        if self.known is None:
+            hasher = Hasher(self.sha256)
+        with open(self.fpath, "rb") as inf:
+            while True:
+                chunk = inf.read(READ_SIZE)
+                if not chunk:
+                    break
+                self.size += len(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                data.write(chunk)
+        if compressor is not None:
+            data.write(compressor.flush())
+        if hasher is not None:
+            self.crc, self.sha = hasher.get_crc(), hasher.get_sha256()
+        else:
+            self.crc = self.known[0]
+            self.sha = self.known[1] if self.sha256 else None
+        self.csize = data.tell()
+        data.seek(0)
+        self.data = data
+        return self
+
+    def _flags_and_name(self):
+        try:
+            return 0, self.name.encode("ascii")
+        except UnicodeEncodeError:
+            return _UTF8_FLAG, self.name.encode("utf-8")
+
+    def write_local(self, out, offset):
+        self.offset = offset
+        flags, name = self._flags_and_name()
+        out.write(_LOCAL_HEADER.pack(0x04034b50, 20, flags, self.method, self.dostime, self.dosdate,
+                                     self.crc, self.csize, self.size, len(name), 0))
+        out.write(name)
+        while True:
+            chunk = self.data.read(READ_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+        self.data.close()
+        self.data = None
+        return _LOCAL_HEADER.size + len(name) + self.csize
+
+    def central_record(self):
+        flags, name = self._flags_and_name()
+        return _CENTRAL_HEADER.pack(0x02014b50, 3 << 8 | 20, 20, flags, self.method, self.dostime, self.dosdate,
+                                    self.crc, self.csize, self.size, len(name), 0, 0, 0, 0,
+                                    self.mode << 16, self.offset) + name
+
+
+def _needs_zip64(book_dir, names):
+    if len(names) >= _MAX_MEMBERS:
+        return True
+    total = 0
+    for name in names:
+        total += os.path.getsize(os.path.join(book_dir, name.replace("/", os.sep)))
+    # deflate can grow incompressible data a little, so allow for it
+    return total + total // 64 + len(names) * 1024 >= _ZIP32_LIMIT
+
+
+def _write_normalized(zf, fname, name, level, timestamp):
+    zinfo = zipfile.ZipInfo(name, time.gmtime(max(timestamp, _DOS_EPOCH))[:6])
+    zinfo.external_attr = NORMALIZED_MODE << 16
+    zinfo.file_size = os.path.getsize(fname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED if level > 0 else zipfile.ZIP_STORED
+    if level > 0 and sys.version_info >= (3, 7):
+        zinfo._compresslevel = level
+    with open(fname, "rb") as inf:
+        if sys.version_info >= (3, 6):
+            # zipfile adds a zip64 extra field only when file_size needs
+            # one, the mimetype must never get one (OCF PKG-005)
+            with zf.open(zinfo, "w") as outf:
+                shutil.copyfileobj(inf, outf, READ_SIZE)
+        else:
+            # zipfile cannot stream a member it is given a ZipInfo for
+            # before 3.6, and the staged file's own time and mode must not
+            # be changed as it may be linked to Sigil's copy of the book
+            zf.writestr(zinfo, inf.read())
+
+
+def _write_with_zipfile(book_dir, names, fpath, levels, timestamp=None):
+    # zipfile does its own checksumming, there is nothing to report
+    with zipfile.ZipFile(fpath, "w", allowZip64=True) as zf:
+        for name, level in zip(names, levels):
+            fname = os.path.join(book_dir, name.replace("/", os.sep))
+            if timestamp is not None:
+                _write_normalized(zf, fname, name, level, timestamp)
+            elif level == 0:
+                zf.write(fname, name, zipfile.ZIP_STORED)
+            elif sys.version_info >= (3, 7):
+                zf.write(fname, name, zipfile.ZIP_DEFLATED, level)
+            else:
+                zf.write(fname, name, zipfile.ZIP_DEFLATED)
+
+
+def write_epub(book_dir, fpath, threads=0, media_types=None, policy=None, checksums=None, sha256=False,
+               timestamp=None, first=None):
+    """
+    Zip the book staged in book_dir into the epub fpath, deflating
+    members on threads threads (0 for one per cpu) at the level
+    member_level() gives for their media type.
+    Members are written in the order of epub_member_names(), or of
+    reading_order() when first is given.
+
+    :param book_dir: the staged book
+    :type  book_dir: str
+    :param fpath: the path of the epub to create
+    :type  fpath: str
+    :param threads: number of compressing threads, 0 for one per cpu
+    :type  threads: int
+    :param media_types: book path to manifest media type
+    :type  media_types: dict
+    :param policy: media type to deflate level, COMPRESSION_POLICY if None
+    :type  policy: dict
+    :param checksums: where the checksums of staged files were recorded
+    :type  checksums: checksums.ChecksumRegistry
+    :param sha256: if True, also compute the SHA-256 of members and the epub
+    :type  sha256: bool
+    :param timestamp: if given, the time in seconds since the epoch given to
+                      every member instead of its modification time, and
+                      their permissions are normalized too
+    :type  timestamp: int or None
+    :param first: if given, the book paths to lead the reading order layout with
+    :type  first: list of str
+    :returns: the checksums of the epub and its members, see write_sidecar(),
+              or None if the book had to be written by zipfile
+    :rtype: dict or None
+    """
+    if media_types is None:
+        media_types = {}
+    names = epub_member_names(book_dir)
+    if first is not None:
+        names = reading_order(names, first, media_types)
+    levels = [member_level(name, media_types.get(name, None), policy) for name in names]
+    if _needs_zip64(book_dir, names):
+        _write_with_zipfile(book_dir, names, fpath, levels, timestamp)
+        return None
+    if threads <= 0:
+        threads = getattr(os, "cpu_count", lambda: 1)() or 1
+
+    members = []
+    for name, level in zip(names, levels):
+        members.append(_Member(name, os.path.join(book_dir, name.replace("/", os.sep)), level,
+                               checksums, sha256, timestamp))
+
+    hasher = Hasher(sha256)
+    with io.BufferedWriter(HashingFile(fpath, hasher), READ_SIZE) as out:
+        offset = 0
+        if threads == 1 or ThreadPoolExecutor is None:
+            for member in members:
+                offset += member.compress().write_local(out, offset)
+        else:
+            # keep only a few members compressed ahead of the one being
+            # written, they are written in order as they complete
+            window = threads * 2
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                futures = []
+                pos = 0
+                for i, member in enumerate(members):
+                    while pos < len(members) and pos < i + window:
+                        futures.append(executor.submit(members[pos].compress))
+                        pos += 1
+                    offset += futures[i].result().write_local(out, offset)
+        cd_start = offset
+        for member in members:
+            record = member.central_record()
+            out.write(record)
+            offset += len(record)
+        out.write(_END_RECORD.pack(0x06054b50, 0, 0, len(members), len(members),
+                                   offset - cd_start, cd_start, 0))
+    return {
+        "size": hasher.size,
+        "crc32": "%08x" % hasher.get_crc(),
+        "sha256": hasher.get_sha256(),
+        "members": [{"name": member.name, "size": member.size,
+                     "crc32": "%08x" % member.crc, "sha256": member.sha} for member in members],
+    }
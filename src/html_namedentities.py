@@ -1,5 +1,7 @@
 from __future__ import absolute_import, division, unicode_literals
 
+import re
+
 # do not convert basic xml entities as they are properly recognized in epub3
 
 named_entities = {
@@ -2223,3 +2225,51 @@ named_entities = {
     "zwj;": "\u200d",
     "zwnj;": "\u200c",
 }
+
+
+IS_NAMED_ENTITY = re.compile(r"(&\w+;)")
+
+# remap any html named enities to numeric entities
+# a few named entities map to more than one code point
+def convert_named_entities(text):
+    pieces = IS_NAMED_ENTITY.split(text)
+    for i in range(1, len(pieces),2):
+        piece = pieces[i]
+        sval = named_entities.get(piece[1:],"")
+        if sval != "":
+            piece = "".join(["&#%d;" % ord(c) for c in sval])
+            pieces[i] =piece
+    return "".join(pieces)
+
+
+# text runs longer than this are converted a chunk at a time
+TEXT_CHUNK_SIZE = 64 * 1024
+
+# the longest named entity with its & and ;
+_MAX_ENTITY_LEN = max(len(k) for k in named_entities) + 1
+
+# yield (start, end) bounds splitting text[start:end] into chunks of about
+# chunk_size, each cut placed so that no named entity straddles it
+# an entity can only be cut if it starts in the last _MAX_ENTITY_LEN
+# characters before the cut, so cutting just before the last '&' there
+# is always safe as no entity holds an '&' past its first character
+# works on str, bytes or mmap given the matching amp ("&" or b"&")
+def text_chunks(text, start=0, end=None, chunk_size=TEXT_CHUNK_SIZE, amp="&"):
+    if end is None:
+        end = len(text)
+    chunk_size = max(chunk_size, 2 * _MAX_ENTITY_LEN)
+    while end - start > chunk_size:
+        cut = start + chunk_size
+        a = text.rfind(amp, cut - _MAX_ENTITY_LEN, cut)
+        if a > start:
+            cut = a
+        yield start, cut
+        start = cut
+    yield start, end
+
+
+# convert_named_entities() writing the result to write() in bounded chunks
+# so a multi megabyte text run is never split and joined as a whole
+def write_named_entities(text, write, chunk_size=TEXT_CHUNK_SIZE):
+    for b, e in text_chunks(text, 0, len(text), chunk_size):
+        write(convert_named_entities(text[b:e]))
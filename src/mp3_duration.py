@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Determine the playing time of an mp3 file from its frame headers
+# without decoding any audio.  Uses the Xing/Info or VBRI header when
+# the encoder wrote one, and otherwise walks every frame header.  The
+# file is memory mapped so only the headers are ever touched.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import mmap
+import struct
+import threading
+
+# bitrates in kbps indexed by [version is MPEG1][layer][bitrate index]
+_BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+
+# sample rates indexed by version bits then sample rate index
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG1
+    2: (22050, 24000, 16000),  # MPEG2
+    0: (11025, 12000, 8000),   # MPEG2.5
+}
+
+# how many frame headers must chain together before we trust a sync
+_SYNC_FRAMES = 3
+
+
+def parse_frame_header(data, pos):
+    """
+    Decode the 4 byte mp3 frame header at pos.
+
+    Return a tuple (frame_length, samples, sample_rate, is_mpeg1, is_mono)
+    or None if there is no valid header there.
+    """
+    if pos + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = struct.unpack_from(">4B", data, pos)
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bitrate_index = (b2 >> 4) & 0x0F
+    rate_index = (b2 >> 2) & 0x03
+    padding = (b2 >> 1) & 0x01
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    is_mpeg1 = version == 3
+    bitrate = _BITRATES[is_mpeg1][layer][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        samples = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if (layer == 2 or is_mpeg1) else 576
+        frame_length = samples // 8 * bitrate // sample_rate + padding
+    is_mono = (b3 >> 6) == 3
+    return frame_length, samples, sample_rate, is_mpeg1, is_mono
+
+
+def _skip_id3v2(data):
+    pos = 0
+    # there may be more than one tag, as appended by some taggers
+    while data[pos:pos+3] == b"ID3" and pos + 10 <= len(data):
+        flags = data[pos+5:pos+6][0]
+        s = data[pos+6:pos+10]
+        size = (s[0] << 21) | (s[1] << 14) | (s[2] << 7) | s[3]
+        pos += 10 + size
+        if flags & 0x10:
+            pos += 10
+    return pos
+
+
+def _frames_chain(data, pos, end):
+    # a run of valid headers each where the previous frame says it should be
+    for i in range(_SYNC_FRAMES):
+        hdr = parse_frame_header(data, pos)
+        if hdr is None:
+            return False
+        pos += hdr[0]
+        if pos >= end:
+            # a short file may hold fewer frames than we want to chain
+            return True
+    return True
+
+
+def _find_first_frame(data, pos, end):
+    while True:
+        pos = data.find(b"\xff", pos, end)
+        if pos == -1 or _frames_chain(data, pos, end):
+            return pos
+        pos += 1
+
+
+def _vbr_header_duration(data, pos, hdr):
+    frame_length, samples, sample_rate, is_mpeg1, is_mono = hdr
+    # Xing or Info header sits right after the side information
+    if is_mpeg1:
+        side = 17 if is_mono else 32
+    else:
+        side = 9 if is_mono else 17
+    x = pos + 4 + side
+    tag = data[x:x+4]
+    # a truncated header is no header, the frames are counted instead
+    if tag in (b"Xing", b"Info") and len(data) >= x + 12:
+        flags = struct.unpack_from(">I", data, x + 4)[0]
+        if not flags & 0x01:
+            return None
+        # the frame count leaves out this header frame which holds no audio
+        # any encoder delay and padding are kept as readers play them too
+        frames = struct.unpack_from(">I", data, x + 8)[0]
+        return frames * samples / sample_rate
+    # VBRI header is always 32 bytes after the frame header
+    v = pos + 4 + 32
+    if data[v:v+4] == b"VBRI" and len(data) >= v + 18:
+        frames = struct.unpack_from(">I", data, v + 14)[0]
+        return frames * samples / sample_rate
+    return None
+
+
+def scan_duration(data):
+    """
+    Return the duration in seconds of the mp3 held in data (any buffer),
+    or None if no mp3 frames are found.
+    """
+    end = len(data)
+    if end >= 128 and data[end-128:end-125] == b"TAG":
+        end -= 128
+    pos = _find_first_frame(data, _skip_id3v2(data), end)
+    if pos == -1:
+        return None
+    hdr = parse_frame_header(data, pos)
+    duration = _vbr_header_duration(data, pos, hdr)
+    if duration is not None:
+        return duration
+
+    # no usable header so count the frames
+    duration = 0.0
+    while pos < end:
+        hdr = parse_frame_header(data, pos)
+        if hdr is None or pos + hdr[0] > end:
+            # lost sync, skip junk up to the next run of valid frames
+            pos = _find_first_frame(data, pos + 1, end)
+            if pos == -1:
+                break
+            continue
+        duration += hdr[1] / hdr[2]
+        pos += hdr[0]
+    return duration
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def mp3_duration(fpath):
+    """
+    Return the duration in seconds of the mp3 file at fpath,
+    or None if it cannot be determined.
+    Results are cached for the life of the process by the file's real
+    path, size and modification time, so the file is scanned once
+    however many clips or overlays ask for it.
+
+    :param fpath: the path of the mp3 file
+    :type  fpath: str
+    :rtype: float or None
+    """
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    path = os.path.realpath(fpath)
+    key = (st.st_size, st.st_mtime)
+    with _cache_lock:
+        cached = _cache.get(path, None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    duration = None
+    if st.st_size > 0:
+        with open(fpath, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                duration = scan_duration(mm)
+            finally:
+                mm.close()
+    with _cache_lock:
+        _cache[path] = (key, duration)
+    return duration
@@ -5,6 +5,7 @@
 from __future__ import unicode_literals, division, absolute_import, print_function
 
 import sys, os
+import io
 from datetime import datetime
 
 try:
@@ -14,12 +15,12 @@ except ImportError:
 
 
 def create_starttag(tname, tattr):
-    tag = "<" + tname
+    tag = ["<" + tname]
     if tattr is not None:
         for key in tattr:
-            tag += ' ' + key + '="'+tattr[key]+'"'
-    tag += '>\n'
-    return tag
+            tag.append(' ' + key + '="'+tattr[key]+'"')
+    tag.append('>\n')
+    return "".join(tag)
 
 
 def taginfo_toxml(taginfo):
@@ -45,15 +46,253 @@ _epub3_allowed_dctypes = ["dictionary", "index", "distributable-object", "edupub
 _OPF_PARENT_TAGS = ['?xml', 'package', 'metadata', 'dc-metadata', 'x-metadata', 'manifest', 'spine', 'tours', 'guide']
 
 
-# note all href returned by the guide are opf relative hrefs not book hrefs
-class Opf_Converter(object):
+# dotted path of the currently open tags
+# _convertOpf only ever asks if a section name is somewhere in the path
+# or if the path ends with one, so keep a count of open tags per section
+# name to answer those in constant time no matter how deep the nesting
+class _TagPath(object):
+
+    _SECTIONS = ('metadata', 'manifest', 'spine', 'guide')
+
+    def __init__(self):
+        self.names = []
+        self.counts = dict((k, 0) for k in self._SECTIONS)
+
+    def push(self, tname):
+        self.names.append(tname)
+        for k in self._SECTIONS:
+            if k in tname:
+                self.counts[k] += 1
+
+    def pop(self):
+        # ignore stray end tags
+        if not self.names:
+            return
+        tname = self.names.pop()
+        for k in self._SECTIONS:
+            if k in tname:
+                self.counts[k] -= 1
+
+    def endswith(self, s):
+        return len(self.names) > 0 and self.names[-1].endswith(s)
+
+    def __contains__(self, s):
+        if s in self.counts:
+            return self.counts[s] > 0
+        return s in str(self)
 
-    def __init__(self, opf2data, spine_properties, manifest_properties, mo_properties, man_ids):
+    def __str__(self):
+        return ".".join(self.names)
+
+
+def _uid_from_identifier(tattr, tcontent):
+    uid = tcontent
+    if "opf:scheme" in tattr:
+        scheme = tattr["opf:scheme"].lower()
+        if not uid.startswith("urn:"):
+            uid = "urn:" + scheme + ":" + tcontent
+    return uid
+
+
+# splits an opf into text and parsed tags
+# tokenize() does all of the parsing up front so that it can be done
+# before (and concurrently with) whatever produces the manifest and spine
+# properties an Opf_Converter needs
+class Opf_Tokenizer(object):
+
+    def __init__(self, opf2data, watchdog=None):
         self.opf = opf2data
+        self.watchdog = watchdog
+        self.opos = 0
+        self.gtpos = -1
+        self.tokens = None
+
+    def tokenize(self):
+        """
+        Parse the whole opf now, later passes reuse the result.
+        Returns self so a tokenizer can be built and run in one go.
+        """
+        if self.tokens is None:
+            self.tokens = list(self._opf_tokens())
+            self.opf = None
+        return self
+
+    def get_uid(self):
+        """
+        Return the book's unique identifier as Opf_Converter.get_uid()
+        will, looking only at the package tag and dc:identifiers.
+        """
+        uniqueid = None
+        uid = ""
+        for prefix, tname, tattr, tcontent in self._opf_tag_iter():
+            if tname == "package":
+                uniqueid = tattr.get("unique-identifier", None)
+            elif "metadata" in prefix and tname == "dc:identifier":
+                if uniqueid and tattr.get("id","") == uniqueid:
+                    uid = _uid_from_identifier(tattr, tcontent)
+        return uid
+
+    # yields (text, None) or (None, (ttype, tname, tattr))
+    def _opf_tokens(self):
+        if self.tokens is not None:
+            for token in self.tokens:
+                if self.watchdog is not None:
+                    self.watchdog.check()
+                yield token
+            return
+        while True:
+            if self.watchdog is not None:
+                self.watchdog.check()
+            text, tag = self._parseopf()
+            if text is None and tag is None:
+                break
+            if text is not None:
+                yield text, None
+            else:
+                yield None, self._parsetag(tag)
+
+    # OPF tag iterator
+    def _opf_tag_iter(self):
+        tcontent = last_tattr = None
+        prefix = _TagPath()
+        for text, tag in self._opf_tokens():
+            if text is not None:
+                tcontent = text.rstrip(" \r\n")
+            else: # we have a tag
+                ttype, tname, tattr = tag
+                if ttype == "begin":
+                    tcontent = None
+                    prefix.push(tname)
+                    if tname in _OPF_PARENT_TAGS:
+                        yield prefix, tname, tattr, tcontent
+                    else:
+                        last_tattr = tattr
+                else: # single or end
+                    if ttype == "end":
+                        prefix.pop()
+                        tattr = last_tattr
+                        if tattr is None:
+                            tattr = {}
+                        last_tattr = None
+                    elif ttype == 'single':
+                        tcontent = None
+                    if ttype == 'single' or (ttype == 'end' and tname not in _OPF_PARENT_TAGS):
+                        yield prefix, tname, tattr, tcontent
+                    tcontent = None
+
+    # parse and return either leading text or the next tag
+    def _parseopf(self):
+        p = self.opos
+        if p >= len(self.opf):
+            return None, None
+        if self.opf[p] != '<':
+            res = self.opf.find('<',p)
+            if res == -1 :
+                res = len(self.opf)
+            self.opos = res
+            return self.opf[p:res], None
+        # handle comment as a special case
+        # an unterminated comment or tag runs to the end of the data
+        if self.opf[p:p+4] == '<!--':
+            te = self.opf.find('-->',p+1)
+            if te != -1:
+                te = te+2
+            else:
+                te = len(self.opf) - 1
+        else:
+            # remember where the next '>' is so that a long run of
+            # stray '<' does not rescan the same data over and over
+            if self.gtpos <= p:
+                self.gtpos = self.opf.find('>',p+1)
+                if self.gtpos == -1:
+                    self.gtpos = len(self.opf)
+            te = self.gtpos
+            ntb = self.opf.find('<',p+1,te)
+            if ntb != -1:
+                self.opos = ntb
+                return self.opf[p:ntb], None
+            if te == len(self.opf):
+                te -= 1
+        self.opos = te + 1
+        return None, self.opf[p:te+1]
+
+
+    # parses tag to identify:  [tname, ttype, tattr]
+    #    tname: tag name,    ttype: tag type ('begin', 'end' or 'single');
+    #    tattr: dictionary of tag atributes
+    def _parsetag(self, s):
+        n = len(s)
+        p = 1
+        tname = None
+        ttype = None
+        tattr = {}
+        while p < n and s[p:p+1] == ' ' : p += 1
+        if s[p:p+1] == '/':
+            ttype = 'end'
+            p += 1
+            while p < n and s[p:p+1] == ' ' : p += 1
+        b = p
+        while p < n and s[p:p+1] not in ('>', '/', ' ', '"', "'","\r","\n") : p += 1
+        tname=s[b:p].lower()
+        # remove redundant opf prefixes
+        if tname.startswith("opf:"):
+            tname = tname[4:]
+        # some special cases
+        if tname == "?xml":
+            tname = "?xml"
+        if tname == "!--":
+            ttype = 'single'
+            comment = s[p:-3].strip()
+            tattr['comment'] = comment
+        if ttype is None:
+            # parse any attributes of begin or single tags
+            while s.find('=',p) != -1 :
+                while p < n and s[p:p+1] == ' ' : p += 1
+                b = p
+                while p < n and s[p:p+1] != '=' : p += 1
+                aname = s[b:p].lower()
+                aname = aname.rstrip(' ')
+                p += 1
+                while p < n and s[p:p+1] == ' ' : p += 1
+                if s[p:p+1] in ('"', "'") :
+                    qt = s[p:p+1]
+                    p = p + 1
+                    b = p
+                    while p < n and s[p:p+1] != qt: p += 1
+                    val = s[b:p]
+                    p += 1
+                else :
+                    b = p
+                    while p < n and s[p:p+1] not in ('>', '/', ' ') : p += 1
+                    val = s[b:p]
+                tattr[aname] = val
+        if ttype is None:
+            ttype = 'begin'
+            if s.find('/',p) >= 0:
+                ttype = 'single'
+        return ttype, tname, tattr
+
+
+# note all href returned by the guide are opf relative hrefs not book hrefs
+class Opf_Converter(Opf_Tokenizer):
+
+    def __init__(self, opf2data, spine_properties, manifest_properties, mo_properties, man_ids, watchdog=None, tokenizer=None, modified=None):
+        Opf_Tokenizer.__init__(self, opf2data, watchdog)
+        if tokenizer is not None:
+            # reuse what an Opf_Tokenizer already parsed, on copies of the
+            # tag attributes as converting changes them in place
+            self.tokens = [(text, tag if tag is None else (tag[0], tag[1], dict(tag[2])))
+                           for text, tag in tokenizer.tokenize().tokens]
+        # the UTC time stamped as dcterms:modified, the current time if None
+        self.modified = modified
         self.sprops = spine_properties.copy()
         self.mprops = manifest_properties.copy()
         self.moprops = mo_properties.copy()
-        self.opos = 0
+        # map each text manifest id to the first media overlay using it
+        self.text_to_mo = {}
+        for mo_id in self.moprops:
+            for text_id in self.moprops[mo_id]["text_ids"]:
+                self.text_to_mo.setdefault(text_id, mo_id)
         self.lang = "en"
         self.uniqueid = None
         self.uid = ""
@@ -70,6 +309,12 @@ class Opf_Converter(object):
         self.ppd = None
         self.nid = None
         self.guide = []
+        # what was written to the opf3, for the pre-validator
+        # manifest holds (id, href, media-type, properties, media-overlay)
+        self.manifest = []
+        self.spine = []
+        self.modified_cnt = 0
+        self.nav_itemref = None
         self.res = []
         self.has_html_toc = False
         self._convertOpf()
@@ -81,38 +326,6 @@ class Opf_Converter(object):
             newid = "x" + newid
         return newid
 
-    # OPF tag iterator
-    def _opf_tag_iter(self):
-        tcontent = last_tattr = None
-        prefix = []
-        while True:
-            text, tag = self._parseopf()
-            if text is None and tag is None:
-                break
-            if text is not None:
-                tcontent = text.rstrip(" \r\n")
-            else: # we have a tag
-                ttype, tname, tattr = self._parsetag(tag)
-                if ttype == "begin":
-                    tcontent = None
-                    prefix.append(tname)
-                    if tname in _OPF_PARENT_TAGS:
-                        yield ".".join(prefix), tname, tattr, tcontent
-                    else:
-                        last_tattr = tattr
-                else: # single or end
-                    if ttype == "end":
-                        prefix.pop()
-                        tattr = last_tattr
-                        if tattr is None:
-                            tattr = {}
-                        last_tattr = None
-                    elif ttype == 'single':
-                        tcontent = None
-                    if ttype == 'single' or (ttype == 'end' and tname not in _OPF_PARENT_TAGS):
-                        yield ".".join(prefix), tname, tattr, tcontent
-                    tcontent = None
-
     # now convert the OPF from 2.0 to 3.0 
     def _convertOpf(self):
         res = []
@@ -173,6 +386,9 @@ class Opf_Converter(object):
 
                 updated_tags = self.map_meta(tname, tattr, None)
                 for updated_tag in updated_tags: 
+                    mattr = updated_tag[1]
+                    if mattr.get("property", "") == "dcterms:modified" and "refines" not in mattr:
+                        self.modified_cnt += 1
                     res.append(taginfo_toxml(updated_tag))
                 continue
 
@@ -183,11 +399,7 @@ class Opf_Converter(object):
                     idval = tattr.get("id","")
                     if idval != "":
                         if self.uniqueid and idval == self.uniqueid:
-                            self.uid = tcontent
-                            if "opf:scheme" in tattr:
-                                scheme = tattr["opf:scheme"].lower()
-                                if not self.uid.startswith("urn:"):
-                                    self.uid = "urn:" + scheme + ":" + tcontent
+                            self.uid = _uid_from_identifier(tattr, tcontent)
                 updated_tags = self.map_dc(tname, tattr, tcontent)
                 for updated_tag in updated_tags:
                     res.append(taginfo_toxml(updated_tag))
@@ -203,7 +415,9 @@ class Opf_Converter(object):
                         res.append(taginfo_toxml(["meta",{"refines":"#"+series_id, "property":"group-position"}, self.series_index]))
 
                 # append the required dcterms modified information
-                res.append(taginfo_toxml(["meta", {"property":"dcterms:modified"}, datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")])) 
+                modified = self.modified if self.modified is not None else datetime.utcnow()
+                res.append(taginfo_toxml(["meta", {"property":"dcterms:modified"}, modified.strftime("%Y-%m-%dT%H:%M:%SZ")]))
+                self.modified_cnt += 1
 
                 # if there are Media Overlays properties, append the required media:* meta
                 if len(self.moprops) > 0:
@@ -257,6 +471,7 @@ class Opf_Converter(object):
                 mo_id = self.mid_to_mo_id(id)
                 if mo_id is not None:
                     tattr["media-overlay"] = mo_id
+                self.manifest.append((id, tattr.get("href", ""), mtype, tattr.get("properties", ""), mo_id))
                 res.append(taginfo_toxml((tname, tattr, None)))
                 continue
 
@@ -264,6 +479,7 @@ class Opf_Converter(object):
                 # add in as yet to be created nav document right beside the current opf
                 self.nid = self.valid_id("navid")
                 res.append('<item id="%s" media-type="application/xhtml+xml" href="nav.xhtml" properties="nav" />\n' % self.nid)
+                self.manifest.append((self.nid, "nav.xhtml", "application/xhtml+xml", "nav", None))
                 self.all_ids.append(self.nid)
                 # close off manifest
                 res.append("</manifest>\n")
@@ -298,13 +514,17 @@ class Opf_Converter(object):
                         props = self.sprops[idref]
                 if props != "":
                     tattr["properties"] = props
+                self.spine.append(idref)
                 res.append(taginfo_toxml((tname, tattr, None)))
                 continue
 
             if end_spine and not "spine" in prefix:
                 # add in nav document at the end of the spine
-                # linear will default to "yes"
-                res.append('<itemref idref="%s"NAVLINEARATTRIBUTE/>\n' % self.nid)
+                # whether it is linear depends on the guide still to come
+                # so leave a slot for write_opf3() to fill in
+                self.nav_itemref = len(res)
+                res.append(None)
+                self.spine.append(self.nid)
                 # close off spine
                 res.append("</spine>\n")
                 end_spine = False
@@ -358,88 +578,6 @@ class Opf_Converter(object):
         self.res = res
 
         
-    # parse and return either leading text or the next tag
-    def _parseopf(self):
-        p = self.opos
-        if p >= len(self.opf):
-            return None, None
-        if self.opf[p] != '<':
-            res = self.opf.find('<',p)
-            if res == -1 :
-                res = len(self.opf)
-            self.opos = res
-            return self.opf[p:res], None
-        # handle comment as a special case
-        if self.opf[p:p+4] == '<!--':
-            te = self.opf.find('-->',p+1)
-            if te != -1:
-                te = te+2
-        else:
-            te = self.opf.find('>',p+1)
-            ntb = self.opf.find('<',p+1)
-            if ntb != -1 and ntb < te:
-                self.opos = ntb
-                return self.opf[p:ntb], None
-        self.opos = te + 1
-        return None, self.opf[p:te+1]
-
-
-    # parses tag to identify:  [tname, ttype, tattr]
-    #    tname: tag name,    ttype: tag type ('begin', 'end' or 'single');
-    #    tattr: dictionary of tag atributes
-    def _parsetag(self, s):
-        n = len(s)
-        p = 1
-        tname = None
-        ttype = None
-        tattr = {}
-        while p < n and s[p:p+1] == ' ' : p += 1
-        if s[p:p+1] == '/':
-            ttype = 'end'
-            p += 1
-            while p < n and s[p:p+1] == ' ' : p += 1
-        b = p
-        while p < n and s[p:p+1] not in ('>', '/', ' ', '"', "'","\r","\n") : p += 1
-        tname=s[b:p].lower()
-        # remove redundant opf prefixes
-        if tname.startswith("opf:"):
-            tname = tname[4:]
-        # some special cases
-        if tname == "?xml":
-            tname = "?xml"
-        if tname == "!--":
-            ttype = 'single'
-            comment = s[p:-3].strip()
-            tattr['comment'] = comment
-        if ttype is None:
-            # parse any attributes of begin or single tags
-            while s.find('=',p) != -1 :
-                while p < n and s[p:p+1] == ' ' : p += 1
-                b = p
-                while p < n and s[p:p+1] != '=' : p += 1
-                aname = s[b:p].lower()
-                aname = aname.rstrip(' ')
-                p += 1
-                while p < n and s[p:p+1] == ' ' : p += 1
-                if s[p:p+1] in ('"', "'") :
-                    qt = s[p:p+1]
-                    p = p + 1
-                    b = p
-                    while p < n and s[p:p+1] != qt: p += 1
-                    val = s[b:p]
-                    p += 1
-                else :
-                    b = p
-                    while p < n and s[p:p+1] not in ('>', '/', ' ') : p += 1
-                    val = s[b:p]
-                tattr[aname] = val
-        if ttype is None:
-            ttype = 'begin'
-            if s.find('/',p) >= 0:
-                ttype = 'single'
-        return ttype, tname, tattr
-
-
     # map some fixed layout tags 
     # otherwise pass old meta data through as is
     def map_meta(self, tname, tattr, tcontent):
@@ -604,21 +742,41 @@ class Opf_Converter(object):
         :type  mid: str
         :rtype: str or None
         """
-        for mo_id in self.moprops:
-            if mid in self.moprops[mo_id]["text_ids"]:
-                return mo_id
-        return None
+        return self.text_to_mo.get(mid, None)
 
     def get_guide(self):
         return self.guide
 
-    def get_opf3(self):
-        opfdata = "".join(self.res)
+    def get_manifest(self):
+        return self.manifest
+
+    def get_spine(self):
+        return self.spine
+
+    def get_modified_count(self):
+        return self.modified_cnt
+
+    def get_cover_id(self):
+        return self.cover_id
+
+    def write_opf3(self, out):
+        """
+        Write the converted opf fragment by fragment to out,
+        any object with a write(str) method.
+        """
+        # linear will default to "yes"
+        linear = ""
         if self.has_html_toc:
-            opfdata = opfdata.replace('NAVLINEARATTRIBUTE', ' linear="no"')
-        else:
-            opfdata = opfdata.replace('NAVLINEARATTRIBUTE', '')
-        return opfdata
+            linear = ' linear="no"'
+        for i, fragment in enumerate(self.res):
+            if i == self.nav_itemref:
+                fragment = '<itemref idref="%s"%s/>\n' % (self.nid, linear)
+            out.write(fragment)
+
+    def get_opf3(self):
+        out = io.StringIO()
+        self.write_opf3(out)
+        return out.getvalue()
 
     def get_lang(self):
         return self.lang
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Run the stages of a conversion as a graph instead of a fixed sequence.
+# Each stage names the stages whose results it needs, and starts in its
+# own thread as soon as they have all finished, so stages that do not
+# depend on each other (parsing the ncx while the xhtml is converted)
+# overlap.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import threading
+
+
+class StageCancelled(Exception):
+    # raised by a stage that has already reported why the conversion stops
+    pass
+
+
+class _Stage(object):
+
+    def __init__(self, name, func, deps, exclusive):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.exclusive = exclusive
+
+
+class Pipeline(object):
+
+    def __init__(self):
+        self.stages = []
+        self.names = set()
+
+    def add(self, name, func, deps=(), exclusive=False):
+        """
+        Add a stage.  func is called with the results of deps, in the
+        given order, as its arguments and its return value is the
+        stage's result.  A stage can only depend on stages already
+        added, so the stages always form an acyclic graph and the order
+        they were added in is a valid order to run them one by one.
+
+        :param name: the stage's name
+        :type  name: str
+        :param func: the work of the stage
+        :type  func: callable
+        :param deps: names of the stages whose results func needs
+        :type  deps: tuple of str
+        :param exclusive: if True the stage runs alone, nothing else
+                          is started until it has finished
+        :type  exclusive: bool
+        """
+        for dep in deps:
+            if dep not in self.names:
+                raise ValueError("stage %s depends on unknown stage %s" % (name, dep))
+        if name in self.names:
+            raise ValueError("stage %s added twice" % name)
+        self.stages.append(_Stage(name, func, tuple(deps), exclusive))
+        self.names.add(name)
+
+    def run(self, concurrent=True):
+        """
+        Run every stage once its dependencies are done and return a dict
+        of stage name to result.  If a stage raises, no further stages
+        are started, the ones running are waited for and the first
+        exception raised is raised again here.
+        With concurrent False the stages run one after another in this
+        thread in the order they were added.
+
+        :rtype: dict
+        """
+        results = {}
+        if not concurrent:
+            for stage in self.stages:
+                results[stage.name] = stage.func(*[results[d] for d in stage.deps])
+            return results
+
+        cond = threading.Condition()
+        pending = list(self.stages)
+        running = set()
+        errors = []
+
+        def work(stage, args):
+            try:
+                result = stage.func(*args)
+            except BaseException as e:
+                with cond:
+                    errors.append(e)
+                    running.discard(stage.name)
+                    cond.notify_all()
+                return
+            with cond:
+                results[stage.name] = result
+                running.discard(stage.name)
+                cond.notify_all()
+
+        threads = []
+        with cond:
+            while True:
+                if not errors:
+                    exclusive_running = any(s.exclusive for s in self.stages if s.name in running)
+                    for stage in list(pending):
+                        if exclusive_running:
+                            break
+                        if not all(d in results for d in stage.deps):
+                            continue
+                        if stage.exclusive and running:
+                            # wait for what is running to finish, and start
+                            # nothing added after it in the meantime
+                            break
+                        pending.remove(stage)
+                        running.add(stage.name)
+                        t = threading.Thread(target=work, args=(stage, [results[d] for d in stage.deps]))
+                        t.daemon = True
+                        t.start()
+                        threads.append(t)
+                        exclusive_running = stage.exclusive
+                if not running and (errors or not pending):
+                    break
+                if not running:
+                    # only possible if a stage waits on one that never ran
+                    raise RuntimeError("pipeline stages %s cannot run" % ", ".join(s.name for s in pending))
+                cond.wait()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return results
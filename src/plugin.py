@@ -12,17 +12,34 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 
 import sys
 import os
-import tempfile, shutil
+import shutil
 import re
+import io
+import mmap
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
 try:
     from urllib.parse import unquote
 except ImportError:
     from urllib import unquote
 
-from opf_converter import Opf_Converter
-from html_namedentities import named_entities
-from epub_utils import epub_zip_up_book_contents
+from xml.sax.saxutils import escape, unescape
+
+from opf_converter import Opf_Converter, Opf_Tokenizer
+from watchdog import Watchdog, ConversionTimeout
+from scheduler import estimate_file_cost, plan_tasks, parallel_available, run_tasks
+from html_namedentities import write_named_entities
+from mp3_duration import mp3_duration
+from smil_clock import parse_clock_value, seconds_to_ns, ns_to_seconds
+from prevalidate import prevalidate_package, check_container
+from xhtml_bytes import convert_xhtml_bytes
+from background_writer import BackgroundWriter
+from pipeline import Pipeline, StageCancelled
+from staging import Stager, book_source_root, tree_size, make_staging_dir
+from epub_zip import write_epub, COMPRESSION_POLICY
+from checksums import HashingFile, staged_checksums, write_sidecar
 
 PY2 = sys.version_info[0] == 2
 
@@ -97,24 +114,78 @@ _ncx_tagname_map = {
 
 _USER_HOME = os.path.expanduser("~")
 
-IS_NAMED_ENTITY = re.compile("(&\w+;)")
+# media types of the files the conversion writes anew
+_REWRITTEN_TYPES = ("application/xhtml+xml", "application/x-dtbncx+xml", "application/smil+xml")
 
 NAMESPACE_MAP = {
     "smil": "http://www.w3.org/ns/SMIL",
     "epub": "http://www.idpf.org/2007/ops"
 }
 
-# remap any html named enities to numeric entities
-def convert_named_entities(text): 
-    pieces = IS_NAMED_ENTITY.split(text)
-    for i in range(1, len(pieces),2):
-        piece = pieces[i]
-        sval = named_entities.get(piece[1:],"")
-        if sval != "":
-            val = ord(sval)
-            piece = "&#%d;" % val
-            pieces[i] =piece
-    return "".join(pieces)
+def staged_path(bookhref, temp_dir, unquote_filename=False):
+    filepath = bookhref
+    if unquote_filename:
+        filepath = unquote(filepath)
+    filepath = filepath.replace("/", os.sep)
+    return os.path.join(temp_dir, filepath)
+
+
+def read_staged_file(fpath):
+    """
+    Read and decode a utf-8 file, memory mapping it so
+    the decoded str is the only copy of its contents made.
+
+    :param fpath: the path of the file
+    :type  fpath: str
+    :rtype: str
+    """
+    with open(fpath, "rb") as file_obj:
+        if os.fstat(file_obj.fileno()).st_size == 0:
+            return ""
+        mm = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return str(mm, "utf-8")
+        finally:
+            mm.close()
+
+
+# bytes buffered by staged_output() before they are hashed and written
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+@contextmanager
+def staged_output(fpath, binary=False):
+    """
+    Open fpath for writing as a utf-8 text stream, encoding as it goes
+    so the document never exists as a single str or bytes in memory.
+    The output goes to a temporary file that replaces fpath when the
+    block completes, if the block raises, fpath is left untouched.
+    As fpath is replaced and never written in place, a staged file
+    that is a link to Sigil's copy of the book leaves that copy alone.
+    The CRC32 (and SHA-256 if enabled) of the bytes written are
+    recorded in staged_checksums, so the file need not be read again
+    to checksum it.
+
+    :param fpath: the path of the file
+    :type  fpath: str
+    :param binary: if True, open a binary stream taking utf-8 bytes instead
+    :type  binary: bool
+    """
+    tmp_path = fpath + ".tmp"
+    hasher = staged_checksums.new_hasher()
+    out = io.BufferedWriter(HashingFile(tmp_path, hasher), OUTPUT_BUFFER_SIZE)
+    if not binary:
+        out = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    try:
+        yield out
+    except BaseException:
+        out.close()
+        os.remove(tmp_path)
+        raise
+    out.close()
+    if os.path.exists(fpath):
+        os.remove(fpath)
+    os.rename(tmp_path, fpath)
+    staged_checksums.record(fpath, hasher)
 
 
 def write_file(data, bookhref, temp_dir, unquote_filename=False):
@@ -132,15 +203,31 @@ def write_file(data, bookhref, temp_dir, unquote_filename=False):
     :param unquote_filename: if True, pass href through unquote()
     :type  unquote_filename: bool
     """
-    filepath = bookhref
-    if unquote_filename:
-        filepath = unquote(filepath)
-    filepath = filepath.replace("/", os.sep)
-    fpath = os.path.join(temp_dir, filepath)
-    with open(fpath, "wb") as file_obj:
+    fpath = staged_path(bookhref, temp_dir, unquote_filename)
+    with staged_output(fpath, binary=True) as file_obj:
         file_obj.write(data.encode("utf-8"))
 
 
+def build_timestamp(supplied=None, source_path=""):
+    """
+    Return the time to stamp a reproducible build with, in seconds since
+    the epoch: the supplied value, else the SOURCE_DATE_EPOCH environment
+    variable, else the modification time of the source epub at source_path.
+
+    :returns: the time, or None if none of them is available
+    :rtype: int or None
+    """
+    for value in (supplied, os.environ.get("SOURCE_DATE_EPOCH", None)):
+        if value is not None and value != "":
+            try:
+                return int(value)
+            except ValueError:
+                print("..warning: ignoring source date epoch %r, it is not a whole number of seconds" % (value,))
+    if source_path and os.path.isfile(source_path):
+        return int(os.path.getmtime(source_path))
+    return None
+
+
 # the plugin entry point
 def run(bk):
 
@@ -154,8 +241,51 @@ def run(bk):
 
     prefs = bk.getPrefs()
     prefs.defaults['lastdir'] = _USER_HOME
+    # time budgets in seconds, 0 means no limit
+    prefs.defaults['doc_timeout'] = 0
+    prefs.defaults['book_timeout'] = 0
+    # what to do with an xhtml file that overruns: 'skip' or 'fail'
+    prefs.defaults['on_timeout'] = 'skip'
+    # number of worker processes converting xhtml, 0 or 1 converts in this process
+    prefs.defaults['workers'] = 0
+    # convert xhtml as utf-8 bytes without Sigil's parser, untouched tags are kept as written
+    prefs.defaults['bytes_engine'] = False
+    # threads writing converted xhtml to temp_dir while the next file is converted, 0 writes inline
+    prefs.defaults['writer_threads'] = 2
+    # most bytes of converted xhtml waiting to be written before conversion waits
+    prefs.defaults['writer_queue_size'] = 16 * 1024 * 1024
+    # SMIL files at least this many bytes long are patched as a stream
+    prefs.defaults['smil_stream_size'] = 4 * 1024 * 1024
+    # what to do with toc, page-list and landmark links to missing ids: 'warn' or 'drop'
+    prefs.defaults['on_dangling_link'] = 'warn'
+    # run independent stages (ncx, opf parsing, xhtml) at the same time
+    prefs.defaults['concurrent_stages'] = True
+    # stage unmodified resources as reflinks or hard links to Sigil's copy of the book
+    prefs.defaults['link_resources'] = True
+    # where to stage the book: 'memory', 'tmpfs' (in staging_dir) or 'disk'
+    prefs.defaults['staging'] = 'memory'
+    prefs.defaults['staging_dir'] = ''
+    # books bigger than this many bytes are staged on disk whatever staging says
+    prefs.defaults['staging_budget'] = 64 * 1024 * 1024
+    # threads deflating the members of the epub, 0 uses one per cpu
+    prefs.defaults['zip_threads'] = 0
+    # media type -> deflate level overriding COMPRESSION_POLICY, 0 stores the media type
+    prefs.defaults['compression'] = {}
+    # write the checksums of the epub and its members to <epub>.checksums.json
+    prefs.defaults['checksum_sidecar'] = False
+    # include SHA-256 digests in that manifest, CRC32 is always there
+    prefs.defaults['checksum_sha256'] = True
+    # make the same book always give a byte identical epub: dcterms:modified
+    # and the zip times come from source_date_epoch, else the environment's
+    # SOURCE_DATE_EPOCH, else the time the source epub was last saved
+    prefs.defaults['deterministic'] = False
+    prefs.defaults['source_date_epoch'] = None
+    # order of the epub's members: 'sorted' by book path, or 'reading' which puts
+    # the opf, nav and spine documents first and audio and video last
+    prefs.defaults['zip_layout'] = 'sorted'
     basepath = prefs['lastdir']
     basename = ""
+    filepath = ""
     if bk.launcher_version() >= 20180122:
         filepath = bk.get_epub_filepath()
         if filepath != "":
@@ -166,215 +296,586 @@ def run(bk):
     spine_properties = {}
     mo_properties = {}
     epub_types = {}
+    # manifest id -> set of element ids, to check fragment targets against
+    fragment_ids = {}
+
+    watchdog = Watchdog(prefs['doc_timeout'], prefs['book_timeout'])
+    on_timeout = prefs['on_timeout']
+
+    # files are checksummed as they are written, SHA-256 only when it goes in the sidecar
+    sha256 = bool(prefs['checksum_sidecar'] and prefs['checksum_sha256'])
+    staged_checksums.reset(sha256)
+
+    timestamp = None
+    modified = None
+    if prefs['deterministic']:
+        timestamp = build_timestamp(prefs['source_date_epoch'], filepath)
+        if timestamp is None:
+            print("..warning: no source date epoch or saved source epub, the output will not be reproducible")
+        else:
+            modified = datetime.fromtimestamp(timestamp, timezone.utc)
 
-    temp_dir = tempfile.mkdtemp()
-    
-    # copy all files to a temporary destination folder
-    # to get all fonts, css, images, and etc
-    bk.copy_book_contents_to(temp_dir)
+    # Sigil's exploded copy of the book, to link resources to and to size the staging area
+    source_root = None
+    if bk.launcher_version() >= 20190927:
+        source_root = book_source_root(bk)
+    needed = None
+    if source_root is not None:
+        needed = tree_size(source_root)
+    temp_dir, staging = make_staging_dir(prefs['staging'], prefs['staging_budget'], needed, prefs['staging_dir'])
+    # whatever happens the staged book is removed, in memory staging would
+    # otherwise hold on to it until the next reboot
+    try:
+        if staging != prefs['staging'] and needed is not None:
+            print("..info: staging the %d byte book on disk instead of %s" % (needed, prefs['staging']))
 
-    # parse all xhtml/html files
-    for mid, href in bk.text_iter():
-        bookhref = "OEBPS/" + href
-        if bk.launcher_version() >= 20190927:
-            bookhref = bk.id_to_bookpath(mid)
-        print("..converting: ", href, " with manifest id: ", mid)
-        data, mprops, sprops, etypes = convert_xhtml(bk, mid, bookhref)
-
-        # store away manifest and spine properties and any links 
-        # to epub:types for later use in opf3
-        if len(sprops) > 0:
-            spine_properties[mid] = " ".join(sprops)
-        if len(mprops) > 0:
-            manifest_properties[mid] = " ".join(mprops)
-        if len(etypes) > 0:
-            epub_types[mid] = etypes
-
-        # write out modified file
-        bookhref = "OEBPS/" + href;
+        # the conversion runs as a graph of stages, each starting as soon as
+        # the stages it needs are done, the opf is tokenized and the ncx parsed
+        # while the xhtml is being converted
+        concurrent = prefs['concurrent_stages']
+        pipeline = Pipeline()
+
+        opfbookhref = "OEBPS/content.opf"
         if bk.launcher_version() >= 20190927:
-            bookhref = bk.id_to_bookpath(mid)
-        write_file(data, bookhref, temp_dir, unquote_filename=True)
-
-    # detect smil files
-
-    # this will be broken in Sigil 1.0 which no longer moves anything
-    # and therefore has no firm locations for anything anymore
-
-    # so we should be updating these inside Sigil itself (I think)
-    # when we do move things.  Not sure really so I will disable this
-    # until I can follow what is exactly being updated and why 
-
-    # for mid, href, mt in bk.manifest_iter():
-    #     if mt == "application/smil+xml":
-    #         bookhref = "OEBPS/" + href
-    #         if bk.launcher_version() >= 20190927:
-    #             bookhref = bk.id_to_bookpath(mid)
-    #         print("..patching: ", bookhref, " with manifest id: ", mid)
-    #         data, text_ids, audio_ids, duration = patch_smil(bk, mid, bookhref)
-    #         # store mo properties to add
-    #         # <meta property="media:duration" ...> elements
-    #         # and media-overlay attributes to opf3
-    #         # text_ids: list of manifest ids of text files referenced by the smil file
-    #         # audio_ids: list of manifest ids of audio files referenced by the smil file
-    #         # duration: float, the duration (in seconds) of the smil file
-    #         mo_properties[mid] = {
-    #             "href": bookhref,
-    #             "text_ids": text_ids,
-    #             "audio_ids": audio_ids,
-    #             "duration": duration
-    #         }
-    #         # write out modified file
-    #         write_file(data, bookhref, temp_dir, unquote_filename=True)
-
-    # now convert the opf
-    opfbookhref = "OEBPS/content.opf"
-    if bk.launcher_version() >= 20190927:
-        opfbookhref = bk.get_opfbookpath()
-
-    print("..converting: ", opfbookhref)
-
-    # first create a list of all ids used in the epub2 opf manifest to help
-    # prevent id clashes when generating new metadta ids for refines in the new opf
-    man_ids = []
-    for (id, href, mime) in bk.manifest_iter():
-        man_ids.append(id)
-
-    # now parse opf2 converting it to opf3 format
-    # while merging in previously collected spine and manifest properties
-    opf2 = bk.readotherfile(opfbookhref)
-
-    opfconv = Opf_Converter(opf2, spine_properties, manifest_properties, mo_properties, man_ids)
-    lang = opfconv.get_lang()
-    uid = opfconv.get_uid()
-    opf3 = opfconv.get_opf3()
-    guide_info = opfconv.get_guide()
-
-    # It is possible that the original EPUB2 <guide> contains references
-    # to files not in the spine;
-    # putting those "dangling" references in the EPUB3 navigation document
-    # will result in validation error:
-    # RSC-011 "Found a reference to a resource that is not a spine item.".
-    # Hence, we must check that the referenced files are listed in the spine.
-    guide_info_in_spine = []
-    spine_hrefs = [t[2] for t in bk.spine_iter()]
-    for gtyp, gtitle, ghref in guide_info:
-        if ghref in spine_hrefs:
-            guide_info_in_spine.append((gtyp, gtitle, ghref))
-        else:
-            print(
-                "..info: the EPUB2 <guide> contains a reference to a resource that is not a spine item: '",
-                ghref,
-                "', not adding it to the guide landmark in nav.xhtml"
+            opfbookhref = bk.get_opfbookpath()
+
+        def stage_copy():
+            # copy all files to a temporary destination folder
+            # to get all fonts, css, images, and etc
+            if source_root is None or not prefs['link_resources']:
+                bk.copy_book_contents_to(temp_dir)
+                return
+            # only the files the conversion rewrites need copies of their own
+            rewritten = set(["mimetype", opfbookhref])
+            for mid, href, mt in bk.manifest_iter():
+                if mt in _REWRITTEN_TYPES:
+                    rewritten.add(bk.id_to_bookpath(mid))
+            stager = Stager()
+            stager.stage_tree(source_root, temp_dir, rewritten)
+            counts = stager.counts
+            print("..info: staged %d files as reflinks, %d as hard links and copied %d" % (
+                counts["reflink"], counts["hardlink"], counts["copy"]))
+
+        # parse all xhtml/html files
+        text_files = []
+        for mid, href in bk.text_iter():
+            bookhref = "OEBPS/" + href
+            if bk.launcher_version() >= 20190927:
+                bookhref = bk.id_to_bookpath(mid)
+            text_files.append((mid, href, bookhref))
+
+        # forking worker processes while other stages run threads is not safe
+        # so the parallel conversion runs on its own
+        use_workers = prefs['workers'] > 1 and parallel_available()
+
+        def stage_xhtml(copied):
+            # worker processes write their own output, only converting
+            # in this process gains from writing in the background
+            writer = None
+            if use_workers:
+                converted = convert_xhtml_parallel(text_files, temp_dir, prefs['workers'], watchdog, prefs['bytes_engine'])
+            else:
+                if prefs['writer_threads'] > 0:
+                    writer = BackgroundWriter(prefs['writer_threads'], prefs['writer_queue_size'])
+                converted = convert_xhtml_serial(bk, text_files, temp_dir, watchdog, prefs['bytes_engine'], writer)
+
+            cancelled = False
+            try:
+                for mid, href, bookhref, result in converted:
+                    print("..converting: ", href, " with manifest id: ", mid)
+                    if isinstance(result, ConversionTimeout):
+                        # the original file is already in temp_dir so skipping
+                        # it passes it through unmodified
+                        watchdog.record(result)
+                        if on_timeout == 'fail':
+                            print("Error: %s, conversion cancelled" % result)
+                            cancelled = True
+                            break
+                        print("..warning: %s, passing it through unmodified" % result)
+                        continue
+                    # the converted file has already been written (or queued to the writer)
+                    mprops, sprops, etypes, ids = result
+
+                    # store away manifest and spine properties and any links 
+                    # to epub:types for later use in opf3
+                    fragment_ids[mid] = ids
+                    if len(sprops) > 0:
+                        spine_properties[mid] = " ".join(sprops)
+                    if len(mprops) > 0:
+                        manifest_properties[mid] = " ".join(mprops)
+                    if len(etypes) > 0:
+                        epub_types[mid] = etypes
+            finally:
+                # every converted file must be on disk before anything reads temp_dir
+                if writer is not None:
+                    for fpath, e in writer.close():
+                        print("Error: could not write %s: %s, conversion cancelled" % (fpath, e))
+                        cancelled = True
+            if cancelled:
+                raise StageCancelled()
+
+        def stage_smil(copied, converted):
+            # detect smil files and patch their text and audio references so that
+            # they resolve in the current layout, collecting what the opf needs
+            # for the media:duration metadata and media-overlay attributes
+            smil_files = []
+            for mid, href, mt in bk.manifest_iter():
+                if mt == "application/smil+xml":
+                    smil_files.append((mid, href))
+
+            if len(smil_files) > 0 and bk.launcher_version() < 20190927:
+                print("..info: patching SMIL files requires Sigil 1.0 or later, leaving them unchanged")
+            elif len(smil_files) > 0:
+                smil_files = [(mid, bk.id_to_bookpath(mid)) for mid, href in smil_files]
+                index = build_manifest_index(bk)
+                for mid, bookhref, patched, dangling in patch_smil_files(bk, smil_files, index, temp_dir,
+                                                                         prefs['smil_stream_size'], fragment_ids,
+                                                                         source_root=source_root):
+                    print("..patching: ", bookhref, " with manifest id: ", mid)
+                    report_dangling_fragments(bookhref, dangling, index)
+                    data, text_ids, audio_ids, duration = patched
+                    # text_ids: list of manifest ids of text files referenced by the smil file
+                    # audio_ids: list of manifest ids of audio files referenced by the smil file
+                    # duration: float, the duration (in seconds) of the smil file
+                    mo_properties[mid] = {
+                        "href": bookhref,
+                        "text_ids": text_ids,
+                        "audio_ids": audio_ids,
+                        "duration": duration
+                    }
+                    # the patched file has already been written to temp_dir
+
+        def stage_opf_tokens():
+            # the opf2 can be parsed before any of the properties merged into
+            # it are known, it runs alongside the xhtml so has its own watchdog
+            tokens_watchdog = Watchdog(*watchdog.get_limits())
+            tokens_watchdog.start_document(opfbookhref)
+            tokenizer = Opf_Tokenizer(bk.readotherfile(opfbookhref), tokens_watchdog).tokenize()
+            tokenizer.watchdog = None
+            # the ncx needs the uid while the opf may already be converting
+            return tokenizer, tokenizer.get_uid()
+
+        def stage_opf(opf_tokens, converted, patched):
+            tokenizer = opf_tokens[0]
+            # now convert the opf
+            print("..converting: ", opfbookhref)
+
+            # first create a list of all ids used in the epub2 opf manifest to help
+            # prevent id clashes when generating new metadta ids for refines in the new opf
+            man_ids = []
+            for (id, href, mime) in bk.manifest_iter():
+                man_ids.append(id)
+
+            # now convert opf2 to opf3 format
+            # while merging in previously collected spine and manifest properties
+            # without a converted opf and ncx there is no epub3 so overrunning
+            # either of them always cancels the conversion
+            watchdog.start_document(opfbookhref)
+            opfconv = Opf_Converter(None, spine_properties, manifest_properties, mo_properties, man_ids, watchdog, tokenizer,
+                                    modified)
+            watchdog.end_document()
+            guide_info = opfconv.get_guide()
+
+            # It is possible that the original EPUB2 <guide> contains references
+            # to files not in the spine;
+            # putting those "dangling" references in the EPUB3 navigation document
+            # will result in validation error:
+            # RSC-011 "Found a reference to a resource that is not a spine item.".
+            # Hence, we must check that the referenced files are listed in the spine.
+            guide_info_in_spine = []
+            spine_hrefs = [t[2] for t in bk.spine_iter()]
+            for gtyp, gtitle, ghref in guide_info:
+                if ghref in spine_hrefs:
+                    guide_info_in_spine.append((gtyp, gtitle, ghref))
+                else:
+                    print(
+                        "..info: the EPUB2 <guide> contains a reference to a resource that is not a spine item: '",
+                        ghref,
+                        "', not adding it to the guide landmark in nav.xhtml"
+                    )
+
+            # now convert all guide hrefs from opf relative to book hrefs
+            new_guide_info = []
+            for gtyp, gtitle, ghref in guide_info_in_spine:
+                gbookhref = "OEBPS/" + href
+                if bk.launcher_version() >= 20190927:
+                    ahref, asep, afrag = ghref.partition('#')
+                    opf_base = bk.get_startingdir(opfbookhref)
+                    gbookhref = bk.build_bookpath(ahref, opf_base) + asep + afrag
+                new_guide_info.append((gtyp, gtitle, gbookhref))
+            guide_info_in_spine = new_guide_info
+
+            with staged_output(staged_path(opfbookhref, temp_dir)) as out:
+                opfconv.write_opf3(out)
+            return opfconv, guide_info_in_spine
+
+        def stage_ncx(copied, opf_tokens):
+            uid = opf_tokens[1]
+            # need to take info from the old opf2 guide, epub_type semantics info
+            # and toc.ncx to create a valid "nav.xhtml"
+            # and update it to remove any doctype
+            ncxbookhref = "OEBPS/toc.ncx"
+            if bk.launcher_version() >= 20190927:
+                ncxid = bk.gettocid()
+                ncxbookhref = bk.id_to_bookpath(ncxid)
+            print("..parsing: ", ncxbookhref)
+            # bk.qp may be busy with the xhtml so use a parser of our own
+            qp = None
+            if concurrent:
+                from quickparser import QuickXHTMLParser
+                qp = QuickXHTMLParser()
+            ncx_watchdog = Watchdog(*watchdog.get_limits())
+            ncx_watchdog.start_document(ncxbookhref)
+            return parse_ncx(bk, ncxbookhref, temp_dir, uid, ncx_watchdog, qp)
+
+        def stage_nav(converted, opf, ncx):
+            opfconv, guide_info_in_spine = opf
+            doctitle, toclist, pagelist = ncx
+            lang = opfconv.get_lang()
+
+            # now build up a nav
+            # place the new nav.xhtml right beside the current opf
+            navbookhref = "OEBPS/nav.xhtml"
+            if bk.launcher_version() >= 20190927:
+                opfbookpath = bk.get_opfbookpath()
+                navbookhref = "nav.xhtml"
+                base = bk.get_startingdir(opfbookpath)
+                navbookhref = bk.build_bookpath("nav.xhtml", base)
+
+            # check every toc, page-list and landmark target against the
+            # element ids collected while converting the xhtml files
+            target_ids = {}
+            for mid, href, bookhref in text_files:
+                if mid in fragment_ids:
+                    target_ids[bookhref] = fragment_ids[mid]
+            drop = prefs['on_dangling_link'] == 'drop'
+            toclist = check_nav_targets("toc", toclist, 2, target_ids, drop)
+            pagelist = check_nav_targets("page-list", pagelist, 1, target_ids, drop)
+            guide_info_in_spine = check_nav_targets("landmarks", guide_info_in_spine, 2, target_ids, drop)
+
+            print("..creating: ", navbookhref)
+            with staged_output(staged_path(navbookhref, temp_dir)) as out:
+                build_nav(bk, navbookhref, doctitle, toclist, pagelist, guide_info_in_spine, epub_types, lang, out)
+
+            return prevalidate_package(opfconv, opfbookhref, toclist, pagelist, guide_info_in_spine, manifest_properties)
+
+        pipeline.add("copy", stage_copy)
+        pipeline.add("opf_tokens", stage_opf_tokens)
+        pipeline.add("xhtml", stage_xhtml, ("copy",), exclusive=use_workers)
+        pipeline.add("smil", stage_smil, ("copy", "xhtml"))
+        pipeline.add("ncx", stage_ncx, ("copy", "opf_tokens"))
+        pipeline.add("opf", stage_opf, ("opf_tokens", "xhtml", "smil"))
+        pipeline.add("nav", stage_nav, ("xhtml", "opf", "ncx"))
+        try:
+            results = pipeline.run(concurrent)
+        except ConversionTimeout as e:
+            print("Error: %s, conversion cancelled" % e)
+            return -1
+        except StageCancelled:
+            return -1
+        doctitle = results["ncx"][0]
+        problems = results["nav"]
+        opfconv = results["opf"][0]
+
+        # the compression of every member is chosen by its manifest media type
+        media_types, id_to_bookhref, navbookhref = map_manifest_bookpaths(bk, opfbookhref, opfconv.get_manifest())
+        policy = dict(COMPRESSION_POLICY)
+        policy.update(prefs['compression'])
+
+        # lead with what a reader needs for the first page, in the converted spine's order
+        first = None
+        if prefs['zip_layout'] == 'reading':
+            first = reading_order_first(opfbookhref, navbookhref, id_to_bookhref, opfconv.get_spine())
+
+        for tmid, scope, elapsed in watchdog.get_timeouts():
+            print("..warning: %s was not converted, it overran its %s time budget after %.2fs" % (tmid, scope, elapsed))
+
+        # finally ready to build epub
+        print("..creating: epub3")
+        data = "application/epub+zip"
+        write_file(data, "mimetype", temp_dir)
+
+        # ask the user where he/she wants to store the new epub
+        if basename == "":
+            if doctitle is None or doctitle == "":
+                doc = "filename"
+            basename = cleanup_file_name(doctitle) + "_epub3.epub"
+        localRoot = tkinter.Tk()
+        localRoot.withdraw()
+ 
+        if sys.platform.startswith('darwin'):
+            # localRoot is is an empty topmost root window that is hidden by withdrawing it
+            # but localRoot needs to be centred, and lifted and focus_force used
+            # so that its child dialog will inherit focus upon launch
+            localRoot.overrideredirect(True)
+            # center on screen but make size 0 to hide the empty localRoot
+            w = localRoot.winfo_screenwidth()
+            h = localRoot.winfo_screenheight()
+            x = int(w/2)
+            y = int(h/2)
+            localRoot.geometry('%dx%d+%d+%d' % (0, 0, x, y))
+            localRoot.deiconify()
+            localRoot.lift()
+            localRoot.focus_force()
+
+        fpath = tkinter_filedialog.asksaveasfilename(
+            parent=localRoot,
+            title="Save ePub3 as ...",
+            initialfile=basename,
+            initialdir=basepath,
+            defaultextension=".epub"
             )
+        # localRoot.destroy()
+        localRoot.quit()
+        if not fpath:
+            print("ePub3-itizer plugin cancelled by user")
+            return 0
+
+        summary = write_epub(temp_dir, fpath, prefs['zip_threads'], media_types, policy,
+                             staged_checksums, sha256, timestamp, first)
+        if prefs['checksum_sidecar']:
+            if summary is None:
+                print("..warning: no checksum manifest, the epub was written as zip64")
+            else:
+                print("..info: checksums written to %s" % write_sidecar(fpath, summary))
+
+        # only books that fail these quick checks need a full epubcheck
+        problems.extend(check_container(fpath))
+        for problem in problems:
+            print("..warning: pre-validation: %s" % problem)
+        if problems:
+            print("..info: pre-validation found %d problems, please run epubcheck on this book" % len(problems))
+        else:
+            print("..info: pre-validation found no problems")
+
+        prefs['lastdir'] = os.path.dirname(fpath)
+        bk.savePrefs(prefs)
+
+        print("Output Conversion Complete")
+        # Setting the proper Return value is important.
+        # 0 - means success
+        # anything else means failure
+        return 0
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        staged_checksums.reset()
+ 
+
+def map_manifest_bookpaths(bk, opfbookhref, manifest):
+    """
+    Map the converted opf's manifest onto the book paths the
+    members are staged and zipped under.
+
+    Return a tuple (media_types, id_to_bookhref, navbookhref) where
+    media_types maps book paths, the opf's included, to media types,
+    id_to_bookhref maps manifest ids to book paths, and navbookhref is
+    the book path of the nav or None.
 
-    # now convert all guide hrefs from opf relative to book hrefs
-    new_guide_info = []
-    for gtyp, gtitle, ghref in guide_info_in_spine:
-        gbookhref = "OEBPS/" + href
+    :param bk: the current book
+    :type  bk: BookContainer
+    :param opfbookhref: the book path of the opf
+    :type  opfbookhref: str
+    :param manifest: the (id, href, media type, properties, media overlay id)
+                     tuples of Opf_Converter.get_manifest()
+    :type  manifest: list
+    :rtype: tuple
+    """
+    media_types = {opfbookhref: "application/oebps-package+xml"}
+    id_to_bookhref = {}
+    navbookhref = None
+    for mid, href, mtype, props, mo_id in manifest:
+        # manifest hrefs are urls, the staged files are named unescaped
+        href = unquote(href)
+        mbookhref = "OEBPS/" + href
         if bk.launcher_version() >= 20190927:
-            ahref, asep, afrag = ghref.partition('#')
-            opf_base = bk.get_startingdir(opfbookhref)
-            gbookhref = bk.build_bookpath(ahref, opf_base) + asep + afrag
-        new_guide_info.append((gtyp, gtitle, gbookhref))
-    guide_info_in_spine = new_guide_info
+            mbookhref = bk.build_bookpath(href, bk.get_startingdir(opfbookhref))
+        media_types[mbookhref] = mtype
+        id_to_bookhref[mid] = mbookhref
+        if "nav" in props.split():
+            navbookhref = mbookhref
+    return media_types, id_to_bookhref, navbookhref
 
-    write_file(opf3, opfbookhref, temp_dir)
 
+def reading_order_first(opfbookhref, navbookhref, id_to_bookhref, spine):
+    """
+    Return the book paths the reading order zip layout leads with:
+    the opf, the nav if any, then the spine items in order.
+
+    :param opfbookhref: the book path of the opf
+    :type  opfbookhref: str
+    :param navbookhref: the book path of the nav or None
+    :type  navbookhref: str or None
+    :param id_to_bookhref: manifest id to book path, see map_manifest_bookpaths()
+    :type  id_to_bookhref: dict
+    :param spine: the idrefs of the converted spine
+    :type  spine: list of str
+    :rtype: list of str
+    """
+    first = [opfbookhref]
+    if navbookhref is not None:
+        first.append(navbookhref)
+    first.extend(id_to_bookhref[idref] for idref in spine if idref in id_to_bookhref)
+    return first
 
-    # need to take info from the old opf2 guide, epub_type semantics info
-    # and toc.ncx to create a valid "nav.xhtml"
-    # and update it to remove any doctype
-    ncxbookhref = "OEBPS/toc.ncx"
-    if bk.launcher_version() >= 20190927:
-        ncxid = bk.gettocid()
-        ncxbookhref = bk.id_to_bookpath(ncxid)
-    print("..parsing: ", ncxbookhref)
-    doctitle, toclist, pagelist = parse_ncx(bk, ncxbookhref, temp_dir, uid)
-
-    # now build up a nav
-    # place the new nav.xhtml right beside the current opf
-    navbookhref = "OEBPS/nav.xhtml"
-    if bk.launcher_version() >= 20190927:
-        opfbookpath = bk.get_opfbookpath()
-        navbookhref = "nav.xhtml"
-        base = bk.get_startingdir(opfbookpath)
-        navbookhref = bk.build_bookpath("nav.xhtml", base)
-
-    print("..creating: ", navbookhref)
-    navdata = build_nav(bk, navbookhref, doctitle, toclist, pagelist, guide_info_in_spine, epub_types, lang)
-    write_file(navdata, navbookhref, temp_dir)
-
-    # finally ready to build epub
-    print("..creating: epub3")
-    data = "application/epub+zip"
-    write_file(data, "mimetype", temp_dir)
-
-    # ask the user where he/she wants to store the new epub
-    if basename == "":
-        if doctitle is None or doctitle == "":
-            doc = "filename"
-        basename = cleanup_file_name(doctitle) + "_epub3.epub"
-    localRoot = tkinter.Tk()
-    localRoot.withdraw()
- 
-    if sys.platform.startswith('darwin'):
-        # localRoot is is an empty topmost root window that is hidden by withdrawing it
-        # but localRoot needs to be centred, and lifted and focus_force used
-        # so that its child dialog will inherit focus upon launch
-        localRoot.overrideredirect(True)
-        # center on screen but make size 0 to hide the empty localRoot
-        w = localRoot.winfo_screenwidth()
-        h = localRoot.winfo_screenheight()
-        x = int(w/2)
-        y = int(h/2)
-        localRoot.geometry('%dx%d+%d+%d' % (0, 0, x, y))
-        localRoot.deiconify()
-        localRoot.lift()
-        localRoot.focus_force()
-
-    fpath = tkinter_filedialog.asksaveasfilename(
-        parent=localRoot,
-        title="Save ePub3 as ...",
-        initialfile=basename,
-        initialdir=basepath,
-        defaultextension=".epub"
-        )
-    # localRoot.destroy()
-    localRoot.quit()
-    if not fpath:
-        shutil.rmtree(temp_dir)
-        print("ePub3-itizer plugin cancelled by user")
-        return 0
 
-    epub_zip_up_book_contents(temp_dir, fpath)
-    shutil.rmtree(temp_dir)
+def build_manifest_index(bk):
+    """
+    Index the manifest once so that references can be resolved
+    without repeated searches of the manifest.
 
-    prefs['lastdir'] = os.path.dirname(fpath)
-    bk.savePrefs(prefs)
+    Return a tuple (id_to_bookpath, bookpath_to_id, basename_to_id, id_to_mime)
+    of dicts, where basename_to_id holds the first manifest id
+    seen with a given file name.
 
-    print("Output Conversion Complete")
-    # Setting the proper Return value is important.
-    # 0 - means success
-    # anything else means failure
-    return 0
- 
+    :param bk: the current book
+    :type  bk: BookContainer
+    :rtype: tuple
+    """
+    id_to_bookpath = {}
+    bookpath_to_id = {}
+    basename_to_id = {}
+    id_to_mime = {}
+    for mid, href, mt in bk.manifest_iter():
+        bookpath = bk.id_to_bookpath(mid)
+        id_to_bookpath[mid] = bookpath
+        bookpath_to_id[bookpath] = mid
+        basename_to_id.setdefault(bookpath.rpartition("/")[2], mid)
+        id_to_mime[mid] = mt
+    return id_to_bookpath, bookpath_to_id, basename_to_id, id_to_mime
+
+
+def patch_smil_files(bk, smil_files, index, temp_dir, stream_size, fragment_ids=None, workers=None,
+                     source_root=None):
+    """
+    Patch the given SMIL files concurrently, yielding
+    (mid, bookhref, result of patch_smil(), dangling) in the given order,
+    where dangling lists the (manifest id, fragment) of <text> targets
+    missing from fragment_ids.
+    lxml releases the GIL while it parses and serializes,
+    so threads are enough to overlap the work.
+    Staged SMIL files of stream_size bytes or more are patched
+    in place by patch_smil_stream() instead.
+
+    :param smil_files: list of (manifest id, bookpath) of SMIL files
+    :type  smil_files: list
+    :param index: the tuple returned by build_manifest_index()
+    :type  index: tuple
+    :param temp_dir: the path to the temporary directory
+    :type  temp_dir: str
+    :param stream_size: size in bytes from which to stream
+    :type  stream_size: int
+    :param fragment_ids: manifest id -> set of element ids of the converted
+                         xhtml files, documents not in it are not checked
+    :type  fragment_ids: dict
+    :param source_root: Sigil's copy of the book, audio is measured there
+                        when it has the file, else in temp_dir
+    :type  source_root: str or None
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def audio_length(amid):
+        # only mp3 can be measured without a decoder
+        if index[3].get(amid, "") != "audio/mpeg":
+            return None
+        # audio is never rewritten so the source copy measures the same
+        # and keeps the same path from one run to the next
+        if source_root is not None:
+            fpath = staged_path(index[0][amid], source_root, unquote_filename=True)
+            if os.path.isfile(fpath):
+                return mp3_duration(fpath)
+        return mp3_duration(staged_path(index[0][amid], temp_dir, unquote_filename=True))
+
+    def patch(smil_file):
+        mid, bookhref = smil_file
+        dangling = []
+        check_fragment = None
+        if fragment_ids is not None:
+            def record_dangling(tmid, frag):
+                ids = fragment_ids.get(tmid, None)
+                if ids is not None and frag and unquote(frag) not in ids:
+                    dangling.append((tmid, frag))
+            check_fragment = record_dangling
+        fpath = staged_path(bookhref, temp_dir, unquote_filename=True)
+        if os.path.getsize(fpath) >= stream_size:
+            patched = patch_smil_stream(bk, mid, bookhref, index, fpath, audio_length, check_fragment)
+        else:
+            patched = patch_smil(bk, mid, bookhref, index, fpath, audio_length, check_fragment)
+        return patched, dangling
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(patch, smil_files)
+        for (mid, bookhref), (patched, dangling) in zip(smil_files, results):
+            yield mid, bookhref, patched, dangling
+
+
+# report no more than this many dangling fragments per SMIL file
+MAX_DANGLING_REPORT = 10
+
+def report_dangling_fragments(bookhref, dangling, index):
+    for tmid, frag in dangling[:MAX_DANGLING_REPORT]:
+        print("..warning: %s: <text> target #%s not found in %s" % (bookhref, frag, index[0][tmid]))
+    if len(dangling) > MAX_DANGLING_REPORT:
+        print("..warning: %s: %d more <text> targets not found" % (bookhref, len(dangling) - MAX_DANGLING_REPORT))
 
-def patch_smil(bk, mid, bookhref):
+
+# compiled XPath objects are not shared between threads
+_smil_xpaths = threading.local()
+
+def smil_xpaths():
+    if not hasattr(_smil_xpaths, "textref"):
+        import lxml.etree as etree
+        _smil_xpaths.textref = etree.XPath("//*[@epub:textref]", namespaces=NAMESPACE_MAP)
+        _smil_xpaths.text = etree.XPath("//smil:text", namespaces=NAMESPACE_MAP)
+        _smil_xpaths.audio = etree.XPath("//smil:audio", namespaces=NAMESPACE_MAP)
+    return _smil_xpaths
+
+
+def resolve_smil_href(bk, bookhref, href, index, cache):
+    """
+    Resolve an href found in the SMIL file at bookhref to a manifest id,
+    first as a path relative to the SMIL file and failing that by its
+    file name alone, as SMIL files often carry paths from another layout.
+
+    Return a tuple (mid, new_href) where new_href is the href relative
+    to the SMIL file, keeping any fragment, or (None, None).
+
+    :param cache: dict for this SMIL file remembering resolved paths
+    :type  cache: dict
+    """
+    ahref, asep, afrag = href.partition("#")
+    if ahref not in cache:
+        id_to_bookpath, bookpath_to_id, basename_to_id, id_to_mime = index
+        tmid = bookpath_to_id.get(bk.build_bookpath(ahref, bk.get_startingdir(bookhref)), None)
+        if tmid is None:
+            tmid = basename_to_id.get(unquote(ahref).rpartition("/")[2], None)
+        if tmid is None:
+            cache[ahref] = (None, None)
+        else:
+            cache[ahref] = (tmid, bk.get_relativepath(bookhref, id_to_bookpath[tmid]))
+    tmid, newhref = cache[ahref]
+    if tmid is None:
+        return None, None
+    return tmid, newhref + asep + afrag
+
+
+def patch_smil(bk, mid, bookhref, index, fpath, audio_length=None, check_fragment=None):
     """
-    Read the given SMIL file, and patches it, setting the suitable
-    src attributes for <audio> and <text> elements,
-    and epub:textref for <smil>, <body>, <seq> and <par> elements.
+    Read the given staged SMIL file, and patches it in place, setting
+    the suitable src attributes for <audio> and <text> elements,
+    and epub:textref for <smil>, <body>, <seq> and <par> elements,
+    so they are relative to the SMIL file.
 
-    Return a tuple (data, text_ids, audio_ids, duration), where
-    data is a str containing the patched SMIL file contents,
+    Return a tuple (None, text_ids, audio_ids, duration), where
     text_ids (resp., audio_ids) is a list of manifest ids
     of referenced text (resp., audio) files;
     and duration is a float representing the total duration
-    of the SMIL file, in seconds.
+    of the SMIL file, in seconds.  The first item is always None
+    as the patched file has already been written.
 
     If the SMIL file cannot be parsed, or an error occurs,
-    return (original_SMIL_file_data, [], [], 0.0)
+    leave the staged file untouched, return (None, [], [], 0.0)
     and print an error message.
 
     :param bk: the current book
@@ -383,135 +884,349 @@ def patch_smil(bk, mid, bookhref):
     :type  mid: str
     :param bookhref: path of the SMIL file
     :type  bookhref: str
+    :param index: the tuple returned by build_manifest_index()
+    :type  index: tuple
+    :param fpath: the path of the staged SMIL file
+    :type  fpath: str
+    :param audio_length: function returning the duration in seconds of
+                         the audio file with the given manifest id, or None
+    :type  audio_length: callable
+    :param check_fragment: function called with the manifest id and fragment
+                           of every <text> target
+    :type  check_fragment: callable
     :rtype: tuple
     """
     text_ids = set()
     audio_ids = set()
-    duration = 0.0
+    # summed in nanoseconds so long overlays add up exactly
+    duration = 0
+    cache = {}
 
-    original_smil_data = bk.readfile(mid)
     try:
-        # remove the XML declaration, if present
-        # otherwise lxml.etree will choke on it
-        original_smil_data = original_smil_data.replace('<?xml version="1.0" encoding="utf-8" ?>', "").strip()
-
-        # parse SMIL file
+        # let lxml.etree read the staged file itself so that the
+        # SMIL file is never held in memory as a Python string and
+        # any XML declaration that may be present is honoured
         # this is a very simplified parsing, as it simply extract <text> and <audio> elements
         # it should cover any reasonable SMIL file, though
         import lxml.etree as etree
-        root = etree.fromstring(original_smil_data)
+        root = etree.parse(fpath).getroot()
+        xpaths = smil_xpaths()
 
         # patch epub:textref attributes, if present
         ns_textref = "{%s}textref" % (NAMESPACE_MAP["epub"])
-        for elem in ["smil", "body", "seq", "par"]:
-            els = root.xpath("//smil:%s" % (elem), namespaces=NAMESPACE_MAP)
-            for el in els:
-                textref = el.get(ns_textref)
-                if textref is not None:
-                    textref = os.path.basename(textref)
-                    el.set(ns_textref, "../Text/%s" % (textref))
+        for el in xpaths.textref(root):
+            tmid, textref = resolve_smil_href(bk, bookhref, el.get(ns_textref), index, cache)
+            if textref is not None:
+                el.set(ns_textref, textref)
 
         # deal with <text> elements
-        text_els = root.xpath("//smil:text", namespaces=NAMESPACE_MAP)
-        for text_el in text_els:
+        for text_el in xpaths.text(root):
             src = text_el.get("src")
             if src is None:
                 print("..error: failure while parsing SMIL file (no src in <text>), the SMIL file will not be patched")
-                return original_smil_data, [], [], 0.0
-            src = os.path.basename(src)
-            frag = ""
-            idx = src.find("#")
-            if idx > -1:
-                frag = src[idx+1:]
-                src = src[:idx]
-            tmid = bk.basename_to_id(src)
+                return None, [], [], 0.0
+            frag = src.partition("#")[2]
+            tmid, src = resolve_smil_href(bk, bookhref, src, index, cache)
             if tmid is None:
                 print("..error: failure while parsing SMIL file (cannot map text src into manifest id), the SMIL file will not be patched")
-                return original_smil_data, [], [], 0.0
+                return None, [], [], 0.0
             text_ids.add(tmid)
-            text_el.set("src", "../Text/%s#%s" % (src, frag))
+            if check_fragment is not None:
+                check_fragment(tmid, frag)
+            text_el.set("src", src)
 
         # deal with <audio> elements
-        audio_els = root.xpath("//smil:audio", namespaces=NAMESPACE_MAP)
-        for audio_el in audio_els:
+        for audio_el in xpaths.audio(root):
             src = audio_el.get("src")
             if src is None:
                 print("..error: failure while parsing SMIL file (no src in <audio>), the SMIL file will not be patched")
-                return original_smil_data, [], [], 0.0
-            src = os.path.basename(src)
-            tmid = bk.basename_to_id(src)
+                return None, [], [], 0.0
+            tmid, src = resolve_smil_href(bk, bookhref, src, index, cache)
             if tmid is None:
                 print("..error: failure while parsing SMIL file (cannot map audio src into manifest id), the SMIL file will not be patched")
-                return original_smil_data, [], [], 0.0
+                return None, [], [], 0.0
             audio_ids.add(tmid)
-            audio_el.set("src", "../Audio/%s" % (src))
-
-            clipBegin = audio_el.get("clipBegin")
-            clipEnd = audio_el.get("clipEnd")
-            if clipBegin is None:
-                # per spec, when omitted, clipBegin should be assumed to be zero
-                # setting as a string, it will converted by clip_time_string_to_float later
-                clipBegin = "0.0"
-            if clipEnd is None:
-                # per spec, when omitted, clipEnd should be assumed
-                # equal to the length of the audio file
-                # since we cannot determine it here,
-                # we set it to zero and print a warning
-                print("..warning: <audio> element without clipEnd attribute, duration might be inaccurate")
-                clipEnd = clipBegin
-            duration += (clip_time_string_to_float(clipEnd) - clip_time_string_to_float(clipBegin))
-
-        # generate a new string
-        # we decode for consistency with the rest of the code
-        new_smil_data = etree.tostring(root, pretty_print=True).decode("utf-8")
+            audio_el.set("src", src)
+
+            duration += clip_duration(audio_el.get("clipBegin"), audio_el.get("clipEnd"), tmid, audio_length)
+
+        # serialize straight to the staged file
+        with staged_output(fpath, binary=True) as out:
+            out.write(etree.tostring(root, pretty_print=True))
     except:
         print("..error: failure while parsing SMIL file (generic), the SMIL file will not be patched")
-        return original_smil_data, [], [], 0.0
+        return None, [], [], 0.0
+
+    return None, list(text_ids), list(audio_ids), ns_to_seconds(duration)
+
+
+class SmilPatchError(Exception):
+    pass
 
-    return new_smil_data, list(text_ids), list(audio_ids), duration 
 
+_SMIL_TAGNAME = re.compile(r'<\s*(?:[\w.-]+:)?([\w.-]+)')
+_SMIL_ATTR = re.compile(r'([\w.:-]+)(\s*=\s*)(["\'])(.*?)\3', re.S)
 
-def clip_time_string_to_float(string):
+SMIL_CHUNK_SIZE = 256 * 1024
+
+def _smil_attr_value(val, qt):
+    if "&" in val or "<" in val or qt in val:
+        return escape(val, {qt: "&quot;" if qt == '"' else "&apos;"})
+    return val
+
+
+_TAG_STOP = re.compile(r'[>"\']')
+
+def _find_tag_end(buf, pos, quote):
+    # find the '>' ending a tag scanning from pos, skipping any quoted
+    # attribute values, quote is the quote still open at pos if any
+    # returns (index of the '>' or -1 if buf ends first, where to resume, open quote)
+    while True:
+        if quote is None:
+            m = _TAG_STOP.search(buf, pos)
+            if m is None:
+                return -1, len(buf), None
+            pos = m.end()
+            if m.group() == '>':
+                return pos - 1, pos, None
+            quote = m.group()
+        else:
+            q = buf.find(quote, pos)
+            if q == -1:
+                return -1, len(buf), quote
+            pos = q + 1
+            quote = None
+
+
+def iter_markup(file_obj, chunk_size=SMIL_CHUNK_SIZE):
+    """
+    Read markup from file_obj in chunks and yield (text, tag) pairs
+    where exactly one of the two is not None, keeping no more than a
+    chunk and the tag being assembled in memory.
+    A '>' inside a quoted attribute value does not end a tag, comments
+    and CDATA sections are yielded whole as a single tag.
+    """
+    buf = ""
+    eof = False
+    resume = 0
+    quote = None
+    while not eof:
+        chunk = file_obj.read(chunk_size)
+        eof = chunk == ""
+        buf += chunk
+        p = 0
+        n = len(buf)
+        while p < n:
+            lt = buf.find('<', p)
+            if lt == -1:
+                yield buf[p:], None
+                p = n
+                break
+            if lt > p:
+                yield buf[p:lt], None
+                p = lt
+            if not eof and n - lt < 9:
+                break
+            if buf.startswith('<!--', lt):
+                te = buf.find('-->', max(lt + 4, resume))
+                if te != -1:
+                    te += 2
+                elif not eof:
+                    resume = n - 2
+            elif buf.startswith('<![CDATA[', lt):
+                te = buf.find(']]>', max(lt + 9, resume))
+                if te != -1:
+                    te += 2
+                elif not eof:
+                    resume = n - 2
+            else:
+                te, resume, quote = _find_tag_end(buf, max(lt + 1, resume), quote)
+            if te == -1:
+                if eof:
+                    te = n - 1
+                else:
+                    # need more data, and no need to search this part again
+                    break
+            yield None, buf[lt:te+1]
+            p = te + 1
+            resume = 0
+            quote = None
+        buf = buf[p:]
+        resume = max(0, resume - p)
+
+
+def patch_smil_stream(bk, mid, bookhref, index, fpath, audio_length=None, check_fragment=None):
+    """
+    Patch the staged SMIL file at fpath in place as a stream, the way
+    patch_smil() does, for overlays too long to hold as a tree.
+    Only the src and epub:textref attribute values are rewritten,
+    everything else passes through as is.
+
+    Return a tuple (None, text_ids, audio_ids, duration) like patch_smil()
+    with None for the data as the file has already been written.
+    On failure the staged file is left untouched and
+    (None, [], [], 0.0) is returned.
+
+    :param fpath: the path of the staged SMIL file
+    :type  fpath: str
+    :rtype: tuple
     """
-    Convert the given clip time string in seconds
-    (possibly with decimal digits).
+    text_ids = set()
+    audio_ids = set()
+    # summed in nanoseconds so long overlays add up exactly
+    duration = 0
+    cache = {}
+    try:
+        with staged_output(fpath) as outf:
+            with io.open(fpath, "r", encoding="utf-8", newline="") as inf:
+                for text, tag in iter_markup(inf):
+                    if text is not None:
+                        outf.write(text)
+                        continue
+                    if tag.startswith("<!") or tag.startswith("<?"):
+                        # comments, CDATA, the doctype and processing instructions
+                        outf.write(tag)
+                        continue
+                    m = _SMIL_TAGNAME.match(tag)
+                    tname = m.group(1) if m is not None else ""
+                    if tname not in ("text", "audio") and "textref" not in tag:
+                        outf.write(tag)
+                        continue
+                    clips = {}
+                    found = []
+
+                    def rewrite(am):
+                        aname, eq, qt, aval = am.groups()
+                        if aname in ("clipBegin", "clipEnd"):
+                            clips[aname] = aval
+                            return am.group(0)
+                        is_src = aname == "src" and tname in ("text", "audio")
+                        if not is_src and not aname.endswith(":textref"):
+                            return am.group(0)
+                        if "&" in aval:
+                            aval = unescape(aval, {"&quot;": '"', "&apos;": "'"})
+                        tmid, href = resolve_smil_href(bk, bookhref, aval, index, cache)
+                        if is_src:
+                            found.append(tmid)
+                            if tmid is None:
+                                raise SmilPatchError("cannot map %s src into manifest id" % tname)
+                            if tname == "text":
+                                text_ids.add(tmid)
+                                if check_fragment is not None:
+                                    check_fragment(tmid, aval.partition("#")[2])
+                            else:
+                                audio_ids.add(tmid)
+                        if href is None:
+                            return am.group(0)
+                        return aname + eq + qt + _smil_attr_value(href, qt) + qt
+
+                    tag = _SMIL_ATTR.sub(rewrite, tag)
+                    if tname in ("text", "audio") and not tag.startswith("</") and not found:
+                        raise SmilPatchError("no src in <%s>" % tname)
+                    if tname == "audio" and not tag.startswith("</"):
+                        duration += clip_duration(clips.get("clipBegin"), clips.get("clipEnd"), found[0], audio_length)
+                    outf.write(tag)
+    except Exception as e:
+        if isinstance(e, SmilPatchError):
+            print("..error: failure while parsing SMIL file (%s), the SMIL file will not be patched" % e)
+        else:
+            print("..error: failure while parsing SMIL file (generic), the SMIL file will not be patched")
+        return None, [], [], 0.0
+
+    return None, list(text_ids), list(audio_ids), ns_to_seconds(duration)
+
 
-    :param string: the clip time string to be converted
-    :type  string: str
-    :returns:      the clip time in seconds
-    :rtype:        float
+def clip_duration(clipBegin, clipEnd, audio_id, audio_length=None):
     """
-    if (string == None) or (len(string) < 1):
+    Return the duration in nanoseconds of an <audio> clip from its
+    clipBegin and clipEnd attribute values (either may be None)
+    and the manifest id of its audio file.
+    """
+    # per spec, when omitted, clipBegin should be assumed to be zero
+    begin = parse_clock_value(clipBegin)
+    if clipEnd is not None:
+        return parse_clock_value(clipEnd) - begin
+    # per spec, when omitted, clipEnd should be assumed
+    # equal to the length of the audio file
+    end = None
+    if audio_length is not None:
+        end = audio_length(audio_id)
+    if end is None:
+        # we cannot determine it so count the clip as empty
+        print("..warning: <audio> element without clipEnd attribute, duration might be inaccurate")
         return 0
-    value = 0
-    if "ms" in string:
-        value = float(string.replace("ms", "")) * 0.001
-    elif "s" in string:
-        value = float(string.replace("s", ""))
-    elif "h" in string:
-        value = float(string.replace("h", "")) * 3600
-    elif "min" in string:
-        value = float(string.replace("min", "")) * 60
-    else:
-        v_h = 0
-        v_m = 0
-        v_s = 0
-        v_d = 0
-        str_hms = string
-        if "." in str_hms:
-            str_hms, str_d = str_hms.split(".")
-            if len(str_d) > 0:
-                v_d = 1.0 * int(str_d) / (10 ** len(str_d))
-        arr_hms = str_hms.split(":")
-        v_n = len(arr_hms)
-        if v_n >= 1:
-            v_s = int(arr_hms[-1])
-        if v_n >= 2:
-            v_m = int(arr_hms[-2])
-        if v_n >= 3:
-            v_h = int(arr_hms[-3])
-        value = v_h * 3600 + v_m * 60 + v_s + v_d
-    return value
+    return seconds_to_ns(end) - begin
+
+
+def convert_xhtml_serial(bk, text_files, temp_dir, watchdog, bytes_engine=False, writer=None):
+    """
+    Convert the given xhtml files one after another in this process,
+    writing each over its staged copy in temp_dir, and yield
+    (mid, href, bookhref, result) in order where result is either
+    the tuple returned by convert_xhtml() or the ConversionTimeout raised.
+    With a BackgroundWriter the files are written by its threads and
+    are only all on disk once it is closed.
+    """
+    output = staged_output
+    if writer is not None:
+        output = writer.staged_output
+    for mid, href, bookhref in text_files:
+        fpath = staged_path(bookhref, temp_dir, unquote_filename=True)
+        try:
+            watchdog.start_document(mid)
+            if bytes_engine:
+                result = convert_xhtml_file(fpath, bookhref, watchdog, output)
+            else:
+                with output(fpath) as out:
+                    result = convert_xhtml(bk, mid, bookhref, out, watchdog)
+        except ConversionTimeout as e:
+            result = e
+        watchdog.end_document()
+        yield mid, href, bookhref, result
+
+
+def convert_xhtml_parallel(text_files, temp_dir, workers, watchdog, bytes_engine=False):
+    """
+    Convert the given xhtml files in a pool of worker processes, largest
+    first, yielding (mid, href, bookhref, result) as they complete.
+
+    Document contents never pass between processes, each worker reads
+    the staged copy of its file in temp_dir and overwrites it with the
+    converted data, so only paths and properties are exchanged.
+    """
+    docs = []
+    for mid, href, bookhref in text_files:
+        fpath = staged_path(bookhref, temp_dir, unquote_filename=True)
+        docs.append((estimate_file_cost(fpath), (mid, href, bookhref, fpath, watchdog.get_limits(), bytes_engine)))
+    return run_tasks(plan_tasks(docs), convert_xhtml_batch, workers)
+
+
+_worker_qp = None
+
+def convert_xhtml_batch(items):
+    # runs in a worker process with its own parser
+    global _worker_qp
+    results = []
+    watchdog = None
+    for mid, href, bookhref, fpath, limits, bytes_engine in items:
+        # one watchdog for the batch so its short documents are checked too
+        if watchdog is None:
+            watchdog = Watchdog(*limits)
+        try:
+            watchdog.start_document(mid)
+            if bytes_engine:
+                result = convert_xhtml_file(fpath, bookhref, watchdog)
+            else:
+                if _worker_qp is None:
+                    from quickparser import QuickXHTMLParser
+                    _worker_qp = QuickXHTMLParser()
+                xhtmldata = read_staged_file(fpath)
+                with staged_output(fpath) as out:
+                    result = convert_xhtml_text(_worker_qp, xhtmldata, bookhref, out, watchdog)
+        except ConversionTimeout as e:
+            result = e
+        results.append((mid, href, bookhref, result))
+    return results
 
 
 # convert xhtml to be epub3 friendly
@@ -523,23 +1238,54 @@ def clip_time_string_to_float(string):
 #  - collect any fixed layout metadata for spine page properties
 #  - collect any epub:type attributes to help extend nav
 #  - collect info on svg, mathml, epub:switch, and script usage for manifest properties
-def convert_xhtml(bk, mid, bookhref):
-    res = []
+#  - collect all element ids so links into the file can be checked
+# the converted xhtml is written to out, any object with a write(str) method
+def convert_xhtml(bk, mid, bookhref, out, watchdog=None):
+    return convert_xhtml_text(bk.qp, bk.readfile(mid), bookhref, out, watchdog)
+
+
+def convert_xhtml_file(fpath, bookhref, watchdog=None, output=staged_output):
+    """
+    Convert the staged xhtml file at fpath in place with the bytes
+    engine, memory mapping the input so that neither the input
+    nor the output is ever decoded or held in memory as a whole.
+
+    :param output: opens the output, staged_output() or a BackgroundWriter's
+    :rtype: tuple
+    :returns: the tuple returned by convert_xhtml_bytes()
+    """
+    with output(fpath, binary=True) as out:
+        with open(fpath, "rb") as file_obj:
+            if os.fstat(file_obj.fileno()).st_size == 0:
+                return convert_xhtml_bytes(b"", bookhref, out, watchdog)
+            mm = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return convert_xhtml_bytes(mm, bookhref, out, watchdog)
+            finally:
+                mm.close()
+
+
+def convert_xhtml_text(qp, xhtmldata, bookhref, out, watchdog=None):
+    write = out.write
     sproperties = []
     mproperties = []
     etypes = []
+    ids = set()
     # maintitle = None
     #parse the xhtml, converting on the fly to update it
-    qp = bk.qp
-    qp.setContent(bk.readfile(mid))
+    qp.setContent(xhtmldata)
     for text, tprefix, tname, ttype, tattr in qp.parse_iter():
+        if watchdog is not None:
+            watchdog.check()
         if text is not None:
             # if "head" in tprefix and tprefix.endswith("title"):
             #     maintitle = text
             # if "pre" not in tprefix:
-            text = convert_named_entities(text)
-            res.append(text)
+            write_named_entities(text, write)
         else:
+            if ttype in ["begin", "single"] and "id" in tattr:
+                ids.add(tattr["id"])
+
             # remap doctype
             if tname == "!DOCTYPE":
                 tattr['special'] = " html"
@@ -597,17 +1343,20 @@ def convert_xhtml(bk, mid, bookhref):
                 title = tattr["title"]
                 etypes.append((bookhref+'#'+id, semantic_type, title))
 
-            res.append(qp.tag_info_to_xml(tname, ttype, tattr))
+            write(qp.tag_info_to_xml(tname, ttype, tattr))
 
-    return "".join(res), mproperties, sproperties, etypes
+    return mproperties, sproperties, etypes, ids
 
 
 # parse the current toc.ncx to extract toc info, and pagelist info
 # note all hrefs returned in toclist and pagelist are converted to be book hrefs
-def parse_ncx(bk, ncxbookhref, temp_dir, uid):
+def parse_ncx(bk, ncxbookhref, temp_dir, uid, watchdog=None, qp=None):
+    # qp defaults to Sigil's own parser, bk.qp
+    if qp is None:
+        qp = bk.qp
     ncx_id = bk.gettocid()
     ncxdata = bk.readfile(ncx_id)
-    bk.qp.setContent(ncxdata)
+    qp.setContent(ncxdata)
     pagelist = []
     toclist = []
     doctitle = None
@@ -615,88 +1364,132 @@ def parse_ncx(bk, ncxbookhref, temp_dir, uid):
     pagenum = None
     skip_if_newline = False
     lvl = 0
-    newncx =[]
-    for txt, tp, tname, ttype, tattr in bk.qp.parse_iter():
-        if txt is not None:
-            if tp.endswith(".doctitle.text"):
-                doctitle = txt
-            if tp.endswith('.navpoint.navlabel.text'):
-                navlabel = txt
-            if skip_if_newline and txt[0:1] == '\n':
-                txt = txt[1:]
-            skip_if_newline = False
-            newncx.append(txt)
-        else:
-            if tname == "meta" and ttype == "single":
-                if tattr.get("name","") == "dtb:uid":
-                    tattr["content"] = uid
-            if tname == "navpoint" and ttype == "begin":
-                lvl += 1
-            elif tname == "navpoint" and ttype == "end":
-                lvl -= 1
-            elif tname == "content" and tattr is not None and "src" in tattr and tp.endswith("navpoint"):
-                href =  tattr["src"]
-                bookhref = "OEBPS/" + href
-                if bk.launcher_version() >= 20190927:
-                    ahref, asep, afrag = href.partition('#')
-                    base = bk.get_startingdir(ncxbookhref)
-                    bookhref = bk.build_bookpath(ahref, base) + asep + afrag
-                toclist.append((lvl, navlabel, bookhref))
-                navlabel = None
-            elif tname == "pagetarget" and ttype == "begin" and tattr is not None:
-                pagenum = tattr.get("value",None)
-            elif tname == "content" and tattr is not None and "src" in tattr and tp.endswith("pagetarget"):
-                pageref = tattr["src"]
-                bookhref = "OEBPS/" + pageref
-                if bk.launcher_version() >= 20190927:
-                    ahref, asep, afrag = pageref.partition('#')
-                    base = bk.get_startingdir(ncxbookhref)
-                    bookhref = bk.build_bookpath(ahref, base) + asep + afrag
-                pagelist.append((pagenum, bookhref))
-                pagenum = None
-
-            # remove the ncx doctype as it is no longer allowed in ncx under epub3
-            if tname != "!DOCTYPE":
-                if tname in _ncx_tagname_map:
-                    tname = _ncx_tagname_map[tname]
-                newncx.append(bk.qp.tag_info_to_xml(tname, ttype, tattr))
+    # write the modified ncx over the staged copy as it is parsed
+    with staged_output(staged_path(ncxbookhref, temp_dir)) as out:
+        write = out.write
+        for txt, tp, tname, ttype, tattr in qp.parse_iter():
+            if watchdog is not None:
+                watchdog.check()
+            if txt is not None:
+                if tp.endswith(".doctitle.text"):
+                    doctitle = txt
+                if tp.endswith('.navpoint.navlabel.text'):
+                    navlabel = txt
+                if skip_if_newline and txt[0:1] == '\n':
+                    txt = txt[1:]
+                skip_if_newline = False
+                write(txt)
             else:
-                skip_if_newline = True
-
-    # overwrite modified ncx file
-    data = "".join(newncx)
-    filepath = ncxbookhref.replace("/", os.sep)
-    fpath = os.path.join(temp_dir, filepath)
-    with open(fpath, "wb") as f:
-        f.write(data.encode('utf-8'))
+                if tname == "meta" and ttype == "single":
+                    if tattr.get("name","") == "dtb:uid":
+                        tattr["content"] = uid
+                if tname == "navpoint" and ttype == "begin":
+                    lvl += 1
+                elif tname == "navpoint" and ttype == "end":
+                    lvl -= 1
+                elif tname == "content" and tattr is not None and "src" in tattr and tp.endswith("navpoint"):
+                    href =  tattr["src"]
+                    bookhref = "OEBPS/" + href
+                    if bk.launcher_version() >= 20190927:
+                        ahref, asep, afrag = href.partition('#')
+                        base = bk.get_startingdir(ncxbookhref)
+                        bookhref = bk.build_bookpath(ahref, base) + asep + afrag
+                    toclist.append((lvl, navlabel, bookhref))
+                    navlabel = None
+                elif tname == "pagetarget" and ttype == "begin" and tattr is not None:
+                    pagenum = tattr.get("value",None)
+                elif tname == "content" and tattr is not None and "src" in tattr and tp.endswith("pagetarget"):
+                    pageref = tattr["src"]
+                    bookhref = "OEBPS/" + pageref
+                    if bk.launcher_version() >= 20190927:
+                        ahref, asep, afrag = pageref.partition('#')
+                        base = bk.get_startingdir(ncxbookhref)
+                        bookhref = bk.build_bookpath(ahref, base) + asep + afrag
+                    pagelist.append((pagenum, bookhref))
+                    pagenum = None
+
+                # remove the ncx doctype as it is no longer allowed in ncx under epub3
+                if tname != "!DOCTYPE":
+                    if tname in _ncx_tagname_map:
+                        tname = _ncx_tagname_map[tname]
+                    write(qp.tag_info_to_xml(tname, ttype, tattr))
+                else:
+                    skip_if_newline = True
+
     return doctitle, toclist, pagelist
 
 
-# build up nave from toclist, pagelist and old opf2 guide info for landmarks
-def build_nav(bk, navbookhref, doctitle, toclist, pagelist, guide_info, epub_types, lang):
-    navres = []
+def is_dangling_target(bookhref, target_ids):
+    """
+    Return True if bookhref has a fragment that is not the id of
+    any element in its target document.  Targets in documents
+    missing from target_ids cannot be checked and are assumed fine.
+
+    :param bookhref: the book href of the link target, with any fragment
+    :type  bookhref: str
+    :param target_ids: book href -> set of element ids
+    :type  target_ids: dict
+    :rtype: bool
+    """
+    ahref, asep, afrag = bookhref.partition('#')
+    if afrag == "":
+        return False
+    ids = target_ids.get(unquote(ahref), None)
+    return ids is not None and unquote(afrag) not in ids
+
+
+def check_nav_targets(kind, entries, pos, target_ids, drop=False):
+    """
+    Report the entries of a toclist, pagelist or guide list whose
+    book href (at index pos of the entry tuple) is a dangling target.
+    If drop is True, dangling page-list and landmarks entries are
+    removed and toc entries are pointed at the start of their file,
+    so the toc keeps its shape.
+
+    :rtype: list
+    """
+    checked = []
+    for entry in entries:
+        bookhref = entry[pos]
+        if is_dangling_target(bookhref, target_ids):
+            if not drop:
+                print("..warning: %s target %s not found" % (kind, bookhref))
+            elif kind == "toc":
+                print("..warning: %s target %s not found, linking to the start of the file" % (kind, bookhref))
+                entry = entry[:pos] + (bookhref.partition('#')[0],) + entry[pos+1:]
+            else:
+                print("..warning: %s target %s not found, dropping it" % (kind, bookhref))
+                continue
+        checked.append(entry)
+    return checked
+
+
+# build up nav from toclist, pagelist and old opf2 guide info for landmarks
+# writing it to out, any object with a write(str) method
+def build_nav(bk, navbookhref, doctitle, toclist, pagelist, guide_info, epub_types, lang, out):
+    write = out.write
     ind = '  '
     ibase = ind*3
     incr = ind*2
-    navres.append('<?xml version="1.0" encoding="utf-8"?>\n')
-    navres.append('<!DOCTYPE html>\n')
-    navres.append('<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops"')
-    navres.append(' lang="%s" xml:lang="%s">\n' % (lang, lang))
-    navres.append(ind + '<head>\n')
-    navres.append(ind*2 + '<meta charset="utf-8" />\n')
-    navres.append(ind*2 + '<title>ePub Nav</title>\n')
-    navres.append(ind*2 + '<style type="text/css">\n')
+    write('<?xml version="1.0" encoding="utf-8"?>\n')
+    write('<!DOCTYPE html>\n')
+    write('<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops"')
+    write(' lang="%s" xml:lang="%s">\n' % (lang, lang))
+    write(ind + '<head>\n')
+    write(ind*2 + '<meta charset="utf-8" />\n')
+    write(ind*2 + '<title>ePub Nav</title>\n')
+    write(ind*2 + '<style type="text/css">\n')
     # redundant with hidden attributes used later
-    # navres.append(ind*2 + 'nav#landmarks, nav#page-list { display:none; }\n')
-    navres.append(ind*2 + 'ol { list-style-type: none; }\n')
-    navres.append(ind*2 + '</style>\n')
-    navres.append(ind + '</head>\n')
-    navres.append(ind + '<body epub:type="frontmatter">\n')
+    # write(ind*2 + 'nav#landmarks, nav#page-list { display:none; }\n')
+    write(ind*2 + 'ol { list-style-type: none; }\n')
+    write(ind*2 + '</style>\n')
+    write(ind + '</head>\n')
+    write(ind + '<body epub:type="frontmatter">\n')
 
     # start with the toc
-    navres.append(ind*2 + '<nav epub:type="toc" id="toc">\n')
-    navres.append(ind*3 + '<h1>Table of Contents</h1>\n')
-    navres.append(ibase + '<ol>\n')
+    write(ind*2 + '<nav epub:type="toc" id="toc">\n')
+    write(ind*3 + '<h1>Table of Contents</h1>\n')
+    write(ibase + '<ol>\n')
     curlvl = 1
     initial = True
     for lvl, lbl, bookhref in toclist:
@@ -708,53 +1501,53 @@ def build_nav(bk, navbookhref, doctitle, toclist, pagelist, guide_info, epub_typ
         if lvl > curlvl:
             while lvl > curlvl:
                 indent = ibase + incr*(curlvl)
-                navres.append(indent + "<ol>\n")
-                navres.append(indent + ind + '<li>\n')
-                navres.append(indent + ind*2 + '<a href="%s">%s</a>\n' % (href, lbl))
+                write(indent + "<ol>\n")
+                write(indent + ind + '<li>\n')
+                write(indent + ind*2 + '<a href="%s">%s</a>\n' % (href, lbl))
                 curlvl += 1
         elif lvl <  curlvl:
             while lvl < curlvl:
                 indent = ibase + incr*(curlvl-1)
-                navres.append(indent + ind + "</li>\n")
-                navres.append(indent + "</ol>\n")
+                write(indent + ind + "</li>\n")
+                write(indent + "</ol>\n")
                 curlvl -= 1
             indent = ibase + incr*(lvl-1)
-            navres.append(indent + ind +  "</li>\n")
-            navres.append(indent + ind + '<li>\n')
-            navres.append(indent + ind*2 + '<a href="%s">%s</a>\n' % (href, lbl))
+            write(indent + ind +  "</li>\n")
+            write(indent + ind + '<li>\n')
+            write(indent + ind*2 + '<a href="%s">%s</a>\n' % (href, lbl))
         else:
             indent = ibase + incr*(lvl-1)
             if not initial:
-                navres.append(indent + ind + '</li>\n')    
-            navres.append(indent + ind + '<li>\n')
-            navres.append(indent + ind*2 + '<a href="%s">%s</a>\n' % (href, lbl))
+                write(indent + ind + '</li>\n')    
+            write(indent + ind + '<li>\n')
+            write(indent + ind*2 + '<a href="%s">%s</a>\n' % (href, lbl))
         initial = False
         curlvl=lvl
     while(curlvl > 0):
         indent = ibase + incr*(curlvl-1)
-        navres.append(indent + ind + "</li>\n")
-        navres.append(indent + "</ol>\n")
+        write(indent + ind + "</li>\n")
+        write(indent + "</ol>\n")
         curlvl -= 1
-    navres.append(ind*2 + '</nav>\n')
+    write(ind*2 + '</nav>\n')
 
     # add any existing page-list if need be
     if len(pagelist) > 0:
-        navres.append(ind*2 + '<nav epub:type="page-list" id="page-list" hidden="">\n')
-        navres.append(ind*3 + '<ol>\n')
+        write(ind*2 + '<nav epub:type="page-list" id="page-list" hidden="">\n')
+        write(ind*3 + '<ol>\n')
         for pn, bookhref in pagelist:
             if bk.launcher_version() < 20190927:
                 href = bookhref[6:]
             else:
                 ahref, asep, afrag = bookhref.partition('#')
                 href = bk.get_relativepath(navbookhref, ahref) + asep + afrag
-            navres.append(ind*4 + '<li><a href="%s">%s</a></li>\n' % (href, pn))
-        navres.append(ind*3 + '</ol>\n')
-        navres.append(ind*2 + '</nav>\n')
+            write(ind*4 + '<li><a href="%s">%s</a></li>\n' % (href, pn))
+        write(ind*3 + '</ol>\n')
+        write(ind*2 + '</nav>\n')
     
     # use the guide from the opf2 to create the landmarks section
-    navres.append(ind*2 + '<nav epub:type="landmarks" id="landmarks" hidden="">\n')
-    navres.append(ind*3 + '<h2>Guide</h2>\n')
-    navres.append(ind*3 + '<ol>\n')
+    write(ind*2 + '<nav epub:type="landmarks" id="landmarks" hidden="">\n')
+    write(ind*3 + '<h2>Guide</h2>\n')
+    write(ind*3 + '<ol>\n')
     for gtyp, gtitle, ghref in guide_info:
         if bk.launcher_version() < 20190927:
             href = ghref[6:]
@@ -763,16 +1556,15 @@ def build_nav(bk, navbookhref, doctitle, toclist, pagelist, guide_info, epub_typ
             href = bk.get_relativepath(navbookhref, ahref) + asep + afrag
         etyp = _guide_epubtype_map.get(gtyp, "")
         if etyp != "":
-            navres.append(ind*4 + '<li>\n')
-            navres.append(ind*5 + '<a epub:type="%s" href="%s">%s</a>\n' % (etyp, href, gtitle))
-            navres.append(ind*4 + '</li>\n')
-    navres.append(ind*3 + '</ol>\n')
-    navres.append(ind*2 + '</nav>\n')
+            write(ind*4 + '<li>\n')
+            write(ind*5 + '<a epub:type="%s" href="%s">%s</a>\n' % (etyp, href, gtitle))
+            write(ind*4 + '</li>\n')
+    write(ind*3 + '</ol>\n')
+    write(ind*2 + '</nav>\n')
 
     # now close it off
-    navres.append(ind + '</body>\n')
-    navres.append('</html>\n')
-    return  "".join(navres)
+    write(ind + '</body>\n')
+    write('</html>\n')
 
 
 # borrowed from calibre from calibre/src/calibre/__init__.py
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Quick structural checks of the generated epub3 built only from what
+# the conversion already knows (the converted opf's manifest and spine,
+# the nav targets and the finished zip's directory).  These cover the
+# problems this plugin has been known to produce, they are no substitute
+# for epubcheck, but a book that passes them rarely needs it.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import posixpath
+import struct
+import zipfile
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+# media types allowed in the spine without a fallback
+_SPINE_TYPES = ("application/xhtml+xml", "image/svg+xml")
+
+
+def _bookpath(href, opfbookhref):
+    return posixpath.normpath(posixpath.join(posixpath.dirname(opfbookhref), unquote(href)))
+
+
+def prevalidate_package(opfconv, opfbookhref, toclist, pagelist, guide_info, manifest_properties):
+    """
+    Check the converted package for broken id references, nav links
+    to non-spine resources (RSC-011), lost manifest properties and
+    a missing or repeated dcterms:modified.
+
+    :param opfconv: the Opf_Converter after conversion
+    :type  opfconv: Opf_Converter
+    :param opfbookhref: the book href of the opf
+    :type  opfbookhref: str
+    :param toclist: (level, label, book href) of the nav toc
+    :param pagelist: (page number, book href) of the nav page-list
+    :param guide_info: (type, title, book href) of the nav landmarks
+    :param manifest_properties: manifest id -> properties found in the xhtml
+    :type  manifest_properties: dict
+    :returns: a list of problem descriptions, empty if none were found
+    :rtype: list of str
+    """
+    problems = []
+    manifest = opfconv.get_manifest()
+    spine = opfconv.get_spine()
+
+    items = {}
+    hrefs = set()
+    navs = 0
+    for mid, href, mtype, props, mo_id in manifest:
+        if mid == "":
+            problems.append("manifest item %s has no id" % href)
+        elif mid in items:
+            problems.append("manifest id %s is used more than once" % mid)
+        if href in hrefs:
+            problems.append("manifest href %s is listed more than once" % href)
+        items[mid] = (href, mtype, props.split(), mo_id)
+        hrefs.add(href)
+        if "nav" in props.split():
+            navs += 1
+    if navs != 1:
+        problems.append("%d manifest items have the nav property, there must be exactly one" % navs)
+
+    for mid, props in manifest_properties.items():
+        if mid not in items:
+            continue
+        missing = [p for p in props.split() if p not in items[mid][2]]
+        if missing:
+            problems.append("manifest item %s lost its %s properties" % (mid, " ".join(missing)))
+    cover_id = opfconv.get_cover_id()
+    if cover_id is not None and cover_id not in items:
+        problems.append("cover meta refers to %s which is not in the manifest" % cover_id)
+
+    for mid, (href, mtype, props, mo_id) in items.items():
+        if mo_id is None:
+            continue
+        if mo_id not in items:
+            problems.append("media-overlay of %s refers to %s which is not in the manifest" % (mid, mo_id))
+        elif items[mo_id][1] != "application/smil+xml":
+            problems.append("media-overlay of %s refers to %s which is not a SMIL file" % (mid, mo_id))
+
+    spine_paths = set()
+    seen = set()
+    for idref in spine:
+        if idref not in items:
+            problems.append("spine itemref %s is not in the manifest" % idref)
+            continue
+        if idref in seen:
+            problems.append("spine itemref %s is listed more than once" % idref)
+        seen.add(idref)
+        href, mtype = items[idref][0], items[idref][1]
+        if mtype not in _SPINE_TYPES:
+            problems.append("spine item %s has media type %s" % (idref, mtype))
+        spine_paths.add(_bookpath(href, opfbookhref))
+
+    # RSC-011 every nav link must point into a spine item
+    targets = [("toc", t[2]) for t in toclist]
+    targets.extend(("page-list", p[1]) for p in pagelist)
+    targets.extend(("landmarks", g[2]) for g in guide_info)
+    for kind, bookhref in targets:
+        ahref = posixpath.normpath(unquote(bookhref.partition("#")[0]))
+        if ahref not in spine_paths:
+            problems.append("%s links to %s which is not a spine item (RSC-011)" % (kind, bookhref))
+
+    modified = opfconv.get_modified_count()
+    if modified != 1:
+        problems.append("the opf has %d dcterms:modified meta, there must be exactly one" % modified)
+    return problems
+
+
+def check_container(fpath):
+    """
+    Check that the epub at fpath starts with an uncompressed mimetype
+    entry holding application/epub+zip with no extra field, and that
+    it has a META-INF/container.xml.
+    Only the zip directory and the mimetype entry are read.
+
+    :param fpath: the path of the epub
+    :type  fpath: str
+    :rtype: list of str
+    """
+    problems = []
+    try:
+        with zipfile.ZipFile(fpath) as zf:
+            infos = zf.infolist()
+            if len(infos) == 0 or infos[0].filename != "mimetype":
+                problems.append("mimetype is not the first entry of the zip")
+            else:
+                info = infos[0]
+                if info.compress_type != zipfile.ZIP_STORED:
+                    problems.append("mimetype entry is compressed")
+                # readers expect the contents at byte 38, so the local
+                # header must not carry an extra field
+                zf.fp.seek(info.header_offset)
+                header = zf.fp.read(30)
+                if info.header_offset != 0 or struct.unpack("<H", header[28:30])[0] != 0:
+                    problems.append("mimetype entry has an extra field")
+                if zf.read(info) != b"application/epub+zip":
+                    problems.append("mimetype entry does not hold application/epub+zip")
+            if "META-INF/container.xml" not in [i.filename for i in infos]:
+                problems.append("META-INF/container.xml is missing")
+    except (IOError, OSError, zipfile.BadZipfile) as e:
+        problems.append("cannot read the epub: %s" % e)
+    return problems
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+
+try:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+except ImportError:
+    multiprocessing = None
+
+# each named entity costs about as much to convert as this many characters
+ENTITY_WEIGHT = 16
+
+# documents cheaper than this are batched together into tasks of roughly
+# BATCH_COST so that title pages do not each pay for a round trip to a worker
+SMALL_COST = 64 * 1024
+BATCH_COST = 256 * 1024
+
+
+def estimate_cost(size, ampersands):
+    """
+    Estimate the relative conversion cost of a document from its size
+    in characters and the number of '&' it holds (entity density).
+    """
+    return size + ENTITY_WEIGHT * ampersands
+
+
+# bytes read from the start of a file to estimate its entity density
+SAMPLE_SIZE = 64 * 1024
+
+
+def estimate_file_cost(filepath):
+    """
+    Estimate the conversion cost of a document on disk without reading
+    all of it, scaling the '&' count of its first SAMPLE_SIZE bytes.
+    """
+    size = os.path.getsize(filepath)
+    with open(filepath, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+    ampersands = sample.count(b"&")
+    if len(sample) > 0 and size > len(sample):
+        ampersands = ampersands * size // len(sample)
+    return estimate_cost(size, ampersands)
+
+
+class Task(object):
+
+    def __init__(self):
+        self.items = []
+        self.cost = 0
+
+    def add(self, item, cost):
+        self.items.append(item)
+        self.cost += cost
+
+
+def plan_tasks(docs, small_cost=SMALL_COST, batch_cost=BATCH_COST):
+    """
+    Turn a list of (cost, item) pairs into a list of Tasks ordered
+    most expensive first, so the long documents start right away and
+    the short ones fill in the gaps at the end (longest processing time
+    first).  Cheap documents are packed together into batches.
+    docs may hold the documents of several books, they all share the
+    one queue.
+
+    :param docs: the documents to schedule
+    :type  docs: list of (int, object)
+    :rtype: list of Task
+    """
+    tasks = []
+    batch = None
+    for cost, item in sorted(docs, key=lambda d: d[0], reverse=True):
+        if cost >= small_cost:
+            task = Task()
+            task.add(item, cost)
+            tasks.append(task)
+            continue
+        if batch is None or batch.cost + cost > batch_cost:
+            batch = Task()
+            tasks.append(batch)
+        batch.add(item, cost)
+    tasks.sort(key=lambda t: t.cost, reverse=True)
+    return tasks
+
+
+def parallel_available():
+    # worker processes are forked so that they inherit the plugin modules
+    # and Sigil's launcher modules without re-running the launcher
+    # Sigil's embedded python on Windows and macOS cannot safely spawn
+    if multiprocessing is None or sys.version_info < (3, 7):
+        return False
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def run_tasks(tasks, worker, workers):
+    """
+    Run worker(task.items) for every task in a pool of forked processes,
+    submitting them in the given order, and yield the items of each
+    returned list as tasks complete.
+
+    :param tasks: tasks from plan_tasks()
+    :type  tasks: list of Task
+    :param worker: module level function taking a list of items and returning a list of results
+    :type  worker: callable
+    :param workers: number of worker processes
+    :type  workers: int
+    """
+    ctx = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+        futures = [executor.submit(worker, task.items) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                for result in future.result():
+                    yield result
+        finally:
+            # if the caller stops early do not wait on tasks not yet started
+            for future in futures:
+                future.cancel()
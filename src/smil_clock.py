@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Parse SMIL 3.0 clock values (as used by clipBegin and clipEnd)
+# into whole nanoseconds, so that the durations of long overlays
+# can be summed with integer arithmetic and no rounding drift.
+#
+#   Clock-value         ::= Full-clock-value | Partial-clock-value | Timecount-value
+#   Full-clock-value    ::= Hours ":" Minutes ":" Seconds ("." Fraction)?
+#   Partial-clock-value ::= Minutes ":" Seconds ("." Fraction)?
+#   Timecount-value     ::= Timecount ("." Fraction)? (Metric)?
+#   Metric              ::= "h" | "min" | "s" | "ms"
+#
+# Minutes and seconds are accepted with any number of digits
+# and a leading "." timecount (".5s") is tolerated.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import re
+
+NS_PER_SECOND = 1000000000
+
+_METRIC_NS = {
+    "h": 3600 * NS_PER_SECOND,
+    "min": 60 * NS_PER_SECOND,
+    "s": NS_PER_SECOND,
+    "ms": NS_PER_SECOND // 1000,
+}
+
+_CLOCK_VALUE = re.compile(r"""
+    ^\s*(?:
+        (?:(?P<hours>\d+):)?(?P<minutes>\d+):(?P<seconds>\d+)(?:\.(?P<fraction>\d*))?
+      | (?P<count>\d*)(?:\.(?P<count_fraction>\d*))?(?P<metric>h|min|s|ms)?
+    )\s*$""", re.X)
+
+# clipEnd of one clip is usually the clipBegin of the next
+# so most values are seen twice, and whole-second values far more often
+_CACHE_SIZE = 65536
+_cache = {}
+
+
+def _scaled(whole, fraction, unit):
+    # whole.fraction * unit rounded to the nearest integer, exactly
+    if not fraction:
+        return whole * unit
+    den = 10 ** len(fraction)
+    num = (whole * den + int(fraction)) * unit
+    return (2 * num + den) // (2 * den)
+
+
+def parse_clock_value(value):
+    """
+    Convert a SMIL clock value to an integer number of nanoseconds.
+    Timecount values without a metric are in seconds.
+    None or an empty string give 0.
+
+    :param value: the clock value to be converted
+    :type  value: str
+    :returns:     the clock value in nanoseconds
+    :rtype:       int
+    :raises ValueError: if value is not a valid clock value
+    """
+    if not value:
+        return 0
+    ns = _cache.get(value, None)
+    if ns is not None:
+        return ns
+    m = _CLOCK_VALUE.match(value)
+    if m is None:
+        raise ValueError("invalid SMIL clock value: %r" % value)
+    if m.group("seconds") is not None:
+        hours = int(m.group("hours") or 0)
+        whole = hours * 3600 + int(m.group("minutes")) * 60 + int(m.group("seconds"))
+        ns = _scaled(whole, m.group("fraction"), NS_PER_SECOND)
+    else:
+        count = m.group("count")
+        fraction = m.group("count_fraction")
+        if not count and not fraction:
+            raise ValueError("invalid SMIL clock value: %r" % value)
+        unit = _METRIC_NS[m.group("metric") or "s"]
+        ns = _scaled(int(count or 0), fraction, unit)
+    if len(_cache) >= _CACHE_SIZE:
+        _cache.clear()
+    _cache[value] = ns
+    return ns
+
+
+def seconds_to_ns(seconds):
+    return int(round(seconds * NS_PER_SECOND))
+
+
+def ns_to_seconds(ns):
+    return ns / NS_PER_SECOND
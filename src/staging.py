@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Stage the book's files in the temp directory without copying the ones
+# that are never modified.  Images, fonts and audio are cloned (a reflink,
+# which shares the data blocks until either copy is written) or hard
+# linked to the exploded book Sigil hands the plugin, and only copied when
+# neither is possible.  Files the conversion rewrites are always copied.
+#
+# Linking is only safe because nothing writes a staged file in place:
+# every rewrite goes through plugin.staged_output() which replaces the
+# file by renaming a new one over it, leaving the original untouched.
+#
+# Where the staging directory lives is chosen by make_staging_dir(), small
+# books can be staged in memory (a tmpfs) and big ones spill over to disk.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import errno
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux ioctl to clone a whole file, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# the errors that mean a way of linking can never work between these two
+# directories, as opposed to a problem with one file
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ("EXDEV", "EOPNOTSUPP", "ENOTSUP", "EINVAL", "ENOTTY", "EPERM", "ENOSYS")
+                   if hasattr(errno, name))
+
+
+def book_source_root(bk):
+    """
+    Return the directory holding the exploded book the launcher gave
+    the plugin, or None if it is not known or does not hold the book
+    as it stands (files changed in memory and not yet written out).
+
+    :rtype: str or None
+    """
+    w = getattr(bk, "_w", None)
+    root = getattr(w, "ebook_root", None)
+    if root is None or not os.path.isdir(root):
+        return None
+    if getattr(w, "modified", None):
+        return None
+    return root
+
+
+class Stager(object):
+
+    def __init__(self, link=True):
+        self.methods = []
+        if link:
+            if fcntl is not None:
+                self.methods.append("reflink")
+            if hasattr(os, "link"):
+                self.methods.append("hardlink")
+        self.counts = {"reflink": 0, "hardlink": 0, "copy": 0}
+
+    def _reflink(self, src, dst):
+        with open(src, "rb") as inf:
+            with open(dst, "wb") as outf:
+                try:
+                    fcntl.ioctl(outf.fileno(), FICLONE, inf.fileno())
+                except (IOError, OSError):
+                    outf.close()
+                    os.remove(dst)
+                    raise
+
+    def stage_file(self, src, dst, copy=False):
+        """
+        Make dst hold the contents of src, linking it to src unless
+        copy is True.  A way of linking that the file systems do not
+        support is not tried again.  A symlink is followed, dst gets
+        the contents of its target and not the link itself, which
+        would point nowhere if it is relative.
+
+        :returns: how it was staged, "reflink", "hardlink" or "copy"
+        :rtype: str
+        """
+        src = os.path.realpath(src)
+        if not copy:
+            for method in list(self.methods):
+                try:
+                    if method == "reflink":
+                        self._reflink(src, dst)
+                    else:
+                        os.link(src, dst)
+                except (IOError, OSError) as e:
+                    if e.errno in _UNSUPPORTED and method in self.methods:
+                        self.methods.remove(method)
+                    continue
+                self.counts[method] += 1
+                return method
+        shutil.copyfile(src, dst)
+        self.counts["copy"] += 1
+        return "copy"
+
+    def stage_tree(self, src_root, dest_root, rewritten=()):
+        """
+        Stage every file under src_root at the same place under
+        dest_root, copying those whose book paths are in rewritten
+        and linking the rest.
+
+        :param rewritten: book paths of the files the conversion rewrites
+        :type  rewritten: set of str
+        """
+        for dirpath, dirnames, filenames in os.walk(src_root):
+            rel = os.path.relpath(dirpath, src_root)
+            destdir = dest_root if rel == os.curdir else os.path.join(dest_root, rel)
+            if not os.path.isdir(destdir):
+                os.makedirs(destdir)
+            for fname in filenames:
+                bookpath = fname if rel == os.curdir else os.path.join(rel, fname).replace(os.sep, "/")
+                self.stage_file(os.path.join(dirpath, fname), os.path.join(destdir, fname),
+                                copy=bookpath in rewritten)
+
+
+# directories backed by memory on the systems that have them
+MEMORY_DIRS = ("/dev/shm", "/run/shm")
+
+# the staged files grow by this factor at worst, while a file is rewritten
+# both the old and new version exist and the mimetype, opf3 and nav are added
+STAGING_HEADROOM = 2
+
+
+def tree_size(root):
+    """
+    Return the total size in bytes of the files under root.
+
+    :rtype: int
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, fname))
+            except OSError:
+                pass
+    return size
+
+
+def _free_space(path):
+    if not hasattr(os, "statvfs"):
+        return None
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def _usable_dir(path, needed):
+    if not path or not os.path.isdir(path) or not os.access(path, os.W_OK | os.X_OK):
+        return False
+    free = _free_space(path)
+    return free is None or free >= needed * STAGING_HEADROOM
+
+
+def make_staging_dir(backend="disk", budget=0, needed=None, tmpfs_dir=""):
+    """
+    Create the temporary directory the book is staged in.
+
+    "memory" stages in a memory backed file system (/dev/shm), "tmpfs"
+    in the directory tmpfs_dir and "disk" in the system temp directory.
+    Either of the first two spills over to disk when the book is bigger
+    than budget, its size is not known, or the file system does not
+    have room for it.
+
+    :param backend: "memory", "tmpfs" or "disk"
+    :type  backend: str
+    :param budget: most bytes of book to stage in memory or tmpfs, 0 for no limit
+    :type  budget: int
+    :param needed: the size in bytes of the book, None if not known
+    :type  needed: int or None
+    :param tmpfs_dir: the directory used by the "tmpfs" backend
+    :type  tmpfs_dir: str
+    :returns: the path of the new directory and the backend used
+    :rtype: tuple
+    """
+    if backend != "disk" and needed is not None and (budget <= 0 or needed <= budget):
+        if backend == "memory":
+            candidates = MEMORY_DIRS
+        else:
+            candidates = (tmpfs_dir,)
+        for base in candidates:
+            if _usable_dir(base, needed):
+                try:
+                    return tempfile.mkdtemp(prefix="epub3itizer", dir=base), backend
+                except (IOError, OSError):
+                    pass
+    return tempfile.mkdtemp(), "disk"
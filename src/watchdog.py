@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import time
+
+_clock = getattr(time, "monotonic", time.time)
+
+
+class ConversionTimeout(Exception):
+
+    def __init__(self, mid, scope, elapsed, budget):
+        Exception.__init__(self, "%s exceeded its %s time budget of %gs after %.2fs" % (mid, scope, budget, elapsed))
+        self.mid = mid
+        self.scope = scope
+        self.elapsed = elapsed
+        self.budget = budget
+
+    def __reduce__(self):
+        # so it can be returned from a worker process
+        return (ConversionTimeout, (self.mid, self.scope, self.elapsed, self.budget))
+
+
+# cooperative time budgets for one book and the document being converted
+# the parsing loops call check() once per token, which only looks at the
+# clock every CHECK_INTERVAL calls and raises ConversionTimeout on overrun
+# the count runs on across documents so a book of short documents is still
+# checked, and start_document() checks the book budget before each one
+# a budget of 0 means no limit
+class Watchdog(object):
+
+    CHECK_INTERVAL = 256
+
+    def __init__(self, doc_budget=0, book_budget=0, book_start=None):
+        self.doc_budget = doc_budget
+        self.book_budget = book_budget
+        self.book_start = book_start
+        if book_start is None:
+            self.book_start = _clock()
+        self.doc_start = None
+        self.mid = None
+        self.ticks = 0
+        self.timeouts = []
+
+    def start_document(self, mid):
+        self.mid = mid
+        self.doc_start = _clock()
+        if self.book_budget > 0 and self.doc_start - self.book_start > self.book_budget:
+            raise ConversionTimeout(mid, "book", self.doc_start - self.book_start, self.book_budget)
+
+    def end_document(self):
+        self.mid = None
+        self.doc_start = None
+
+    def check(self):
+        self.ticks += 1
+        if self.ticks % self.CHECK_INTERVAL:
+            return
+        now = _clock()
+        if self.doc_budget > 0 and self.doc_start is not None and now - self.doc_start > self.doc_budget:
+            raise ConversionTimeout(self.mid, "document", now - self.doc_start, self.doc_budget)
+        if self.book_budget > 0 and now - self.book_start > self.book_budget:
+            raise ConversionTimeout(self.mid, "book", now - self.book_start, self.book_budget)
+
+    def record(self, err):
+        # remember which manifest ids were cancelled for the final report
+        self.timeouts.append((err.mid, err.scope, err.elapsed))
+        self.end_document()
+
+    def get_limits(self):
+        # enough to recreate this watchdog's budgets in a worker process
+        return (self.doc_budget, self.book_budget, self.book_start)
+
+    def get_timeouts(self):
+        return self.timeouts
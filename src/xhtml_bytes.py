@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Convert xhtml to be epub3 friendly working directly on its utf-8 bytes.
+#
+# All the edits convert_xhtml_text() makes are to ascii markup or are named
+# entities in text, so the document never needs to be decoded.  Text and
+# untouched tags are copied to the output as slices of the input; only the
+# few tags that change are rebuilt.  It splits the document into text and
+# tags the same way Sigil's QuickXHTMLParser does, but unlike it does not
+# re-serialize the tags it leaves alone, so their quoting and spacing
+# survive as written.
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import re
+
+from html_namedentities import named_entities, text_chunks
+
+_TAG_NAME = re.compile(br'<\s*(/?)\s*([^>/\s"\']*)')
+
+_ATTR = re.compile(br'''([^\s=/>"']+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>/"']+))''')
+
+_NAMED_ENTITY = re.compile(br"&(\w+;)")
+
+_EPUB_NS = b"http://www.idpf.org/2007/ops"
+
+_entity_bytes = None
+
+def _entity_map():
+    # named entity with its ; -> numeric character references as bytes
+    global _entity_bytes
+    if _entity_bytes is None:
+        emap = {}
+        for name, sval in named_entities.items():
+            if name.endswith(";"):
+                emap[name.encode("ascii")] = "".join(["&#%d;" % ord(c) for c in sval]).encode("ascii")
+        _entity_bytes = emap
+    return _entity_bytes
+
+
+def convert_named_entities_bytes(text):
+    if b"&" not in text:
+        return text
+    emap = _entity_map()
+    return _NAMED_ENTITY.sub(lambda m: emap.get(m.group(1), m.group(0)), text)
+
+
+def _parse_attrs(tag):
+    # ordered list of [name, value] with names lowercased
+    attrs = []
+    for m in _ATTR.finditer(tag, 1):
+        val = m.group(2)
+        if val is None:
+            val = m.group(3)
+            if val is None:
+                val = m.group(4)
+        attrs.append([m.group(1).lower(), val])
+    return attrs
+
+
+def _get(attrs, name, default=None):
+    for aname, val in attrs:
+        if aname == name:
+            return val
+    return default
+
+
+def _set(attrs, name, val):
+    for attr in attrs:
+        if attr[0] == name:
+            attr[1] = val
+            return
+    attrs.append([name, val])
+
+
+def _build_tag(tname, ttype, attrs):
+    res = [b"<", tname]
+    for aname, val in attrs:
+        qt = b'"'
+        if b'"' in val:
+            qt = b"'"
+        res.extend((b" ", aname, b"=", qt, val, qt))
+    if ttype == "single":
+        res.append(b"/>")
+    else:
+        res.append(b">")
+    return b"".join(res)
+
+
+def _iter_tokens(data):
+    # yield (start, end, is_tag) spans splitting data into text and tags
+    # the way QuickXHTMLParser does: a '<' before the next '>' ends a tag
+    # early and the part before it is text, and an unterminated comment
+    # or tag runs to the end of the data
+    n = len(data)
+    p = 0
+    gtpos = -1
+    while p < n:
+        if data[p:p+1] != b"<":
+            te = data.find(b"<", p)
+            if te == -1:
+                te = n
+            yield p, te, False
+            p = te
+            continue
+        if data[p:p+4] == b"<!--":
+            te = data.find(b"-->", p + 1)
+            te = n if te == -1 else te + 3
+            yield p, te, True
+            p = te
+            continue
+        if gtpos <= p:
+            gtpos = data.find(b">", p + 1)
+            if gtpos == -1:
+                gtpos = n
+        ntb = data.find(b"<", p + 1, gtpos)
+        if ntb != -1:
+            yield p, ntb, False
+            p = ntb
+            continue
+        te = min(gtpos + 1, n)
+        yield p, te, True
+        p = te
+
+
+def convert_xhtml_bytes(data, bookhref, out, watchdog=None):
+    """
+    Convert the utf-8 encoded xhtml in data the way convert_xhtml_text()
+    does, writing utf-8 bytes to out.
+
+    :param data: the utf-8 encoded xhtml, bytes or an mmap
+    :param bookhref: the book href of the document
+    :type  bookhref: str
+    :param out: any object with a write(bytes) method
+    :returns: a tuple (mproperties, sproperties, etypes, ids)
+    :rtype: tuple
+    """
+    write = out.write
+    view = memoryview(data)
+    sproperties = []
+    mproperties = []
+    etypes = []
+    ids = set()
+    # the names of the open tags, and how many of them contain "head"
+    # as the QuickXHTMLParser tag prefix would
+    path = []
+    in_head = 0
+    try:
+        for b, e, is_tag in _iter_tokens(data):
+            if watchdog is not None:
+                watchdog.check()
+            if not is_tag:
+                if data.find(b"&", b, e) == -1:
+                    write(view[b:e])
+                    continue
+                for cb, ce in text_chunks(data, b, e, amp=b"&"):
+                    write(convert_named_entities_bytes(data[cb:ce]))
+                continue
+
+            tag = data[b:e]
+            if tag.startswith(b"<!--") or tag.startswith(b"<?") or tag.startswith(b"<![CDATA["):
+                write(view[b:e])
+                continue
+            m = _TAG_NAME.match(tag)
+            tname = m.group(2).lower()
+            if m.group(1):
+                ttype = "end"
+            elif tag.endswith(b"/>"):
+                ttype = "single"
+            else:
+                ttype = "begin"
+            in_prefix = in_head > 0
+            if ttype == "begin":
+                path.append(tname)
+                if b"head" in tname:
+                    in_head += 1
+            elif ttype == "end" and path:
+                if b"head" in path.pop():
+                    in_head -= 1
+
+            attrs = None
+            if ttype != "end" and b"id" in tag:
+                attrs = _parse_attrs(tag)
+                tid = _get(attrs, b"id")
+                if tid is not None:
+                    ids.add(tid.decode("utf-8"))
+
+            if tname == b"!doctype":
+                write(b"<!DOCTYPE html>")
+                continue
+
+            elif tname == b"html":
+                if ttype != "end":
+                    attrs = attrs if attrs is not None else _parse_attrs(tag)
+                    if _get(attrs, b"xmlns:epub") != _EPUB_NS:
+                        _set(attrs, b"xmlns:epub", _EPUB_NS)
+                        write(_build_tag(m.group(2), ttype, attrs))
+                        continue
+
+            elif tname == b"link":
+                if ttype != "end" and b"charset" in tag.lower():
+                    attrs = attrs if attrs is not None else _parse_attrs(tag)
+                    if _get(attrs, b"charset") is not None:
+                        attrs = [a for a in attrs if a[0] != b"charset"]
+                        write(_build_tag(m.group(2), ttype, attrs))
+                        continue
+
+            elif tname == b"big":
+                if ttype == "end":
+                    write(b"</span>")
+                    continue
+                attrs = attrs if attrs is not None else _parse_attrs(tag)
+                if ttype == "begin":
+                    style = _get(attrs, b"style", b"")
+                    if style == b"":
+                        style = b"font-size: larger"
+                    else:
+                        style = style + b"; font-size: larger"
+                    _set(attrs, b"style", style)
+                write(_build_tag(b"span", ttype, attrs))
+                continue
+
+            elif tname == b"meta":
+                if ttype != "end":
+                    attrs = attrs if attrs is not None else _parse_attrs(tag)
+                    mname = _get(attrs, b"name", b"")
+                    mcontent = _get(attrs, b"content", b"")
+                    # determine any spine properties for this page from meta data
+                    if mname in (b"layout", b"orientation", b"page-spread", b"viewport"):
+                        if mcontent != b"":
+                            sproperties.append((mname + b"-" + mcontent).decode("utf-8"))
+                    # remap to new html5 charset declaration
+                    elif b"charset" in mcontent:
+                        write(_build_tag(m.group(2), ttype, [[b"charset", b"utf-8"]]))
+                        continue
+
+            # handle manifest properties
+            elif tname in (b"svg", b"svg:svg") and not "svg" in mproperties:
+                mproperties.append("svg")
+            elif tname == b"script" and in_prefix and not "scripted" in mproperties:
+                mproperties.append("scripted")
+            elif tname in (b"math", b"m:math") and not "math" in mproperties:
+                mproperties.append("mathml")
+            elif tname == b"epub:switch" and not "switch" in mproperties:
+                mproperties.append("switch")
+
+            # build up url to epub:types mapping
+            elif ttype != "end" and attrs is not None and b"epub:type" in tag:
+                semantic_type = _get(attrs, b"epub:type")
+                tid = _get(attrs, b"id")
+                title = _get(attrs, b"title")
+                if semantic_type is not None and tid is not None and title is not None:
+                    etypes.append((bookhref + "#" + tid.decode("utf-8"),
+                                   semantic_type.decode("utf-8"), title.decode("utf-8")))
+
+            write(view[b:e])
+    finally:
+        view.release()
+
+    return mproperties, sproperties, etypes, ids
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Regression checks for the SMIL clock value parser
+#
+# Every form of clock value SMIL 3.0 allows is parsed and compared with
+# its value in nanoseconds, worked out by hand: timecounts with each of
+# the h, min, s and ms metrics (the "min" metric used to be misread),
+# partial and full clock values, and input that must be rejected.  Each
+# value is parsed twice so the cached result is checked too.
+#
+# usage: python clock_values.py
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(os.path.dirname(_HERE), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+from smil_clock import parse_clock_value
+
+S = 1000000000
+
+# (clock value, nanoseconds)
+VALID = [
+    # timecounts with a metric
+    ("2h", 2 * 3600 * S),
+    ("0.5h", 1800 * S),
+    ("2min", 120 * S),
+    ("1.5min", 90 * S),
+    ("0.25min", 15 * S),
+    ("90min", 5400 * S),
+    ("3s", 3 * S),
+    ("3.25s", 3250000000),
+    (".5s", S // 2),
+    ("500ms", S // 2),
+    ("1.5ms", 1500000),
+    ("0.0000005ms", 1),
+    # timecounts without a metric are seconds
+    ("45", 45 * S),
+    ("12.345", 12345000000),
+    # partial clock values
+    ("02:30", 150 * S),
+    ("1:02.25", 62250000000),
+    ("125:00", 7500 * S),
+    ("00:00.000000001", 1),
+    # full clock values
+    ("00:01:02.5", 62500000000),
+    ("12:00:00", 12 * 3600 * S),
+    ("1:00:00.1", 3600100000000),
+    ("0:00:02.200", 2200000000),
+    # surrounding white space, nothing at all
+    ("  4s ", 4 * S),
+    ("", 0),
+    (None, 0),
+]
+
+INVALID = [
+    "abc",
+    "s",
+    "min",
+    "1m",
+    "5 min",
+    "2mins",
+    "-1s",
+    "1.2.3",
+    "1:2:3:4",
+    "1::2",
+    ":30",
+    "1:30min",
+    "ms5",
+]
+
+
+def check_valid():
+    problems = []
+    for value, expected in VALID:
+        for attempt in ("first", "cached"):
+            try:
+                got = parse_clock_value(value)
+            except ValueError as e:
+                problems.append("%r (%s): raised %s" % (value, attempt, e))
+                break
+            if got != expected:
+                problems.append("%r (%s): got %d ns, expected %d ns" % (value, attempt, got, expected))
+                break
+    return problems
+
+
+def check_invalid():
+    problems = []
+    for value in INVALID:
+        try:
+            got = parse_clock_value(value)
+        except ValueError:
+            continue
+        problems.append("%r: accepted as %d ns" % (value, got))
+    return problems
+
+
+def main(argv):
+    problems = check_valid() + check_invalid()
+    for problem in problems:
+        print("    FAIL: %s" % problem)
+    print("    %d valid and %d invalid clock values checked" % (len(VALID), len(INVALID)))
+    if problems:
+        print("Clock value checks failed: %d" % len(problems))
+        return 1
+    print("Clock value checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Checks for the layout of written epubs
+#
+# Each exploded book of the corpus (the tests/mo and tests/escaped books
+# by default) is zipped by write_epub() on its own zip writer and on the
+# zipfile zip64 fallback, with and without the deterministic timestamp,
+# and every epub must pass check_container() (mimetype first, stored, no
+# extra field) and read back with the same members and data as the
+# staged book.
+#
+# The plugin's manifest to book path mapping must then give every member
+# of the book its manifest media type, however its href is escaped, and
+# the epub zipped with them must compress each member as the media type
+# policy says.  Zipped in reading order, the opf and then the spine items
+# must follow the mimetype and container.xml, escaped names or not.
+#
+# usage: python epub_layout.py [corpus_dir ...]
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+import shutil
+import tempfile
+import zipfile
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(os.path.dirname(_HERE), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+import epub_zip
+from epub_zip import write_epub, epub_member_names, member_level, COMPRESSION_POLICY
+from opf_converter import Opf_Converter
+from plugin import map_manifest_bookpaths, reading_order_first
+from prevalidate import check_container
+from shadow_run import ExplodedBook, find_corpus
+
+# the deterministic timestamp, 2020-09-13 12:26:40 UTC
+TIMESTAMP = 1600000000
+
+# (name, force the zip64 fallback, timestamp)
+LAYOUTS = [
+    ("zip32", False, None),
+    ("zip32 deterministic", False, TIMESTAMP),
+    ("zip64", True, None),
+    ("zip64 deterministic", True, TIMESTAMP),
+]
+
+
+def write_layout(root, fpath, zip64, timestamp):
+    saved = epub_zip._ZIP32_LIMIT
+    if zip64:
+        # any book is too big for a zip32 archive
+        epub_zip._ZIP32_LIMIT = 0
+    try:
+        write_epub(root, fpath, 1, timestamp=timestamp)
+    finally:
+        epub_zip._ZIP32_LIMIT = saved
+
+
+def check_members(root, fpath):
+    problems = []
+    names = epub_member_names(root)
+    with zipfile.ZipFile(fpath) as zf:
+        if sorted(zf.namelist()) != sorted(names):
+            return ["the members are not those of the staged book"]
+        for name in names:
+            with open(os.path.join(root, name.replace("/", os.sep)), "rb") as f:
+                if zf.read(name) != f.read():
+                    problems.append("%s does not read back as staged" % name)
+    return problems
+
+
+def check_media_types(root, fpath):
+    problems = []
+    bk = ExplodedBook(root)
+    opfbookpath = bk.get_opfbookpath()
+    man_ids = [mid for mid, href, mime in bk.manifest_iter()]
+    opfconv = Opf_Converter(bk.readotherfile(opfbookpath), {}, {}, {}, man_ids)
+    media_types = map_manifest_bookpaths(bk, opfbookpath, opfconv.get_manifest())[0]
+    # the media types as the manifest gives them, for the staged names
+    expected = dict((bk.id_to_bookpath(mid), mime) for mid, href, mime in bk.manifest_iter())
+    for name in epub_member_names(root):
+        if name in expected and media_types.get(name, None) != expected[name]:
+            problems.append("%s has media type %s" % (name, media_types.get(name, None)))
+    write_epub(root, fpath, 1, media_types, COMPRESSION_POLICY)
+    with zipfile.ZipFile(fpath) as zf:
+        for info in zf.infolist():
+            stored = member_level(info.filename, expected.get(info.filename, None), COMPRESSION_POLICY) == 0
+            if stored != (info.compress_type == zipfile.ZIP_STORED):
+                problems.append("%s is %s" % (info.filename, "deflated" if stored else "stored"))
+    return problems
+
+
+def check_reading_order(root, fpath):
+    bk = ExplodedBook(root)
+    opfbookpath = bk.get_opfbookpath()
+    man_ids = [mid for mid, href, mime in bk.manifest_iter()]
+    opfconv = Opf_Converter(bk.readotherfile(opfbookpath), {}, {}, {}, man_ids)
+    media_types, id_to_bookhref, navbookhref = map_manifest_bookpaths(bk, opfbookpath, opfconv.get_manifest())
+    first = reading_order_first(opfbookpath, navbookhref, id_to_bookhref, opfconv.get_spine())
+    write_epub(root, fpath, 1, media_types, COMPRESSION_POLICY, first=first)
+    with zipfile.ZipFile(fpath) as zf:
+        names = zf.namelist()
+    # the exploded books have no nav yet, the spine follows the opf
+    spine = [bk.id_to_bookpath(idref) for idref, linear, href in bk.spine_iter()]
+    expected = ["mimetype", "META-INF/container.xml", opfbookpath] + spine
+    if names[:len(expected)] != expected:
+        return ["the epub starts %s, expected %s" % (", ".join(names[:len(expected)]), ", ".join(expected))]
+    return []
+
+
+def main(argv):
+    dirs = argv[1:] or [os.path.join(_HERE, "mo"), os.path.join(_HERE, "escaped")]
+    failures = 0
+    out_dir = tempfile.mkdtemp()
+    try:
+        for root in find_corpus(dirs):
+            print("..book: ", os.path.relpath(root))
+            for name, zip64, timestamp in LAYOUTS:
+                fpath = os.path.join(out_dir, "book.epub")
+                write_layout(root, fpath, zip64, timestamp)
+                problems = check_container(fpath) + check_members(root, fpath)
+                if problems:
+                    print("    %-25s FAIL: %s" % (name, "; ".join(problems)))
+                    failures += 1
+                else:
+                    print("    %-25s ok" % name)
+            problems = check_media_types(root, os.path.join(out_dir, "book.epub"))
+            if problems:
+                print("    %-25s FAIL: %s" % ("media types", "; ".join(problems)))
+                failures += 1
+            else:
+                print("    %-25s ok" % "media types")
+            problems = check_reading_order(root, os.path.join(out_dir, "book.epub"))
+            if problems:
+                print("    %-25s FAIL: %s" % ("reading order", "; ".join(problems)))
+                failures += 1
+            else:
+                print("    %-25s ok" % "reading order")
+    finally:
+        shutil.rmtree(out_dir)
+    if failures:
+        print("Epub layout checks failed: %d" % failures)
+        return 1
+    print("Epub layout checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Checks for the mp3 duration scanner
+#
+# The frame size arithmetic is checked against frame lengths worked out
+# by hand from the MPEG audio spec, and whole streams are built from
+# frame headers to check the frame walk, the Xing/Info and VBRI headers
+# (truncated ones too), ID3 tags and junk between frames.  Every mp3 of
+# the corpus (the tests/mo books by default) must then measure no shorter
+# than the last clipEnd any SMIL overlay plays it to, and no more than
+# TOLERANCE_FRAMES frames longer.
+#
+# usage: python mp3_durations.py [corpus_dir ...]
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+import struct
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(os.path.dirname(_HERE), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+from lxml import etree
+
+from mp3_duration import parse_frame_header, scan_duration, mp3_duration
+from smil_clock import parse_clock_value, ns_to_seconds
+
+# the last clip of an overlay ends within this many frames of the audio
+TOLERANCE_FRAMES = 2
+
+_SMIL_AUDIO = "{http://www.w3.org/ns/SMIL}audio"
+
+_LAYER_BITS = {1: 3, 2: 2, 3: 1}
+_VERSION_BITS = {"1": 3, "2": 2, "2.5": 0}
+
+
+def frame_header(version="1", layer=3, bitrate_index=9, rate_index=0, padding=0, mono=False):
+    # the 4 header bytes, no crc
+    b1 = 0xE0 | _VERSION_BITS[version] << 3 | _LAYER_BITS[layer] << 1 | 1
+    b2 = bitrate_index << 4 | rate_index << 2 | padding << 1
+    b3 = (3 if mono else 0) << 6
+    return struct.pack(">4B", 0xFF, b1, b2, b3)
+
+
+def frame(**kw):
+    hdr = frame_header(**kw)
+    return hdr + b"\0" * (parse_frame_header(hdr, 0)[0] - 4)
+
+
+# (header fields, frame length, samples per frame, sample rate)
+FRAME_SIZES = [
+    (dict(version="1", layer=3, bitrate_index=9, rate_index=0), 417, 1152, 44100),
+    (dict(version="1", layer=3, bitrate_index=9, rate_index=0, padding=1), 418, 1152, 44100),
+    (dict(version="1", layer=3, bitrate_index=14, rate_index=1), 960, 1152, 48000),
+    (dict(version="1", layer=2, bitrate_index=10, rate_index=0), 626, 1152, 44100),
+    (dict(version="1", layer=1, bitrate_index=14, rate_index=1), 448, 384, 48000),
+    (dict(version="1", layer=1, bitrate_index=1, rate_index=0, padding=1), 36, 384, 44100),
+    (dict(version="2", layer=3, bitrate_index=8, rate_index=0), 208, 576, 22050),
+    (dict(version="2.5", layer=3, bitrate_index=4, rate_index=2), 288, 576, 8000),
+    (dict(version="2", layer=2, bitrate_index=8, rate_index=1), 384, 1152, 24000),
+]
+
+
+def check_frame_sizes():
+    problems = []
+    for fields, length, samples, rate in FRAME_SIZES:
+        hdr = parse_frame_header(frame_header(**fields), 0)
+        if hdr is None or hdr[:3] != (length, samples, rate):
+            problems.append("%r gave %r, expected %r" % (fields, hdr and hdr[:3], (length, samples, rate)))
+    for bad in (b"\xff\xe8\x90\x00",   # reserved version
+                b"\xff\xf9\x90\x00",   # reserved layer
+                b"\xff\xfb\xf0\x00",   # bad bitrate index
+                b"\xff\xfb\x9c\x00"):  # reserved sample rate
+        if parse_frame_header(bad, 0) is not None:
+            problems.append("%r was taken for a frame header" % bad)
+    return problems
+
+
+def _id3v2(size):
+    s = bytearray(4)
+    for i in range(4):
+        s[3 - i] = (size >> (7 * i)) & 0x7F
+    return b"ID3\x03\x00\x00" + bytes(s) + b"\0" * size
+
+
+def _xing_frame(frames, tag=b"Xing", mono=False):
+    data = bytearray(frame(mono=mono))
+    x = 4 + (17 if mono else 32)
+    data[x:x + 12] = tag + struct.pack(">II", 0x01, frames)
+    return bytes(data)
+
+
+def _vbri_frame(frames):
+    data = bytearray(frame())
+    data[36:36 + 18] = b"VBRI" + struct.pack(">HHHII", 1, 0, 75, 0, frames)
+    return bytes(data)
+
+
+# (name, stream, expected duration)
+SPF = 1152 / 44100
+STREAMS = [
+    ("frame walk", frame() * 100, 100 * SPF),
+    ("padded frames", (frame() + frame(padding=1)) * 50, 100 * SPF),
+    ("mpeg2 frames", frame(version="2", bitrate_index=8) * 10, 10 * 576 / 22050),
+    ("id3v2 and id3v1 tags", _id3v2(300) + frame() * 10 + b"TAG" + b"\0" * 125, 10 * SPF),
+    ("junk between frames", frame() * 10 + b"\xff\x00junk" * 7 + frame() * 10, 20 * SPF),
+    ("xing header", _xing_frame(5000) + frame() * 3, 5000 * SPF),
+    ("info header, mono", _xing_frame(40, b"Info", mono=True) + frame(mono=True) * 3, 40 * SPF),
+    ("vbri header", _vbri_frame(777) + frame() * 3, 777 * SPF),
+    ("no frames", b"\0" * 1000, None),
+    # cut inside the header frame, so there is not one whole frame to count
+    ("truncated xing flags", _xing_frame(5000)[:4 + 32 + 6], 0.0),
+    ("truncated xing frame count", _xing_frame(5000)[:4 + 32 + 10], 0.0),
+    ("truncated vbri frame count", _vbri_frame(777)[:4 + 32 + 16], 0.0),
+]
+
+
+def check_streams():
+    problems = []
+    for name, data, expected in STREAMS:
+        try:
+            got = scan_duration(data)
+        except struct.error as e:
+            problems.append("%s: raised %s" % (name, e))
+            continue
+        if expected is None or got is None:
+            ok = got is expected
+        else:
+            ok = abs(got - expected) < 1e-9
+        if not ok:
+            problems.append("%s: got %r, expected %r" % (name, got, expected))
+    return problems
+
+
+def last_clip_ends(dirs):
+    # real path of every mp3 -> the latest clipEnd any overlay plays it to
+    ends = {}
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            for fn in filenames:
+                if not fn.endswith(".smil"):
+                    continue
+                smil = os.path.join(dirpath, fn)
+                for audio in etree.parse(smil).iter(_SMIL_AUDIO):
+                    src, clip_end = audio.get("src"), audio.get("clipEnd")
+                    if not src or not clip_end or not src.endswith(".mp3"):
+                        continue
+                    path = os.path.realpath(os.path.join(dirpath, src))
+                    if not os.path.isfile(path):
+                        # the overlay templates in tests/mo/res only resolve inside a book
+                        continue
+                    ends[path] = max(ends.get(path, 0), parse_clock_value(clip_end))
+    return ends
+
+
+def check_corpus(dirs):
+    problems = []
+    ends = last_clip_ends(dirs)
+    if not ends:
+        problems.append("no mp3 overlays found in %s" % ", ".join(dirs))
+    for path, end_ns in sorted(ends.items()):
+        duration = mp3_duration(path)
+        end = ns_to_seconds(end_ns)
+        name = os.path.relpath(path, _HERE)
+        if duration is None:
+            problems.append("%s: no duration" % name)
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        pos = data.find(b"\xff")
+        hdr = parse_frame_header(data, pos)
+        tolerance = TOLERANCE_FRAMES * hdr[1] / hdr[2] if hdr else 0.1
+        print("    %-40s %9.3fs, last clipEnd %9.3fs" % (name, duration, end))
+        if duration < end - 1e-3 or duration > end + tolerance:
+            problems.append("%s: %.3fs does not match the last clipEnd %.3fs" % (name, duration, end))
+    return problems
+
+
+def main(argv):
+    dirs = argv[1:] or [os.path.join(_HERE, "mo")]
+    problems = []
+    print("..frame sizes:")
+    problems.extend(check_frame_sizes())
+    print("..streams:")
+    problems.extend(check_streams())
+    print("..corpus:")
+    problems.extend(check_corpus(dirs))
+    for problem in problems:
+        print("    FAIL: %s" % problem)
+    if problems:
+        print("mp3 duration checks failed: %d" % len(problems))
+        return 1
+    print("mp3 duration checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
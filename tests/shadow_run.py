@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Differential "shadow run" harness
+#
+# Runs the legacy conversion path and a candidate path side by side over a
+# corpus of exploded epub2 trees (the tests/mo books plus generated ones),
+# diffs every output member and reports the speedup and any mismatch.
+#
+# The legacy path is the plugin as it was at BASELINE_REV: its sources are
+# taken out of git (or from a directory holding a copy of them, given with
+# --baseline) and imported apart from the current tree, so later changes to
+# src cannot creep into the reference side.  The candidates default to the
+# current tree's stages.
+#
+# The OPF stage only needs opf_converter.py and always runs.  The xhtml, ncx
+# and nav stages import plugin.py and so need the Sigil plugin launcher
+# directory (quickparser.py, epub_utils.py) on the path, either via
+# PYTHONPATH or --sigil-launcher DIR.  Without it those stages are skipped.
+#
+# The utf-8 bytes engine (xhtml_bytes.py, the bytes_engine pref) is not a
+# default candidate as its output is not byte identical by design: it keeps
+# the tags it leaves alone as written where QuickXHTMLParser re-serializes
+# them, so their spacing (<hr /> kept where the legacy writes <hr/>),
+# attribute quotes and any unquoted attribute values differ.  Shadow it with
+# --candidate xhtml=shadow_run:bytes_xhtml and expect those mismatches.
+#
+# usage: python shadow_run.py [--generated N] [--repeat N]
+#                             [--candidate stage=module:function]
+#                             [--baseline REV|DIR]
+#                             [--sigil-launcher DIR] [corpus_dir ...]
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+import io
+import re
+import time
+import copy
+import shutil
+import tempfile
+import difflib
+import importlib
+import subprocess
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(os.path.dirname(_HERE), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+from opf_converter import Opf_Converter
+
+STAGES = ["xhtml", "opf", "ncx", "nav"]
+
+# the tree the legacy side of the comparison is pinned to
+BASELINE_REV = "c2a5b3d"
+
+# the baseline modules, keyed by module name, filled in by main()
+BASELINE = {}
+
+# candidate engines keyed by stage name, each must have the same signature
+# as the legacy stage function it shadows, the defaults are set up below
+# the current tree's stage functions
+CANDIDATES = {}
+
+_DCTERMS_MODIFIED = re.compile(r'(property="dcterms:modified"\s*>)[^<]*(<)')
+
+_ROOTFILE = re.compile(r'<rootfile\b[^>]*full-path="([^"]+)"')
+_ITEM = re.compile(r'<item\b[^>]*>')
+_ITEMREF = re.compile(r'<itemref\b[^>]*>')
+_ATTR = re.compile(r'([\w:-]+)\s*=\s*"([^"]*)"')
+
+
+def normalize_member(data):
+    # the only volatile part of our output is the modification timestamp
+    return _DCTERMS_MODIFIED.sub(r'\1MODIFIED\2', data)
+
+
+def diff_member(name, legacy, candidate, context=3, limit=40):
+    """
+    Return a list of unified diff lines between the normalized
+    legacy and candidate data of one output member,
+    or an empty list if they are identical.
+    """
+    a = normalize_member(legacy)
+    b = normalize_member(candidate)
+    if a == b:
+        return []
+    lines = list(difflib.unified_diff(a.splitlines(True), b.splitlines(True),
+                                      "legacy/" + name, "candidate/" + name, n=context))
+    if len(lines) > limit:
+        lines = lines[:limit] + ["... %d more diff lines\n" % (len(lines) - limit)]
+    return lines
+
+
+class ExplodedBook(object):
+    """
+    Read only view of an exploded epub2 tree offering the part of
+    the Sigil BookContainer interface the conversion code uses.
+    """
+
+    def __init__(self, root, qp=None):
+        self.root = root
+        self.qp = qp
+        container = self.readotherfile("META-INF/container.xml")
+        self.opfbookpath = _ROOTFILE.search(container).group(1)
+        self.opfdir = self.get_startingdir(self.opfbookpath)
+        self.manifest = []
+        self.spine = []
+        self.tocid = None
+        opf = self.readotherfile(self.opfbookpath)
+        for tag in _ITEM.findall(opf):
+            attr = dict(_ATTR.findall(tag))
+            mid, href, mime = attr.get("id"), attr.get("href"), attr.get("media-type")
+            self.manifest.append((mid, href, mime))
+            if mime == "application/x-dtbncx+xml":
+                self.tocid = mid
+        self.id_to_href = dict((m[0], m[1]) for m in self.manifest)
+        for tag in _ITEMREF.findall(opf):
+            attr = dict(_ATTR.findall(tag))
+            idref = attr.get("idref")
+            self.spine.append((idref, attr.get("linear"), self.id_to_href.get(idref)))
+
+    def launcher_version(self):
+        return 20190927
+
+    def epub_version(self):
+        return "2.0"
+
+    def get_opfbookpath(self):
+        return self.opfbookpath
+
+    def gettocid(self):
+        return self.tocid
+
+    def get_startingdir(self, bookpath):
+        return bookpath.rpartition("/")[0]
+
+    def build_bookpath(self, href, starting_dir):
+        # like Sigil's, this does not unquote href
+        parts = starting_dir.split("/") if starting_dir else []
+        for seg in href.split("/"):
+            if seg == "..":
+                if parts:
+                    parts.pop()
+            elif seg not in ("", "."):
+                parts.append(seg)
+        return "/".join(parts)
+
+    def get_relativepath(self, from_bookpath, to_bookpath):
+        start = self.get_startingdir(from_bookpath)
+        return os.path.relpath(to_bookpath, start or ".").replace(os.sep, "/")
+
+    def id_to_bookpath(self, mid):
+        return self.build_bookpath(unquote(self.id_to_href[mid]), self.opfdir)
+
+    def basename_to_id(self, basename, ext=None):
+        for mid, href, mime in self.manifest:
+            if href.rpartition("/")[2] == basename:
+                return mid
+        return None
+
+    def manifest_iter(self):
+        for item in self.manifest:
+            yield item
+
+    def text_iter(self):
+        for mid, href, mime in self.manifest:
+            if mime == "application/xhtml+xml":
+                yield mid, href
+
+    def spine_iter(self):
+        for item in self.spine:
+            yield item
+
+    def readotherfile(self, bookpath):
+        with open(os.path.join(self.root, bookpath.replace("/", os.sep)), "rb") as f:
+            return f.read().decode("utf-8")
+
+    def readfile(self, mid):
+        return self.readotherfile(self.id_to_bookpath(mid))
+
+
+def find_corpus(dirs):
+    # any directory holding a META-INF/container.xml is an exploded book
+    books = []
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            if os.path.isfile(os.path.join(dirpath, "META-INF", "container.xml")):
+                books.append(dirpath)
+                dirnames[:] = []
+    return books
+
+
+def extract_baseline(rev, dest):
+    """
+    Write the python sources of src/ as of git revision rev into
+    dest, raise CalledProcessError or OSError if git cannot.
+    """
+    top = os.path.dirname(_HERE)
+    names = subprocess.check_output(["git", "ls-tree", "--name-only", rev, "src/"], cwd=top)
+    for bookpath in names.decode("utf-8").splitlines():
+        if not bookpath.endswith(".py"):
+            continue
+        data = subprocess.check_output(["git", "show", "%s:%s" % (rev, bookpath)], cwd=top)
+        with open(os.path.join(dest, bookpath.rpartition("/")[2]), "wb") as f:
+            f.write(data)
+    return dest
+
+
+def import_baseline(src_dir, modname):
+    """
+    Import modname from the baseline sources in src_dir.  The current
+    tree's modules of the same names are set aside for the import and
+    put back afterwards, so neither side ever sees the other's code.
+    """
+    shadowed = [fn[:-3] for fn in os.listdir(src_dir) if fn.endswith(".py")]
+    saved_modules = dict((name, sys.modules.pop(name)) for name in shadowed if name in sys.modules)
+    saved_path = list(sys.path)
+    sys.path.insert(0, src_dir)
+    importlib.invalidate_caches()
+    try:
+        return importlib.import_module(modname)
+    finally:
+        for name in shadowed:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved_modules)
+        sys.path[:] = saved_path
+
+
+def generate_book(root, nchapters, nparas):
+    """
+    Write a synthetic exploded epub2 book with nchapters xhtml files of
+    nparas paragraphs each, using named entities, epub:types and a guide.
+    """
+    def write(bookpath, data):
+        fpath = os.path.join(root, bookpath.replace("/", os.sep))
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with open(fpath, "wb") as f:
+            f.write(data.encode("utf-8"))
+
+    write("mimetype", "application/epub+zip")
+    write("META-INF/container.xml",
+          '<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+          '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+          '</container>\n')
+    items = []
+    refs = []
+    navpoints = []
+    for c in range(1, nchapters + 1):
+        cid = "c%04d" % c
+        body = []
+        for p in range(1, nparas + 1):
+            body.append('<p id="p%d">Caf&eacute; &amp; cr&egrave;me &mdash; para %d&hellip;</p>\n' % (p, p))
+        write("OEBPS/Text/%s.xhtml" % cid,
+              '<?xml version="1.0" encoding="utf-8"?>\n'
+              '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
+              '<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n'
+              '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />\n'
+              '<title>Chapter %d</title>\n</head>\n<body>\n'
+              '<h1 id="h" epub:type="chapter" title="Chapter %d">Chapter <big>%d</big></h1>\n%s'
+              '</body>\n</html>\n' % (c, c, c, "".join(body)))
+        items.append('<item id="%s" href="Text/%s.xhtml" media-type="application/xhtml+xml"/>\n' % (cid, cid))
+        refs.append('<itemref idref="%s"/>\n' % cid)
+        navpoints.append('<navPoint id="np%d" playOrder="%d"><navLabel><text>Chapter %d</text></navLabel>'
+                         '<content src="Text/%s.xhtml#h"/></navPoint>\n' % (c, c, c, cid))
+    write("OEBPS/content.opf",
+          '<?xml version="1.0" encoding="utf-8"?>\n'
+          '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="BookId">\n'
+          '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
+          '<dc:identifier id="BookId" opf:scheme="UUID">0000-generated-%d-%d</dc:identifier>\n'
+          '<dc:title>Generated %d x %d</dc:title>\n'
+          '<dc:creator opf:role="aut" opf:file-as="Author, Some">Some Author</dc:creator>\n'
+          '<dc:language>en</dc:language>\n'
+          '<dc:date opf:event="modification">2020-01-01</dc:date>\n'
+          '<meta name="calibre:series" content="Generated" />\n'
+          '<meta name="calibre:series_index" content="%d" />\n'
+          '</metadata>\n<manifest>\n'
+          '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n%s'
+          '</manifest>\n<spine toc="ncx">\n%s</spine>\n'
+          '<guide>\n<reference type="text" title="Start" href="Text/c0001.xhtml"/>\n</guide>\n'
+          '</package>\n' % (nchapters, nparas, nchapters, nparas, nchapters, "".join(items), "".join(refs)))
+    write("OEBPS/toc.ncx",
+          '<?xml version="1.0" encoding="utf-8"?>\n'
+          '<!DOCTYPE ncx PUBLIC "-//NISO//DTD ncx 2005-1//EN" "http://www.daisy.org/z3986/2005/ncx-2005-1.dtd">\n'
+          '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n<head>\n'
+          '<meta name="dtb:uid" content="0000-generated" />\n</head>\n'
+          '<docTitle><text>Generated</text></docTitle>\n<navMap>\n%s</navMap>\n</ncx>\n' % "".join(navpoints))
+    return root
+
+
+# legacy stage functions, run against the baseline modules
+# each takes the book and a state dict shared between the stages of
+# a single book and returns a dict of output member name -> data
+
+def legacy_xhtml(bk, state):
+    convert_xhtml = BASELINE["plugin"].convert_xhtml
+    res = {}
+    for mid, href in bk.text_iter():
+        bookhref = bk.id_to_bookpath(mid)
+        data, mprops, sprops, etypes = convert_xhtml(bk, mid, bookhref)
+        # the baseline does not collect element ids
+        _store_xhtml_props(state, mid, mprops, sprops, etypes, set())
+        res[bookhref] = data
+    return res
+
+
+def _store_xhtml_props(state, mid, mprops, sprops, etypes, ids):
+    state["ids"][mid] = ids
+    if len(sprops) > 0:
+        state["sprops"][mid] = " ".join(sprops)
+    if len(mprops) > 0:
+        state["mprops"][mid] = " ".join(mprops)
+    if len(etypes) > 0:
+        state["etypes"][mid] = etypes
+
+
+def legacy_opf(bk, state):
+    return _opf(BASELINE["opf_converter"].Opf_Converter, bk, state)
+
+
+def legacy_ncx(bk, state):
+    return _ncx(BASELINE["plugin"].parse_ncx, bk, state)
+
+
+def legacy_nav(bk, state):
+    build_nav = BASELINE["plugin"].build_nav
+    navbookhref, guide = _nav_args(bk, state)
+    data = build_nav(bk, navbookhref, state.get("doctitle"), state.get("toclist", []),
+                     state.get("pagelist", []), guide, state["etypes"], state.get("lang", "en"))
+    return {navbookhref: data}
+
+
+LEGACY = {
+    "xhtml": legacy_xhtml,
+    "opf": legacy_opf,
+    "ncx": legacy_ncx,
+    "nav": legacy_nav,
+}
+
+
+# the current tree's stage functions
+
+def current_xhtml(bk, state):
+    from plugin import convert_xhtml
+    res = {}
+    for mid, href in bk.text_iter():
+        bookhref = bk.id_to_bookpath(mid)
+        out = io.StringIO()
+        _store_xhtml_props(state, mid, *convert_xhtml(bk, mid, bookhref, out))
+        res[bookhref] = out.getvalue()
+    return res
+
+
+def current_opf(bk, state):
+    return _opf(Opf_Converter, bk, state)
+
+
+def current_ncx(bk, state):
+    from plugin import parse_ncx
+    return _ncx(parse_ncx, bk, state)
+
+
+def current_nav(bk, state):
+    from plugin import build_nav
+    navbookhref, guide = _nav_args(bk, state)
+    out = io.StringIO()
+    build_nav(bk, navbookhref, state.get("doctitle"), state.get("toclist", []),
+              state.get("pagelist", []), guide, state["etypes"], state.get("lang", "en"), out)
+    return {navbookhref: out.getvalue()}
+
+
+def _opf(opf_converter, bk, state):
+    opfbookhref = bk.get_opfbookpath()
+    man_ids = [mid for mid, href, mime in bk.manifest_iter()]
+    opfconv = opf_converter(bk.readotherfile(opfbookhref), state["sprops"], state["mprops"], {}, man_ids)
+    state["lang"] = opfconv.get_lang()
+    state["uid"] = opfconv.get_uid()
+    state["guide"] = opfconv.get_guide()
+    return {opfbookhref: opfconv.get_opf3()}
+
+
+def _ncx(parse_ncx, bk, state):
+    ncxbookhref = bk.id_to_bookpath(bk.gettocid())
+    temp_dir = tempfile.mkdtemp()
+    try:
+        fpath = os.path.join(temp_dir, ncxbookhref.replace("/", os.sep))
+        os.makedirs(os.path.dirname(fpath))
+        doctitle, toclist, pagelist = parse_ncx(bk, ncxbookhref, temp_dir, state.get("uid", ""))
+        with open(fpath, "rb") as f:
+            data = f.read().decode("utf-8")
+    finally:
+        shutil.rmtree(temp_dir)
+    state["doctitle"], state["toclist"], state["pagelist"] = doctitle, toclist, pagelist
+    return {ncxbookhref: data}
+
+
+def _nav_args(bk, state):
+    opfbookpath = bk.get_opfbookpath()
+    navbookhref = bk.build_bookpath("nav.xhtml", bk.get_startingdir(opfbookpath))
+    guide = []
+    spine_hrefs = [t[2] for t in bk.spine_iter()]
+    for gtyp, gtitle, ghref in state.get("guide", []):
+        if ghref in spine_hrefs:
+            ahref, asep, afrag = ghref.partition('#')
+            guide.append((gtyp, gtitle, bk.build_bookpath(ahref, bk.get_startingdir(opfbookpath)) + asep + afrag))
+    return navbookhref, guide
+
+
+def bytes_xhtml(bk, state):
+    # tags left alone are kept as written, see the notes at the top
+    from xhtml_bytes import convert_xhtml_bytes
+    res = {}
+    for mid, href in bk.text_iter():
+        bookhref = bk.id_to_bookpath(mid)
+        with open(os.path.join(bk.root, bookhref.replace("/", os.sep)), "rb") as f:
+            data = f.read()
+        out = io.BytesIO()
+        _store_xhtml_props(state, mid, *convert_xhtml_bytes(data, bookhref, out))
+        res[bookhref] = out.getvalue().decode("utf-8")
+    return res
+
+
+CANDIDATES.update(xhtml=current_xhtml, opf=current_opf, ncx=current_ncx, nav=current_nav)
+
+
+def _new_state():
+    return {"sprops": {}, "mprops": {}, "etypes": {}, "ids": {}}
+
+
+def _timed(func, bk, state, repeat):
+    # every repeat starts from a fresh copy of the state left by the earlier stages
+    best = None
+    for i in range(repeat):
+        st = copy.deepcopy(state)
+        start = time.perf_counter()
+        out = func(bk, st)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return out, best, st
+
+
+def shadow_book(root, stages, candidates, repeat=3, qp_factory=None):
+    """
+    Run every stage of one book through the legacy and candidate paths.
+    Return a list of (stage, legacy_secs, candidate_secs, mismatches) where
+    mismatches is a list of (member, diff_lines).
+    """
+    results = []
+    state = _new_state()
+    for stage in stages:
+        legacy = LEGACY[stage]
+        candidate = candidates[stage]
+        lbk = ExplodedBook(root, qp_factory() if qp_factory else None)
+        cbk = ExplodedBook(root, qp_factory() if qp_factory else None)
+        lout, ltime, lstate = _timed(legacy, lbk, state, repeat)
+        cout, ctime, cstate = _timed(candidate, cbk, state, repeat)
+        mismatches = []
+        for name in sorted(set(lout) | set(cout)):
+            if name not in cout:
+                mismatches.append((name, ["member missing from candidate output\n"]))
+            elif name not in lout:
+                mismatches.append((name, ["unexpected member in candidate output\n"]))
+            else:
+                lines = diff_member(name, lout[name], cout[name])
+                if lines:
+                    mismatches.append((name, lines))
+        results.append((stage, ltime, ctime, mismatches))
+        # later stages always see the legacy results
+        state = lstate
+    return results
+
+
+def _load_callable(spec):
+    modname, _, funcname = spec.partition(":")
+    return getattr(importlib.import_module(modname), funcname)
+
+
+def main(argv):
+    corpus = []
+    generated = 2
+    repeat = 3
+    baseline = BASELINE_REV
+    candidates = dict(CANDIDATES)
+    args = list(argv[1:])
+    while args:
+        arg = args.pop(0)
+        if arg == "--generated":
+            generated = int(args.pop(0))
+        elif arg == "--repeat":
+            repeat = max(1, int(args.pop(0)))
+        elif arg == "--candidate":
+            stage, _, spec = args.pop(0).partition("=")
+            candidates[stage] = _load_callable(spec)
+        elif arg == "--baseline":
+            baseline = args.pop(0)
+        elif arg == "--sigil-launcher":
+            sys.path.insert(0, args.pop(0))
+        else:
+            corpus.append(arg)
+    if not corpus:
+        corpus = [os.path.join(_HERE, "mo")]
+
+    base_dir = None
+    if not os.path.isdir(baseline):
+        base_dir = tempfile.mkdtemp()
+        try:
+            extract_baseline(baseline, base_dir)
+        except (subprocess.CalledProcessError, OSError) as e:
+            shutil.rmtree(base_dir)
+            print("Error: cannot read the baseline sources at %s: %s" % (baseline, e))
+            return 1
+    src_dir = base_dir or baseline
+    gen_dir = tempfile.mkdtemp()
+    try:
+        print("..info: legacy side is the baseline at %s" % baseline)
+        BASELINE["opf_converter"] = import_baseline(src_dir, "opf_converter")
+        stages = STAGES
+        qp_factory = None
+        try:
+            from quickparser import QuickXHTMLParser
+            BASELINE["plugin"] = import_baseline(src_dir, "plugin")
+            qp_factory = QuickXHTMLParser
+        except ImportError as e:
+            print("..info: Sigil plugin launcher not found (%s), only running the opf stage" % e)
+            stages = ["opf"]
+
+        books = find_corpus(corpus)
+        for i in range(generated):
+            nchapters = 10 * (10 ** i)
+            books.append(generate_book(os.path.join(gen_dir, "generated_%d" % nchapters), nchapters, 50))
+
+        failures = 0
+        totals = dict((s, [0.0, 0.0]) for s in stages)
+        for root in books:
+            print("..book: ", os.path.relpath(root))
+            for stage, ltime, ctime, mismatches in shadow_book(root, stages, candidates, repeat, qp_factory):
+                totals[stage][0] += ltime
+                totals[stage][1] += ctime
+                speedup = ltime / ctime if ctime > 0 else float("inf")
+                status = "ok" if not mismatches else "MISMATCH (%d members)" % len(mismatches)
+                print("    %-6s legacy %9.4fs  candidate %9.4fs  speedup %6.2fx  %s" % (stage, ltime, ctime, speedup, status))
+                for name, lines in mismatches:
+                    failures += 1
+                    sys.stdout.write("".join(lines))
+        print("..totals:")
+        for stage in stages:
+            ltime, ctime = totals[stage]
+            speedup = ltime / ctime if ctime > 0 else float("inf")
+            print("    %-6s legacy %9.4fs  candidate %9.4fs  speedup %6.2fx" % (stage, ltime, ctime, speedup))
+    finally:
+        shutil.rmtree(gen_dir)
+        if base_dir is not None:
+            shutil.rmtree(base_dir)
+
+    if failures:
+        print("Shadow run found %d mismatched members" % failures)
+        return 1
+    print("Shadow run complete, all outputs identical")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
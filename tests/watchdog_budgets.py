@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Time budget checks for the Watchdog
+#
+# Books are mostly made of short documents, far fewer tokens each than
+# the Watchdog's CHECK_INTERVAL, so the budgets must hold across many
+# short documents and not only inside one long one.  Every case converts
+# a run of small xhtml documents with the bytes engine the way the plugin
+# does (start_document, convert, end_document) and checks the overrun is
+# caught, and caught in time.
+#
+# usage: python watchdog_budgets.py
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+import io
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(os.path.dirname(_HERE), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+import watchdog as watchdog_module
+from watchdog import Watchdog, ConversionTimeout
+from xhtml_bytes import convert_xhtml_bytes
+
+# a document of a couple of dozen tokens
+SHORT_DOC = (b'<?xml version="1.0" encoding="utf-8"?>\n'
+             b'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>t</title></head>\n'
+             b'<body><p id="a">one &amp; two</p><p>three</p></body></html>\n')
+
+
+def convert_docs(watchdog, count):
+    """
+    Convert count short documents, return how many were converted
+    before the first ConversionTimeout and that timeout, or None.
+    """
+    for i in range(count):
+        try:
+            watchdog.start_document("doc%d" % i)
+            convert_xhtml_bytes(SHORT_DOC, "OEBPS/Text/doc%d.xhtml" % i, io.BytesIO(), watchdog)
+        except ConversionTimeout as e:
+            return i, e
+        watchdog.end_document()
+    return count, None
+
+
+class FakeClock(object):
+
+    # a clock that moves on by step seconds every time it is read
+
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def check_book_budget():
+    # a 1ms budget cannot hold for 10000 documents
+    watchdog = Watchdog(0, 0.001)
+    done, err = convert_docs(watchdog, 10000)
+    if err is None:
+        return "the book budget never fired over 10000 short documents"
+    if err.scope != "book":
+        return "expected a book timeout, got %s" % err
+    if done >= 10000:
+        return "the book budget fired only after the last document"
+    return None
+
+
+def check_book_budget_at_start():
+    # a book already over its budget converts nothing more
+    watchdog = Watchdog(0, 1, book_start=watchdog_module._clock() - 10)
+    done, err = convert_docs(watchdog, 10)
+    if err is None or err.scope != "book" or done != 0:
+        return "an overrun book budget was not caught at the first document (%d converted)" % done
+    return None
+
+
+def check_doc_budget_across_documents():
+    # every clock read is a second later so any check overruns a 0.5s
+    # document budget, the checks must come round within a few short
+    # documents rather than never
+    saved = watchdog_module._clock
+    watchdog_module._clock = FakeClock(1.0)
+    try:
+        watchdog = Watchdog(0.5, 0)
+        per_doc = max(1, count_checks(SHORT_DOC))
+        done, err = convert_docs(watchdog, 1000)
+    finally:
+        watchdog_module._clock = saved
+    if err is None:
+        return "the document budget never fired over 1000 short documents"
+    if err.scope != "document":
+        return "expected a document timeout, got %s" % err
+    limit = Watchdog.CHECK_INTERVAL // per_doc + 2
+    if done > limit:
+        return "the document budget fired only at document %d, expected by %d" % (done, limit)
+    return None
+
+
+def count_checks(data):
+    # the number of check() calls converting data makes
+    class Counter(Watchdog):
+        def check(self):
+            self.ticks += 1
+    counter = Counter()
+    counter.start_document("count")
+    convert_xhtml_bytes(data, "OEBPS/Text/count.xhtml", io.BytesIO(), counter)
+    return counter.ticks
+
+
+CASES = [
+    ("book budget over many short documents", check_book_budget),
+    ("book budget checked as a document starts", check_book_budget_at_start),
+    ("document budget across short documents", check_doc_budget_across_documents),
+]
+
+
+def main(argv):
+    failures = 0
+    for name, check in CASES:
+        problem = check()
+        if problem is None:
+            print("    %-45s ok" % name)
+        else:
+            print("    %-45s FAIL: %s" % (name, problem))
+            failures += 1
+    if failures:
+        print("Watchdog checks failed: %d" % failures)
+        return 1
+    print("Watchdog checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Worst case complexity and fuzz checks for the OPF, entity and xhtml parsers
+#
+# Each scaling case builds a hostile input at doubling sizes, times the
+# parser on it and fits the growth exponent on a log-log scale.  Anything
+# growing faster than O(n log n) (within a noise allowance) fails, as does
+# any single run exceeding the hang limit.  The fuzz pass randomly mutates
+# the tests/mo OPF files and checks the converter always terminates and
+# produces text.
+#
+# usage: python worst_case.py [--seed N] [--fuzz N] [--max-exponent X]
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+import io
+import math
+import time
+import random
+import signal
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(os.path.dirname(_HERE), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+from opf_converter import Opf_Converter
+from html_namedentities import convert_named_entities
+from xhtml_bytes import convert_xhtml_bytes
+
+# a single run taking longer than this is treated as a hang
+HANG_LIMIT = 20
+
+# n log n over a 16x range of sizes fits to an exponent of about 1.1
+MAX_EXPONENT = 1.3
+
+SIZES = [20000, 40000, 80000, 160000, 320000]
+
+
+class Hang(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise Hang()
+
+
+def _opf(metadata="", manifest=""):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="BookId">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
+            '<dc:identifier id="BookId">x</dc:identifier>\n<dc:language>en</dc:language>\n%s'
+            '</metadata>\n<manifest>\n%s</manifest>\n<spine>\n</spine>\n</package>\n' % (metadata, manifest))
+
+
+def convert_opf(opf):
+    return Opf_Converter(opf, {}, {}, {}, []).get_opf3()
+
+
+def convert_xhtml(data):
+    out = io.BytesIO()
+    convert_xhtml_bytes(data, "OEBPS/Text/x.xhtml", out)
+    return out.getvalue()
+
+
+# name, function under test, input builder for a given size
+CASES = [
+    ("opf tag with thousands of attributes", convert_opf,
+     lambda n: _opf('<meta name="x" %s/>\n' % " ".join('a%d="v"' % i for i in range(n // 8)))),
+    ("opf deeply nested metadata", convert_opf,
+     lambda n: _opf("<x-metadata>" * (n // 12) + "</x-metadata>" * (n // 12))),
+    ("opf unterminated comment", convert_opf,
+     lambda n: _opf() + "<!--" + "a- " * (n // 3)),
+    ("opf run of stray '<'", convert_opf,
+     lambda n: _opf("<" * n + "<dc:title>t</dc:title>\n")),
+    ("opf unterminated tag", convert_opf,
+     lambda n: _opf() + "<item " + 'a="b" ' * (n // 6)),
+    ("opf stray end tags", convert_opf,
+     lambda n: "</x>" * (n // 4) + _opf()),
+    ("opf large manifest", convert_opf,
+     lambda n: _opf(manifest="".join('<item id="i%d" href="Text/f%d.xhtml" media-type="application/xhtml+xml"/>\n' % (i, i)
+                                      for i in range(n // 80)))),
+    ("text full of named entities", convert_named_entities,
+     lambda n: "&eacute;&amp;x" * (n // 14)),
+    ("text full of bare ampersands", convert_named_entities,
+     lambda n: "&" * n),
+    ("entity name that never ends", convert_named_entities,
+     lambda n: "&" + "a" * n),
+    ("text of unknown entities", convert_named_entities,
+     lambda n: "&nosuchentity;" * (n // 14)),
+    ("xhtml run of stray '<'", convert_xhtml,
+     lambda n: b"<p>" + b"<" * n + b"</p>"),
+    ("xhtml unterminated comment", convert_xhtml,
+     lambda n: b"<p>x</p><!--" + b"<a- " * (n // 4)),
+    ("xhtml tag with thousands of attributes", convert_xhtml,
+     lambda n: b"<p id=\"x\" " + b" ".join(('a%d="v"' % i).encode("ascii") for i in range(n // 8)) + b">"),
+    ("xhtml deeply nested tags", convert_xhtml,
+     lambda n: b"<head>" * (n // 12) + b"</head>" * (n // 12)),
+    ("xhtml text full of named entities", convert_xhtml,
+     lambda n: b"<p>" + "&eacute;&amp;\u4e2d".encode("utf-8") * (n // 16) + b"</p>"),
+]
+
+
+def _time(func, data, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def fit_exponent(sizes, times):
+    # least squares slope of log(time) against log(size)
+    xs = [math.log(s) for s in sizes]
+    ys = [math.log(max(t, 1e-6)) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    num = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    den = sum((x - mx) ** 2 for x in xs)
+    return num / den
+
+
+def check_scaling(max_exponent):
+    failures = 0
+    for name, func, build in CASES:
+        times = []
+        try:
+            for n in SIZES:
+                data = build(n)
+                signal.alarm(HANG_LIMIT)
+                try:
+                    times.append(_time(func, data))
+                finally:
+                    signal.alarm(0)
+        except Hang:
+            print("    %-40s HANG (over %ds at size %d)" % (name, HANG_LIMIT, n))
+            failures += 1
+            continue
+        except Exception as e:
+            print("    %-40s %s: %s" % (name, type(e).__name__, e))
+            failures += 1
+            continue
+        exponent = fit_exponent(SIZES, times)
+        status = "ok"
+        if exponent > max_exponent:
+            status = "FAIL"
+            failures += 1
+        print("    %-40s %8.4fs at n=%d  exponent %5.2f  %s" % (name, times[-1], SIZES[-1], exponent, status))
+    return failures
+
+
+def _mutate(rng, data):
+    pieces = ['<', '>', '<!--', '-->', '"', "'", '=', '/', '&', '</metadata>', '<manifest>', '\n']
+    for i in range(rng.randint(1, 8)):
+        op = rng.randint(0, 2)
+        p = rng.randint(0, len(data))
+        if op == 0:
+            data = data[:p] + rng.choice(pieces) + data[p:]
+        elif op == 1:
+            data = data[:p] + data[p + rng.randint(1, 40):]
+        else:
+            data = data[:p]
+    return data
+
+
+def check_fuzz(seed, rounds):
+    rng = random.Random(seed)
+    seeds = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(_HERE, "mo")):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if fn.endswith(".opf"):
+                with open(os.path.join(dirpath, fn), "rb") as f:
+                    seeds.append(f.read().decode("utf-8"))
+    failures = 0
+    for r in range(rounds):
+        data = _mutate(rng, rng.choice(seeds))
+        signal.alarm(HANG_LIMIT)
+        try:
+            out = convert_opf(data)
+            if not isinstance(out, type("")):
+                raise TypeError("converter returned %r" % type(out))
+            convert_named_entities(data)
+        except Hang:
+            print("    fuzz round %d: HANG" % r)
+            failures += 1
+        except Exception as e:
+            print("    fuzz round %d: %s: %s" % (r, type(e).__name__, e))
+            failures += 1
+        finally:
+            signal.alarm(0)
+    print("    %d fuzz rounds with seed %d, %d failures" % (rounds, seed, failures))
+    return failures
+
+
+def main(argv):
+    seed = 1
+    rounds = 2000
+    max_exponent = MAX_EXPONENT
+    args = list(argv[1:])
+    while args:
+        arg = args.pop(0)
+        if arg == "--seed":
+            seed = int(args.pop(0))
+        elif arg == "--fuzz":
+            rounds = int(args.pop(0))
+        elif arg == "--max-exponent":
+            max_exponent = float(args.pop(0))
+    signal.signal(signal.SIGALRM, _on_alarm)
+    print("..scaling:")
+    failures = check_scaling(max_exponent)
+    print("..fuzzing:")
+    failures += check_fuzz(seed, rounds)
+    if failures:
+        print("Worst case checks failed: %d" % failures)
+        return 1
+    print("Worst case checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
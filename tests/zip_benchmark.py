@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Compression policy benchmark
+#
+# Zips each exploded book of the corpus (the tests/mo books by default)
+# with every member deflated at the default level, and again with the
+# per media type COMPRESSION_POLICY of epub_zip.py, and reports the time
+# (best of --repeat runs) and archive size of both, per book and in total.
+# Compression runs on --threads threads, 1 by default so the time is the
+# CPU the policy saves rather than how well it spreads over cores.
+#
+# usage: python zip_benchmark.py [--repeat N] [--threads N] [corpus_dir ...]
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SRC = os.path.join(os.path.dirname(_HERE), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+from epub_zip import write_epub, COMPRESSION_POLICY
+from shadow_run import ExplodedBook, find_corpus
+
+POLICIES = [
+    ("deflate all", {}),
+    ("policy", COMPRESSION_POLICY),
+]
+
+
+def book_media_types(root):
+    """
+    Return book path -> manifest media type for the exploded book at root.
+    """
+    bk = ExplodedBook(root)
+    media_types = {bk.get_opfbookpath(): "application/oebps-package+xml"}
+    for mid, href, mime in bk.manifest_iter():
+        media_types[bk.id_to_bookpath(mid)] = mime
+    return media_types
+
+
+def time_policy(root, media_types, policy, repeat, threads, out_dir):
+    fpath = os.path.join(out_dir, "book.epub")
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        write_epub(root, fpath, threads, media_types, policy)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, os.path.getsize(fpath)
+
+
+def main(argv):
+    repeat = 5
+    threads = 1
+    dirs = []
+    args = list(argv[1:])
+    while args:
+        arg = args.pop(0)
+        if arg == "--repeat":
+            repeat = int(args.pop(0))
+        elif arg == "--threads":
+            threads = int(args.pop(0))
+        else:
+            dirs.append(arg)
+    if not dirs:
+        dirs = [os.path.join(_HERE, "mo")]
+    out_dir = tempfile.mkdtemp()
+    totals = dict((name, [0.0, 0]) for name, policy in POLICIES)
+    try:
+        for root in find_corpus(dirs):
+            media_types = book_media_types(root)
+            cells = []
+            for name, policy in POLICIES:
+                elapsed, size = time_policy(root, media_types, policy, repeat, threads, out_dir)
+                totals[name][0] += elapsed
+                totals[name][1] += size
+                cells.append("%s %7.1fms %9d bytes" % (name, elapsed * 1000, size))
+            print("%-36s %s" % (os.path.basename(root), "   ".join(cells)))
+    finally:
+        shutil.rmtree(out_dir)
+    cells = ["%s %7.1fms %9d bytes" % (name, totals[name][0] * 1000, totals[name][1]) for name, policy in POLICIES]
+    print("%-36s %s" % ("total", "   ".join(cells)))
+    base_time, base_size = totals[POLICIES[0][0]]
+    time_, size = totals[POLICIES[-1][0]]
+    if base_time > 0 and base_size > 0:
+        print("..info: the policy takes %.0f%% of the time for %+.2f%% archive size" % (
+            100.0 * time_ / base_time, 100.0 * (size - base_size) / base_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))